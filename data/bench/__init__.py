@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""Benchmarks for the Darwin Core Archive to CartoDB ingest pipeline.
+
+dwca.py generates synthetic archives, fakecdb.py serves a local stand-in for
+the CartoDB SQL API, and run.py runs the benchmarks and compares them with a
+stored baseline.
+"""
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module generates synthetic Darwin Core Archives for benchmarks.
+
+An archive has a meta.xml and one occurrence core data file. The number of
+rows and columns, the encoding, the delimiter, the line terminator and the
+quote character are configurable, and the same seed always generates the same
+archive. Taxon names are drawn from a fixed taxonomy so that, as in real
+archives, the taxon columns repeat a limited number of distinct names.
+
+Usage:
+    python bench/dwca.py -r 100000 -o occurrence.zip
+"""
+
+import csv
+import os
+import random
+import shutil
+import tempfile
+import zipfile
+
+from optparse import OptionParser
+from xml.sax.saxutils import quoteattr
+
+DWC_NAMESPACE = 'http://rs.tdwg.org/dwc/terms/'
+
+# The default columns, in order, after the id column:
+COLUMNS = ['basisOfRecord', 'institutionCode', 'collectionCode', 'catalogNumber',
+           'scientificName', 'kingdom', 'phylum', 'class', 'order', 'family',
+           'genus', 'specificEpithet', 'country', 'stateProvince', 'locality',
+           'decimalLatitude', 'decimalLongitude', 'year', 'month', 'day',
+           'eventDate', 'recordedBy', 'occurrenceRemarks']
+
+# More text columns, used when more columns are asked for than COLUMNS has:
+EXTRA_COLUMNS = ['county', 'habitat', 'preparations', 'sex', 'lifeStage',
+                 'fieldNumber', 'recordNumber', 'identifiedBy', 'typeStatus',
+                 'waterBody', 'islandGroup', 'continent', 'municipality',
+                 'verbatimLocality', 'verbatimEventDate', 'georeferencedBy']
+
+COUNTRIES = [u'United States', u'Mexico', u'Brasil', u'Canada', u'Perú',
+             u'Côte d’Ivoire', u'Österreich', u'España']
+
+LOCALITIES = [u'3 mi N of Lawrence', u'Río Grande, 2 km E of bridge',
+              u'São Paulo, near the coast', u'Zürich', u'Mt. Diablo summit',
+              u'Bosque "La Selva"', u'Kraków outskirts', u'Lake Tahoe, south shore']
+
+METAFILE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="eml.xml">
+  <core encoding=%(encoding)s fieldsTerminatedBy=%(delimiter)s linesTerminatedBy=%(terminator)s fieldsEnclosedBy=%(enclosure)s ignoreHeaderLines="1" rowType="http://rs.tdwg.org/dwc/terms/Occurrence">
+    <files>
+      <location>%(location)s</location>
+    </files>
+    <id index="0"/>
+%(fields)s
+  </core>
+</archive>
+"""
+
+def get_columns(count=None):
+    """Returns a list of count column names (all of COLUMNS by default)."""
+    columns = COLUMNS + EXTRA_COLUMNS
+    if count is None:
+        return list(COLUMNS)
+    if count > len(columns):
+        raise ValueError('At most %s columns are supported' % len(columns))
+    return columns[:count]
+
+def get_taxonomy(species):
+    """Returns a list of taxonomy dictionaries, one per species.
+
+    Each genus has 8 species, each family 5 genera, and so on up to 2 kingdoms.
+    """
+    taxa = []
+    for n in range(species):
+        genus = n / 8
+        family = genus / 5
+        order = family / 4
+        klass = order / 4
+        phylum = klass / 3
+        taxa.append({
+            'kingdom': 'Kingdom%d' % (phylum / 5 % 2),
+            'phylum': 'Phylum%d' % phylum,
+            'class': 'Class%d' % klass,
+            'order': 'Order%d' % order,
+            'family': 'Family%didae' % family,
+            'genus': 'Genus%d' % genus,
+            'specificEpithet': 'epithet%d' % n,
+            'scientificName': 'Genus%d epithet%d' % (genus, n)})
+    return taxa
+
+def get_value(column, n, taxon, rnd):
+    """Returns a unicode value for a column of row n."""
+    if column in taxon:
+        return unicode(taxon[column])
+    if column == 'basisOfRecord':
+        return u'PreservedSpecimen'
+    if column == 'institutionCode':
+        return u'INST%d' % (n % 7)
+    if column == 'collectionCode':
+        return u'Mammals' if n % 3 else u'Birds'
+    if column == 'catalogNumber':
+        return u'%d' % (n + 1)
+    if column == 'country':
+        return rnd.choice(COUNTRIES)
+    if column == 'stateProvince':
+        return u'State %d' % rnd.randint(1, 50)
+    if column == 'locality':
+        return rnd.choice(LOCALITIES)
+    if column == 'decimalLatitude':
+        return u'' if n % 50 == 0 else u'%.5f' % rnd.uniform(-90, 90)
+    if column == 'decimalLongitude':
+        return u'' if n % 50 == 0 else u'%.5f' % rnd.uniform(-180, 180)
+    if column == 'year':
+        return u'%d' % rnd.randint(1850, 2012)
+    if column == 'month':
+        return u'%d' % rnd.randint(1, 12)
+    if column == 'day':
+        return u'%d' % rnd.randint(1, 28)
+    if column == 'eventDate':
+        return u'%d-%02d-%02d' % (rnd.randint(1850, 2012), rnd.randint(1, 12),
+                                  rnd.randint(1, 28))
+    if column == 'recordedBy':
+        return u'Collector %d' % rnd.randint(1, 500)
+    if column == 'occurrenceRemarks':
+        return u'' if n % 4 else u'Remark %d for this specimen' % n
+    return u'%s %d' % (column, rnd.randint(1, 1000))
+
+def get_metafile(columns, location, encoding, delimiter, terminator, enclosure):
+    """Returns the contents of a meta.xml for an occurrence data file."""
+    fields = '\n'.join('    <field index="%d" term="%s%s"/>' % (i + 1, DWC_NAMESPACE, x)
+                       for i, x in enumerate(columns))
+    return METAFILE % dict(
+        encoding=quoteattr(encoding.upper()),
+        delimiter=quoteattr(delimiter.encode('string_escape')),
+        terminator=quoteattr(terminator.encode('string_escape')),
+        enclosure=quoteattr(enclosure.encode('string_escape')),
+        location=location,
+        fields=fields)
+
+def write_rows(f, columns, rows, encoding, delimiter, terminator, enclosure,
+               species, seed):
+    """Writes a header and rows of generated values to the data file f."""
+    rnd = random.Random(seed)
+    taxa = get_taxonomy(species)
+    if enclosure:
+        writer = csv.writer(f, delimiter=delimiter, lineterminator=terminator,
+                            quotechar=enclosure, quoting=csv.QUOTE_MINIMAL)
+        write = writer.writerow
+    else:
+        # Unquoted values must not contain the delimiter or terminator:
+        def write(row):
+            row = [x.replace(delimiter, ' ').replace(terminator, ' ') for x in row]
+            f.write(delimiter.join(row) + terminator)
+    write([x.encode(encoding, 'replace') for x in ['id'] + columns])
+    for n in xrange(rows):
+        taxon = taxa[rnd.randrange(species)]
+        row = [u'urn:catalog:INST:%d' % (n + 1)] + \
+            [get_value(x, n, taxon, rnd) for x in columns]
+        write([x.encode(encoding, 'replace') for x in row])
+
+def generate(path, rows, columns=None, encoding='utf-8', delimiter='\t',
+             terminator='\n', enclosure='', species=1000, seed=0):
+    """Generates a Darwin Core Archive.
+
+    Args:
+        path: A string path to a .zip file, or to a directory for an archive
+            that is already extracted.
+        rows: The integer number of occurrence rows.
+        columns: An optional list of column names (see get_columns).
+        encoding: The string encoding of the data file.
+        delimiter: The string field delimiter.
+        terminator: The string line terminator.
+        enclosure: The string quote character, or '' for unquoted fields.
+        species: The integer number of distinct species.
+        seed: The integer random seed.
+
+    Returns:
+        The string path to the metafile, or to the zip file.
+    """
+    columns = columns or get_columns()
+    metafile = get_metafile(columns, 'occurrence.txt', encoding, delimiter,
+                            terminator, enclosure)
+    if not path.endswith('.zip'):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'occurrence.txt'), 'wb') as f:
+            write_rows(f, columns, rows, encoding, delimiter, terminator, enclosure,
+                       species, seed)
+        with open(os.path.join(path, 'meta.xml'), 'wb') as f:
+            f.write(metafile.encode('utf-8'))
+        return os.path.join(path, 'meta.xml')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = os.path.join(tmpdir, 'occurrence.txt')
+        with open(data, 'wb') as f:
+            write_rows(f, columns, rows, encoding, delimiter, terminator, enclosure,
+                       species, seed)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            z.writestr('meta.xml', metafile.encode('utf-8'))
+            z.write(data, 'occurrence.txt')
+    finally:
+        shutil.rmtree(tmpdir)
+    return path
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-o", "--output", dest="output",
+                      help="The .zip file, or directory, to write",
+                      default="occurrence.zip")
+    parser.add_option("-r", "--rows", dest="rows", type="int",
+                      help="The number of occurrence rows",
+                      default=100000)
+    parser.add_option("-c", "--columns", dest="columns", type="int",
+                      help="The number of columns after the id",
+                      default=None)
+    parser.add_option("-e", "--encoding", dest="encoding",
+                      help="The encoding of the data file",
+                      default="utf-8")
+    parser.add_option("-t", "--delimiter", dest="delimiter",
+                      help="The field delimiter, e.g., \\t or ,",
+                      default="\\t")
+    parser.add_option("-l", "--terminator", dest="terminator",
+                      help="The line terminator, e.g., \\n or \\r\\n",
+                      default="\\n")
+    parser.add_option("-q", "--enclosure", dest="enclosure",
+                      help="The quote character, empty for unquoted fields",
+                      default="")
+    parser.add_option("-n", "--species", dest="species", type="int",
+                      help="The number of distinct species",
+                      default=1000)
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="The random seed",
+                      default=0)
+    (options, args) = parser.parse_args()
+    print generate(options.output, options.rows, get_columns(options.columns),
+                   options.encoding, options.delimiter.decode('string_escape'),
+                   options.terminator.decode('string_escape'),
+                   options.enclosure.decode('string_escape'), options.species,
+                   options.seed)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module serves a local stand-in for the CartoDB SQL API.
+
+It answers the OAuth access token request and the statements sent by
+csv2cdb.py and sqlbutcher.py on /api/v1/sql: taxon inserts and lookups, the
+paged taxon reads of TaxonCache, occurrence inserts and deletes, and the
+chunked moves from a staging table of staging_rows rows. Taxon names are kept
+in memory and occurrence rows are only counted.
+
+Each request waits latency seconds (plus up to jitter seconds more), and a
+fraction error_rate of requests fail with a 500 error before the statement is
+applied, as a transient server error would. Requests are counted by kind.
+
+Usage:
+    python bench/fakecdb.py -P 8080 --latency 0.05 --error_rate 0.01
+
+and point csv2cdb.py at it with --host localhost:8080 --protocol http and an
+empty domain (-d '').
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import logging
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import urlparse
+
+from optparse import OptionParser
+
+LITERAL = re.compile(r"E?'(?:[^']|'')*'")
+TAXON_ARRAY = re.compile(r"ARRAY\[(.*)\]::text", re.S)
+AFTER = re.compile(r'cartodb_id > (\d+)')
+LIMIT = re.compile(r'LIMIT (\d+)')
+MOVE_RANGE = re.compile(r'cartodb_id >= (\d+) AND cartodb_id < (\d+)')
+
+def unquote(literal):
+    """Returns the value of a SQL string literal as sent by sql_literal."""
+    value = literal[2:-1] if literal.startswith('E') else literal[1:-1]
+    value = value.replace("''", "'")
+    if literal.startswith('E'):
+        value = value.replace('\\\\', '\\')
+    return value
+
+def count_tuples(values):
+    """Returns the number of tuples in the VALUES list of an insert."""
+    return LITERAL.sub('', values).count('(')
+
+class FakeSQLAPI(object):
+    """The state and statement handling of a fake SQL API.
+
+    Attributes:
+        requests: A collections.Counter of requests by kind.
+        rows: The integer number of occurrence rows inserted or moved.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, staging_rows=0, seed=0):
+        """Constructs a new FakeSQLAPI.
+
+        Args:
+            latency: The float number of seconds each request waits.
+            jitter: The float maximum number of seconds added to latency.
+            error_rate: The float fraction of requests that fail.
+            staging_rows: The integer number of rows in any staging table.
+            seed: The integer random seed for jitter and errors.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.staging_rows = staging_rows
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.names = {} # name to cartodb_id
+        self.ids = [] # names by cartodb_id - 1
+        self.requests = collections.Counter()
+        self.rows = 0
+
+    def stats(self):
+        """Returns a dictionary of request counts, occurrence rows and taxons."""
+        with self.lock:
+            return dict(requests=dict(self.requests), rows=self.rows,
+                        taxons=len(self.ids))
+
+    def execute(self, sql):
+        """Returns the (HTTP status, response dictionary) for a statement."""
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        with self.lock:
+            self.requests['total'] += 1
+            if failed:
+                self.requests['error'] += 1
+                return 500, dict(error=['internal server error'])
+            return 200, self._execute(sql.strip())
+
+    def _execute(self, sql):
+        rows = []
+        total = 0
+        if sql.startswith('INSERT INTO taxon'):
+            self.requests['taxon_insert'] += 1
+            for literal in LITERAL.findall(TAXON_ARRAY.search(sql).group(1)):
+                name = unquote(literal)
+                if name not in self.names:
+                    self.ids.append(name)
+                    self.names[name] = len(self.ids)
+                    total += 1
+        elif sql.startswith('INSERT INTO occurrence') and ' VALUES ' in sql:
+            self.requests['occurrence_insert'] += 1
+            total = count_tuples(sql.split(' VALUES ', 1)[1])
+            self.rows += total
+        elif sql.startswith('DELETE FROM occurrence'):
+            self.requests['occurrence_delete'] += 1
+            total = len(LITERAL.findall(sql))
+        elif sql.startswith('INSERT INTO occurrence'):
+            self.requests['move'] += 1
+            start, end = [int(x) for x in MOVE_RANGE.search(sql).groups()]
+            total = max(0, min(end, self.staging_rows + 1) - max(start, 1))
+            self.rows += total
+        elif 'FROM taxon WHERE name IN' in sql:
+            self.requests['taxon_lookup'] += 1
+            names = [unquote(x) for x in LITERAL.findall(sql)]
+            rows = [dict(name=x, cartodb_id=self.names[x]) for x in names if x in self.names]
+        elif 'FROM taxon' in sql and 'updated_at >' in sql:
+            self.requests['taxon_page'] += 1
+        elif 'FROM taxon' in sql:
+            self.requests['taxon_page'] += 1
+            after = AFTER.search(sql)
+            after = int(after.group(1)) if after else 0
+            limit = int(LIMIT.search(sql).group(1)) if LIMIT.search(sql) else len(self.ids)
+            rows = [dict(name=name, cartodb_id=i, updated_at='2012-01-01T00:00:00Z')
+                    for i, name in enumerate(self.ids[after:after + limit], after + 1)]
+        elif sql.startswith('SELECT min(cartodb_id)'):
+            self.requests['id_range'] += 1
+            if self.staging_rows:
+                rows = [dict(first=1, last=self.staging_rows)]
+            else:
+                rows = [dict(first=None, last=None)]
+        else:
+            self.requests['other'] += 1
+        return dict(rows=rows, total_rows=total or len(rows))
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles requests with keep-alive connections, as httplib2 sends them."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        self.respond(self.rfile.read(length))
+
+    def respond(self, params):
+        if self.path.startswith('/oauth/access_token'):
+            status, body = 200, 'oauth_token=token&oauth_token_secret=secret'
+        else:
+            sql = urlparse.parse_qs(params).get('q', [''])[0].decode('utf-8')
+            status, response = self.server.api.execute(sql)
+            body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server for a FakeSQLAPI."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, api, port=0, host='127.0.0.1'):
+        """Constructs a new Server, listening on port (0 for any free port)."""
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), Handler)
+        self.api = api
+
+    def get_address(self):
+        """Returns the host:port string of the server."""
+        return '%s:%d' % self.server_address
+    address = property(get_address)
+
+    def start(self):
+        """Serves requests on a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option("-P", "--port", dest="port", type="int",
+                      help="The port to listen on",
+                      default=8080)
+    parser.add_option("--latency", dest="latency", type="float",
+                      help="The seconds each request waits",
+                      default=0.0)
+    parser.add_option("--jitter", dest="jitter", type="float",
+                      help="The maximum seconds added to the latency",
+                      default=0.0)
+    parser.add_option("--error_rate", dest="error_rate", type="float",
+                      help="The fraction of requests that fail with a 500 error",
+                      default=0.0)
+    parser.add_option("--staging_rows", dest="staging_rows", type="int",
+                      help="The number of rows in a staging table",
+                      default=0)
+    (options, args) = parser.parse_args()
+
+    api = FakeSQLAPI(options.latency, options.jitter, options.error_rate,
+                     options.staging_rows)
+    server = Server(api, options.port)
+    logging.info('Serving a fake SQL API on http://%s' % server.address)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info('Requests: %s' % json.dumps(api.stats(), sort_keys=True))
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module runs the ingest benchmarks and compares them with a baseline.
+
+The microbenchmarks time csv_unicode.UnicodeDictReader and UnicodeDictWriter,
+parsing a metafile into a dca2csv.CoreFileType, and csv2cdb.taxons_from_csv.
+The end-to-end benchmarks run dca2csv.py on a synthetic archive, and csv2cdb.py
+and sqlbutcher.py against a fakecdb.Server with the given latency and error
+rate.
+
+Each run of a benchmark happens in a new process, so its peak RSS is its own
+(including any processes it waited for). Runs are repeated and the fastest is
+reported with its rows/s and, for end-to-end runs, the SQL API request counts.
+
+Results are compared with a baseline file written by an earlier run with
+--save. A benchmark whose rows/s dropped, or whose peak RSS grew, by more than
+the tolerance is reported as a regression and the exit status is 1.
+
+Usage:
+    python bench/run.py -r 100000 --save
+    python bench/run.py -r 100000
+    python bench/run.py -r 100000 taxons_from_csv csv2cdb
+"""
+
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DATA_DIR)
+
+import csv2cdb
+import csv_unicode as csvu
+import dca2csv
+import dwca
+import fakecdb
+
+from optparse import OptionParser
+
+# The default baseline file:
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# The number of times the metafile is parsed by the metafile benchmark:
+METAFILE_PARSES = 2000
+
+# The options that make results comparable with a baseline:
+CONFIG_KEYS = ['rows', 'columns', 'jobs', 'latency', 'jitter', 'error_rate']
+
+class Context(object):
+    """The inputs and options shared by the benchmarks.
+
+    Attributes:
+        workdir: The string path to the directory of inputs and outputs.
+        archive: The string path to the synthetic archive zip.
+        csv: The string path to the archive converted to CSV.
+        options: The command line options.
+    """
+
+    def __init__(self, workdir, options):
+        self.workdir = workdir
+        self.options = options
+        self.archive = os.path.join(workdir, 'occurrence.zip')
+        self.csv = os.path.join(workdir, 'occurrence.csv')
+
+    def prepare(self):
+        """Generates the archive and converts it to CSV, if not done already."""
+        if not os.path.exists(self.archive):
+            logging.info('Generating %s rows in %s' % (self.options.rows, self.archive))
+            dwca.generate(self.archive, self.options.rows,
+                          dwca.get_columns(self.options.columns))
+        if not os.path.exists(self.csv):
+            dca2csv.writecsv(None, self.csv, self.archive)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def script(self, name, *args):
+        """Runs a script of the data directory and raises if it fails."""
+        command = [sys.executable, os.path.join(DATA_DIR, name)] + list(args)
+        with open(self.path('%s.log' % name), 'wb') as log:
+            code = subprocess.call(command, stdout=log, stderr=log, cwd=self.workdir)
+        if code != 0:
+            raise RuntimeError('%s failed with exit status %s, see %s' %
+                               (name, code, self.path('%s.log' % name)))
+
+    def server(self, staging_rows=0):
+        """Returns a started fakecdb.Server with the latency and error options."""
+        api = fakecdb.FakeSQLAPI(self.options.latency, self.options.jitter,
+                                 self.options.error_rate, staging_rows)
+        return fakecdb.Server(api).start()
+
+    def cartodb_args(self, server):
+        """Returns the command line options that connect a script to server."""
+        return ['-k', 'key', '-s', 'secret', '-u', 'user', '-p', 'password',
+                '-d', '', '--host', server.address, '--protocol', 'http']
+
+# Benchmarks by name. Each takes a Context, does its setup, and returns a
+# function that runs the timed part and returns a dictionary with its rows:
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+@benchmark
+def unicode_dict_reader(context):
+    def run():
+        with open(context.csv, 'rb') as f:
+            rows = sum(1 for row in csvu.UnicodeDictReader(f))
+        return dict(rows=rows)
+    return run
+
+@benchmark
+def unicode_dict_writer(context):
+    with open(context.csv, 'rb') as f:
+        reader = csvu.UnicodeDictReader(f)
+        fieldnames = reader.header
+        rows = list(reader)
+    def run():
+        with open(context.path('writer.csv'), 'wb') as f:
+            writer = csvu.UnicodeDictWriter(f, fieldnames, buffer_size=csvu.BUFFER_SIZE)
+            writer.writeheader()
+            writer.writerows(rows)
+            writer.flush()
+        return dict(rows=len(rows))
+    return run
+
+@benchmark
+def core_file_type(context):
+    metafile = dwca.get_metafile(dwca.get_columns(context.options.columns),
+                                 'occurrence.txt', 'utf-8', '\t', '\n', '')
+    def run():
+        for n in xrange(METAFILE_PARSES):
+            dca2csv.CoreFileType(metafile)
+        return dict(rows=METAFILE_PARSES)
+    return run
+
+@benchmark
+def taxons_from_csv(context):
+    def run():
+        csv2cdb.taxons_from_csv(context.csv, context.options.jobs)
+        return dict(rows=context.options.rows)
+    return run
+
+@benchmark
+def dca2csv_archive(context):
+    def run():
+        context.script('dca2csv.py', '-a', context.archive, '-d', context.path('e2e.csv'),
+                       '-j', str(context.options.jobs))
+        return dict(rows=context.options.rows)
+    return run
+
+@benchmark
+def csv2cdb_upload(context):
+    # Copies the CSV file so that each run starts without a journal:
+    path = context.path('upload.csv')
+    shutil.copy(context.csv, path)
+    for name in [path + '.journal', context.path('taxon_cache.sqlite')]:
+        if os.path.exists(name):
+            os.remove(name)
+    def run():
+        server = context.server()
+        try:
+            context.script('csv2cdb.py', '-c', path, '-x', context.path('taxon_cache.sqlite'),
+                           '-j', str(context.options.jobs), *context.cartodb_args(server))
+            stats = server.api.stats()
+        finally:
+            server.stop()
+        return dict(rows=stats['rows'], requests=stats['requests'])
+    return run
+
+@benchmark
+def sqlbutcher_move(context):
+    def run():
+        server = context.server(staging_rows=context.options.rows)
+        try:
+            context.script('sqlbutcher.py', '-c', context.csv, '-t', 'staging',
+                           *context.cartodb_args(server))
+            stats = server.api.stats()
+        finally:
+            server.stop()
+        return dict(rows=stats['rows'], requests=stats['requests'])
+    return run
+
+def run_once(name, context, conn):
+    """Runs a benchmark once and sends its result on conn (in a new process)."""
+    try:
+        run = BENCHMARKS[name](context)
+        began = time.time()
+        result = run()
+        result['seconds'] = time.time() - began
+        rss = [resource.getrusage(x).ru_maxrss for x in
+               (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        result['peak_rss_kb'] = max(rss)
+        conn.send(result)
+    except Exception, e:
+        logging.exception('Benchmark %s failed' % name)
+        conn.send(dict(error=str(e)))
+    finally:
+        conn.close()
+
+def run_benchmark(name, context, repeat):
+    """Returns the result of the fastest of repeat runs of a benchmark."""
+    best = None
+    peak_rss_kb = 0
+    for n in range(repeat):
+        parent, child = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=run_once, args=(name, context, child))
+        process.start()
+        child.close()
+        result = parent.recv()
+        process.join()
+        if 'error' in result:
+            return result
+        peak_rss_kb = max(peak_rss_kb, result['peak_rss_kb'])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['rows_per_s'] = best['rows'] / best['seconds'] if best['seconds'] else 0
+    best['peak_rss_kb'] = peak_rss_kb
+    return best
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regression messages for results against a baseline."""
+    regressions = []
+    for name, result in results.iteritems():
+        base = baseline.get('results', {}).get(name)
+        if not base or 'error' in base or 'error' in result:
+            continue
+        if result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+            regressions.append('%s: %.0f rows/s, baseline %.0f rows/s' %
+                               (name, result['rows_per_s'], base['rows_per_s']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %s KB, baseline %s KB' %
+                               (name, result['peak_rss_kb'], base['peak_rss_kb']))
+    return regressions
+
+def report(results, baseline):
+    """Prints a table of results with their change from the baseline."""
+    base = baseline.get('results', {}) if baseline else {}
+    print '%-22s %12s %14s %10s %12s  %s' % ('benchmark', 'rows/s', 'vs baseline',
+                                             'seconds', 'peak RSS KB', 'requests')
+    for name, result in results.iteritems():
+        if 'error' in result:
+            print '%-22s failed: %s' % (name, result['error'])
+            continue
+        change = ''
+        if name in base and base[name].get('rows_per_s'):
+            change = '%+.1f%%' % (100.0 * result['rows_per_s'] / base[name]['rows_per_s'] - 100)
+        requests = result.get('requests')
+        print '%-22s %12.0f %14s %10.2f %12s  %s' % (
+            name, result['rows_per_s'], change, result['seconds'], result['peak_rss_kb'],
+            ' '.join('%s=%s' % x for x in sorted(requests.items())) if requests else '')
+
+def get_options():
+    """Parses and returns command line options and benchmark names."""
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option("-r", "--rows", dest="rows", type="int",
+                      help="The number of rows in the synthetic archive",
+                      default=100000)
+    parser.add_option("-c", "--columns", dest="columns", type="int",
+                      help="The number of columns in the synthetic archive",
+                      default=None)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="The number of processes used by the scripts",
+                      default=1)
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="The number of runs of each benchmark",
+                      default=3)
+    parser.add_option("--latency", dest="latency", type="float",
+                      help="The seconds each fake SQL API request waits",
+                      default=0.005)
+    parser.add_option("--jitter", dest="jitter", type="float",
+                      help="The maximum seconds added to the latency",
+                      default=0.0)
+    parser.add_option("--error_rate", dest="error_rate", type="float",
+                      help="The fraction of fake SQL API requests that fail",
+                      default=0.0)
+    parser.add_option("-w", "--workdir", dest="workdir",
+                      help="The directory for inputs and outputs, reused "
+                      "between runs (a new temporary directory by default)",
+                      default=None)
+    parser.add_option("-b", "--baseline", dest="baseline",
+                      help="The baseline results file",
+                      default=BASELINE)
+    parser.add_option("--save", dest="save", action="store_true", default=False,
+                      help="Save the results as the new baseline")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float",
+                      help="The fraction by which a result may be worse than "
+                      "the baseline",
+                      default=0.1)
+    parser.add_option("-o", "--output", dest="output",
+                      help="A file to write the results to as JSON",
+                      default=None)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    options, names = get_options()
+    unknown = [x for x in names if x not in BENCHMARKS]
+    if unknown:
+        logging.error('Unknown benchmarks %s, choose from %s' %
+                      (', '.join(unknown), ', '.join(BENCHMARKS)))
+        sys.exit(2)
+    names = names or list(BENCHMARKS)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='bench')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    context = Context(workdir, options)
+    context.prepare()
+
+    results = collections.OrderedDict()
+    for name in names:
+        logging.info('Running %s' % name)
+        results[name] = run_benchmark(name, context, options.repeat)
+
+    config = dict((x, getattr(options, x)) for x in CONFIG_KEYS)
+    output = dict(config=config, results=results, python=sys.version.split()[0],
+                  time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+
+    baseline = None
+    if os.path.exists(options.baseline) and not options.save:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            logging.warning('Baseline %s was run with %s' %
+                            (options.baseline, json.dumps(baseline.get('config'))))
+
+    report(results, baseline)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if options.save:
+        with open(options.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+        logging.info('Saved baseline %s' % options.baseline)
+    if not options.workdir:
+        shutil.rmtree(workdir)
+
+    failed = [x for x in results if 'error' in results[x]]
+    regressions = compare(results, baseline, options.tolerance) if baseline else []
+    for message in regressions:
+        logging.error('Regression %s' % message)
+    if failed or regressions:
+        sys.exit(1)
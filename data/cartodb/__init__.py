@@ -1,2 +1,4 @@
 
 from cartodb import *
+from executor import SQLExecutor, SQLFuture
+from retry import RetryPolicy, CircuitBreaker, CircuitOpenError, IdempotencyLedger, FileLedger
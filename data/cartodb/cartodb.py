@@ -12,6 +12,14 @@
      pip install oauth2
      pip install simplejson # if you're running python < 2.6
 
+  * Concurrency:
+
+    A CartoDB instance is safe to share between threads. The OAuth access
+    token is fetched once, and each request borrows an oauth.Client (and its
+    keep-alive httplib2 connections) from a pool of at most pool_size
+    clients, so up to pool_size requests run at the same time. An
+    SQLExecutor resizes the pool to its own limit if the pool is smaller.
+
   * Example use:
         user =  'your@mail.com'
         password =  'XXXX'
@@ -20,6 +28,8 @@
         cartodb_domain = 'vitorino'
         cl = CartoDB(CONSUMER_KEY, CONSUMER_SECRET, user, password, cartodb_domain)
         print cl.sql('select * from a')
+        for row in cl.iter_sql('select cartodb_id, name from a', page_size=1000):
+            print row
 
 """
 
@@ -28,6 +38,10 @@ import oauth2 as oauth
 import urllib
 import httplib2
 import sys
+import threading
+import time
+
+from Queue import Queue, Empty
 
 try:
     import json
@@ -37,10 +51,19 @@ except ImportError:
 from oauth2 import Request
 
 #REQUEST_TOKEN_URL = 'https://%(user)s.%(domain)s/oauth/request_token'
-ACCESS_TOKEN_URL = '%(protocol)s://%(user)s.%(domain)s/oauth/access_token'
+ACCESS_TOKEN_URL = '%(protocol)s://%(server)s/oauth/access_token'
 #AUTHORIZATION_URL = 'https://%(user)s.%(domain)s/oauth/authorize'
-RESOURCE_URL = '%(protocol)s://%(user)s.%(domain)s/api/v1/sql'
+RESOURCE_URL = '%(protocol)s://%(server)s/api/v1/sql'
+
 
+def sql_literal(value):
+    """ returns a value as an escaped unicode sql string literal """
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    value = value.replace(u"'", u"''")
+    if u'\\' in value:
+        return u"E'%s'" % value.replace(u'\\', u'\\\\')
+    return u"'%s'" % value
 
 class CartoDBException(Exception):
     def __init__(self, msg, http_code):
@@ -53,8 +76,12 @@ class CartoDBException(Exception):
 class CartoDB(object):
     """ basic client to access cartodb api """
     MAX_GET_QUERY_LEN = 2048
+    POOL_SIZE = 10
 
-    def __init__(self, key, secret, email, password, cartodb_domain, host='cartodb.com', protocol='https', proxy_info=None):
+    def __init__(self, key, secret, email, password, cartodb_domain, host='cartodb.com', protocol='https', proxy_info=None, pool_size=POOL_SIZE, timeout=None, observer=None):
+        """ observer: an optional function called with the seconds taken and the
+            http status (None if there was no response) of each sql request
+        """
 
         self.consumer_key = key
         self.consumer_secret = secret
@@ -68,39 +95,85 @@ class CartoDB(object):
         params["x_auth_password"] = password
         params["x_auth_mode"] = 'client_auth'
 
+        # the server is <cartodb_domain>.<host>, or just host without a domain,
+        # e.g., host='localhost:8080' for a local stand-in of the sql api
+        server = '%s.%s' % (cartodb_domain, host) if cartodb_domain else host
+
         # Get Access Token
-        access_token_url = ACCESS_TOKEN_URL % {'user': cartodb_domain, 'domain': host, 'protocol': protocol}
+        access_token_url = ACCESS_TOKEN_URL % {'server': server, 'protocol': protocol}
         resp, token = client.request(access_token_url, method="POST", body=urllib.urlencode(params))
         access_token = dict(urlparse.parse_qsl(token))
         token = oauth.Token(access_token['oauth_token'], access_token['oauth_token_secret'])
 
-        # prepare client
-        self.resource_url = RESOURCE_URL % {'user': cartodb_domain, 'domain': host, 'protocol': protocol}
-        self.client = oauth.Client(consumer, token)
-
+        # prepare client pool, reusing the access token for every client
+        self.resource_url = RESOURCE_URL % {'server': server, 'protocol': protocol}
+        self.consumer = consumer
+        self.token = token
+        self.proxy_info = proxy_info
+        self.timeout = timeout
+        self.observer = observer
+        self.pool_size = pool_size
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.idle = Queue()
+        self.client = self.new_client()
+        self.idle.put(self.client)
+
+    def new_client(self):
+        """ returns a new authorized client with its own connections """
+        return oauth.Client(self.consumer, self.token, timeout=self.timeout, proxy_info=self.proxy_info)
 
     def req(self, url, http_method="GET", http_headers=None, body=''):
-        """ make an autorized request """
-        resp, content = self.client.request(
-            url,
-            body=body,
-            method=http_method,
-            headers=http_headers
-        )
+        """ make an autorized request with a pooled client """
+        # the pool may be resized meanwhile, so the same slots are released
+        slots = self.slots
+        slots.acquire()
+        try:
+            try:
+                client = self.idle.get_nowait()
+            except Empty:
+                client = self.new_client()
+            # a client that fails is dropped since its connection may be broken
+            resp, content = client.request(
+                url,
+                body=body,
+                method=http_method,
+                headers=http_headers
+            )
+            self.idle.put(client)
+        finally:
+            slots.release()
         return resp, content
 
+    def resize_pool(self, pool_size):
+        """ sets the maximum number of requests that run at the same time
+
+            requests already running are not counted by the new limit
+        """
+        self.pool_size = pool_size
+        self.slots = threading.BoundedSemaphore(pool_size)
+
     def sql(self, sql, parse_json=True, do_post=True):
         """ executes sql in cartodb server
             set parse_json to False if you want raw reponse
         """
+        if isinstance(sql, unicode):
+            sql = sql.encode('utf-8')
         p = urllib.urlencode({'q': sql})
         url = self.resource_url
         # depending on query size do a POST or GET
-        if len(sql) < self.MAX_GET_QUERY_LEN and not do_post:
-            url = url + '?' + p
-            resp, content = self.req(url);
-        else:
-            resp, content = self.req(url, 'POST', body=p);
+        began = time.time()
+        try:
+            if len(sql) < self.MAX_GET_QUERY_LEN and not do_post:
+                url = url + '?' + p
+                resp, content = self.req(url);
+            else:
+                resp, content = self.req(url, 'POST', body=p);
+        except Exception:
+            if self.observer:
+                self.observer(time.time() - began, None)
+            raise
+        if self.observer:
+            self.observer(time.time() - began, resp['status'])
 
         if resp['status'] == '200':
             if parse_json:
@@ -111,7 +184,27 @@ class CartoDB(object):
         elif resp['status'] == '500':
             raise CartoDBException('internal server error', resp['status'])
         else:
-            raise CartoDBException('Unknown error: response=%s content=%s' % (resp, content))
-
+            raise CartoDBException('Unknown error: response=%s content=%s' % (resp, content), resp['status'])
 
+    def iter_sql(self, sql, page_size=10000, key='cartodb_id', after=None, retry=None):
+        """ yields the rows of a select statement one page at a time
 
+            pages are read with keyset pagination on key, which the statement
+            must return, so only page_size rows are held in memory at once
+            and each page is found with an index lookup instead of an OFFSET.
+            set after to start with the rows whose key is greater than it.
+            set retry to a RetryPolicy to retry each page on transient errors.
+        """
+        sql = sql.strip().rstrip(';')
+        while True:
+            where = ''
+            if after is not None:
+                where = ' WHERE %s > %s' % (key, after if isinstance(after, (int, long, float)) else sql_literal(after))
+            page_sql = 'SELECT * FROM (%s) AS page%s ORDER BY %s LIMIT %d' % (sql, where, key, page_size)
+            page = retry.call(self.sql, (page_sql,)) if retry else self.sql(page_sql)
+            rows = page['rows']
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            after = rows[-1][key]
@@ -0,0 +1,217 @@
+# -*- encoding: utf-8 -*-
+
+"""
+  ** SQLExecutor **
+
+    Runs many CartoDB SQL API requests concurrently with a shared CartoDB
+    client.
+
+    Requests are submitted as SQL strings and return a SQLFuture. Up to
+    max_in_flight worker threads send requests, limited per host by a
+    semaphore (max_in_flight by default), and by an adaptive limit that backs
+    off (halves) when responses are slow or the server returns 5xx errors,
+    and grows again (additively) while responses are fast.
+
+    Failed requests are retried according to a RetryPolicy. Each attempt is
+    counted by the adaptive limit separately, so backoff sleeps do not hold
+    a slot or count as latency.
+
+    There is no asyncio in python 2, so requests are run by threads; each one
+    mostly waits on the network.
+
+  * Example use:
+        ex = SQLExecutor(cl, max_in_flight=200)
+        futures = ex.map(['select 1', 'select 2'])
+        print [f.result() for f in futures]
+        ex.shutdown()
+
+"""
+
+import logging
+import threading
+import time
+import urlparse
+
+from Queue import Queue
+
+from cartodb import CartoDBException
+from retry import RetryPolicy
+
+
+class SQLFuture(object):
+    """ the pending result of a submitted sql request """
+
+    def __init__(self, sql, key=None, idempotent=True):
+        self.sql = sql
+        self.key = key
+        self.idempotent = idempotent
+        self.elapsed = None # seconds spent running, including retries
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """ waits for the request and returns its exception, if any """
+        if not self._done.wait(timeout):
+            raise RuntimeError('timed out waiting for %s' % self.sql[:100])
+        return self._exception
+
+    def result(self, timeout=None):
+        """ waits for the request and returns its result or raises its exception """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class AdaptiveLimit(object):
+    """ a concurrency limit adjusted by response latency and server errors
+
+        The limit grows by one each time limit requests succeed within
+        target_latency seconds, and is halved (at most once per
+        target_latency seconds) when a request is slower or fails with a
+        5xx error.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, target_latency=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.target_latency = target_latency
+        self.active = 0
+        self.decreased = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, overloaded):
+        with self.cond:
+            self.active -= 1
+            now = time.time()
+            if overloaded or latency > self.target_latency:
+                if now - self.decreased > self.target_latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.decreased = now
+                    logging.info('SQL concurrency limit decreased to %d' % self.limit)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class SQLExecutor(object):
+    """ runs sql requests against a CartoDB client with bounded concurrency """
+
+    def __init__(self, cdb, max_in_flight=100, host_limits=None, initial=None, target_latency=2.0, retry=None):
+        """
+            cdb: the CartoDB client, whose pool is resized to the host limit
+                if it is smaller
+            max_in_flight: the maximum number of concurrent requests
+            host_limits: optional dict of host to maximum concurrent
+                requests, by default max_in_flight
+            initial: the initial adaptive limit, by default max_in_flight
+            target_latency: seconds above which a response counts as slow
+            retry: an optional RetryPolicy
+        """
+        self.cdb = cdb
+        self.retry = retry or RetryPolicy()
+        self.host = urlparse.urlparse(cdb.resource_url).netloc
+        host_limit = (host_limits or {}).get(self.host, max_in_flight)
+        self.host_slots = threading.BoundedSemaphore(host_limit)
+        # the client would otherwise queue requests the host limit lets through
+        if getattr(cdb, 'pool_size', host_limit) < host_limit:
+            cdb.resize_pool(host_limit)
+        self.limit = AdaptiveLimit(initial or max_in_flight, maximum=max_in_flight, target_latency=target_latency)
+        self.queue = Queue()
+        self.workers = []
+        for i in range(max_in_flight):
+            worker = threading.Thread(target=self._loop)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _loop(self):
+        while True:
+            future = self.queue.get()
+            if future is None:
+                self.queue.task_done()
+                break
+            self._run(future)
+            self.queue.task_done()
+
+    def _run(self, future):
+        start = time.time()
+        try:
+            result = self.retry.call(self._attempt, (future.sql,), future.key,
+                                     future.idempotent)
+        except Exception as e:
+            future.elapsed = time.time() - start
+            future.set_exception(e)
+        else:
+            future.elapsed = time.time() - start
+            future.set_result(result)
+
+    def _attempt(self, sql):
+        self.limit.acquire()
+        self.host_slots.acquire()
+        start = time.time()
+        overloaded = False
+        try:
+            return self.execute(sql)
+        except CartoDBException as e:
+            overloaded = str(e.http_code).startswith('5')
+            raise
+        except Exception:
+            overloaded = True
+            raise
+        finally:
+            self.host_slots.release()
+            self.limit.release(time.time() - start, overloaded)
+
+    def execute(self, sql):
+        """ sends one request, called by worker threads """
+        return self.cdb.sql(sql)
+
+    def submit(self, sql, key=None, idempotent=True):
+        """ queues a sql request and returns its SQLFuture
+
+            key: an optional idempotency key, see RetryPolicy.call
+            idempotent: False if the request must not be retried after
+                ambiguous errors, see RetryPolicy.call
+        """
+        future = SQLFuture(sql, key, idempotent)
+        self.queue.put(future)
+        return future
+
+    def map(self, queries):
+        """ queues sql requests and returns their SQLFutures in order """
+        return [self.submit(sql) for sql in queries]
+
+    def shutdown(self, wait=True):
+        """ stops the workers after all queued requests have run """
+        for worker in self.workers:
+            self.queue.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+def wait(futures):
+    """ waits for all futures and returns them """
+    for future in futures:
+        future.exception()
+    return futures
@@ -0,0 +1,234 @@
+# -*- encoding: utf-8 -*-
+
+"""
+  ** RetryPolicy **
+
+    Retries CartoDB calls that fail with transient errors.
+
+    Errors are classified per class: 5xx responses, timeouts, SSL errors and
+    dropped connections are retried with jittered exponential backoff, while
+    4xx responses (e.g., a 400 for bad SQL) fail immediately. A shared
+    CircuitBreaker stops all calls for a while after repeated failures, and an
+    IdempotencyLedger records completed calls by key so a batch that already
+    succeeded is never sent again.
+
+  * Example use:
+        policy = RetryPolicy(attempts=5)
+        policy.call(cl.sql, ('insert into taxon ...',), key='taxon-batch-1')
+
+"""
+
+import hashlib
+import httplib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+from ssl import SSLError
+
+from cartodb import CartoDBException
+
+try:
+    from httplib2 import HttpLib2Error
+except ImportError:
+    HttpLib2Error = IOError
+
+# Errors that may happen after a request reached the server, so the request
+# may or may not have been applied:
+AMBIGUOUS_ERRORS = (socket.timeout, SSLError, httplib.BadStatusLine)
+
+# Errors that are retried in addition to 5xx responses:
+TRANSIENT_ERRORS = (socket.error, httplib.HTTPException, HttpLib2Error) + AMBIGUOUS_ERRORS
+
+
+class CircuitOpenError(Exception):
+    """ raised instead of calling while a circuit breaker is open """
+    pass
+
+
+class CircuitBreaker(object):
+    """ stops calls after repeated transient failures
+
+        After failure_threshold consecutive failures the circuit opens and
+        every call fails with CircuitOpenError for reset_timeout seconds.
+        Then a single trial call is let through: the circuit closes if it
+        succeeds and opens again if it fails. A trial that ends otherwise,
+        e.g. with a bad response, is released so another can be let through.
+
+        >>> breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        >>> policy = RetryPolicy(attempts=1, breaker=breaker)
+        >>> def timeout():
+        ...     raise socket.timeout('timed out')
+        >>> def bad_json():
+        ...     raise ValueError('No JSON object could be decoded')
+        >>> breaker.failure()
+        >>> policy.call(timeout, idempotent=False)
+        Traceback (most recent call last):
+        ...
+        timeout: timed out
+        >>> policy.call(bad_json)
+        Traceback (most recent call last):
+        ...
+        ValueError: No JSON object could be decoded
+        >>> policy.call(lambda: 'ok')
+        'ok'
+        >>> breaker.opened is None
+        True
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.trial or time.time() - self.opened < self.reset_timeout:
+                raise CircuitOpenError('circuit open after %d failures' % self.failures)
+            self.trial = True
+
+    def release(self):
+        """ ends a trial call without closing or opening the circuit """
+        with self.lock:
+            self.trial = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened is None or self.trial:
+                    logging.warning('Circuit opened after %d failures' % self.failures)
+                self.opened = time.time()
+                self.trial = False
+
+
+class IdempotencyLedger(object):
+    """ a thread-safe record of the keys of calls that completed """
+
+    def __init__(self):
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def done(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def record(self, key):
+        with self.lock:
+            self.keys.add(key)
+
+
+class FileLedger(IdempotencyLedger):
+    """ an IdempotencyLedger persisted to a file, one key per line
+
+        keys are appended and flushed to disk as soon as they are recorded,
+        so calls completed before a crash are skipped when rerun.
+    """
+
+    def __init__(self, path):
+        IdempotencyLedger.__init__(self)
+        try:
+            with open(path, 'r') as f:
+                self.keys.update(line.strip() for line in f if line.strip())
+        except IOError:
+            pass
+        self.f = open(path, 'a')
+
+    def record(self, key):
+        with self.lock:
+            self.keys.add(key)
+            self.f.write('%s\n' % key)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+
+def sql_key(sql):
+    """ returns an idempotency key for a sql statement """
+    return hashlib.sha1(sql.encode('utf-8') if isinstance(sql, unicode) else sql).hexdigest()
+
+
+class RetryPolicy(object):
+    """ calls functions with retries, backoff, a circuit breaker and a ledger """
+
+    def __init__(self, attempts=10, base=1.0, cap=30.0, breaker=None, ledger=None, sleep=time.sleep, observer=None):
+        """
+            attempts: the maximum number of calls
+            base: the backoff in seconds before jitter after the first failure
+            cap: the maximum backoff in seconds
+            breaker: an optional shared CircuitBreaker
+            ledger: an optional shared IdempotencyLedger
+            observer: an optional function called with the attempt number and
+                the error before each retry
+        """
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker or CircuitBreaker()
+        self.ledger = ledger or IdempotencyLedger()
+        self.sleep = sleep
+        self.observer = observer
+
+    def is_retryable(self, error, idempotent=True):
+        """ returns True if a call that raised error should be retried """
+        if isinstance(error, CartoDBException):
+            return str(error.http_code).startswith('5')
+        if not idempotent and isinstance(error, AMBIGUOUS_ERRORS):
+            return False
+        return isinstance(error, TRANSIENT_ERRORS)
+
+    def backoff(self, attempt):
+        """ returns the full jitter backoff in seconds after a failed attempt """
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def call(self, fn, args=(), key=None, idempotent=True):
+        """ calls fn(*args) until it succeeds or fails with a permanent error
+
+            key: an optional idempotency key. If a call with the same key
+                already completed it is skipped and None is returned.
+            idempotent: False if fn must not be retried after errors that
+                leave it unknown whether it was applied, such as timeouts.
+        """
+        if key is not None and self.ledger.done(key):
+            logging.info('Skipping completed call %s' % key)
+            return None
+        for attempt in range(self.attempts):
+            self.breaker.before()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                retryable = self.is_retryable(e, idempotent)
+                if retryable or isinstance(e, TRANSIENT_ERRORS):
+                    self.breaker.failure()
+                elif isinstance(e, CartoDBException):
+                    # 4xx responses mean the server is up, so they don't open the circuit
+                    self.breaker.success()
+                else:
+                    # Other errors say nothing of the server, but must end a trial:
+                    self.breaker.release()
+                if not retryable or attempt == self.attempts - 1:
+                    raise
+                backoff = self.backoff(attempt)
+                logging.info('Retry %s of %s with backoff %.2fs - %s' %
+                             (attempt + 1, self.attempts - 1, backoff, e))
+                if self.observer:
+                    self.observer(attempt + 1, e)
+                self.sleep(backoff)
+            else:
+                self.breaker.success()
+                if key is not None:
+                    self.ledger.record(key)
+                return result
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports reading and writing compact columnar files.
+
+A columnar file stores rows in row groups. Within a row group every column is
+dictionary encoded: the distinct values of the column are stored once and each
+row holds an index into them. Dictionaries and indexes are zlib compressed
+separately, so repeated values such as kingdom or country take almost no space
+and a reader can load only the columns (or just the distinct values) it needs.
+
+Layout:
+    MAGIC
+    row groups: for each column, a dictionary block and an index block
+    footer: JSON with the column names and the offset and length of each block
+    footer length as an 8 byte little-endian integer
+    MAGIC
+
+Values are stored as UTF-8 strings.
+"""
+
+import array
+import json
+import marshal
+import struct
+import sys
+import zlib
+
+from itertools import izip, repeat
+from records import Constant
+
+MAGIC = 'DWCC1\n'
+
+# The default number of rows in a row group:
+ROW_GROUP_SIZE = 65536
+
+# Array typecodes used for indexes, by the largest dictionary they can address:
+INDEX_TYPES = [(1 << 8, 'B'), (1 << 16, 'H'), (1 << 32, 'I')]
+
+def _encode(value):
+    """Returns a value as a UTF-8 string, or '' if the value is None."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif value is None:
+        return ''
+    return str(value)
+
+class ColumnarWriter:
+    """
+    A writer which will write rows (sequences of values) to the columnar file
+    "f" with the given fieldnames as its schema.
+
+    Values are dictionary encoded as they are written, and the row group is
+    held in memory until it is complete, so close() must be called to write
+    the last row group and the footer.
+    """
+
+    def __init__(self, f, fieldnames, row_group_size=ROW_GROUP_SIZE, level=6):
+        self.stream = f
+        self.fieldnames = list(fieldnames)
+        self.row_group_size = row_group_size
+        self.level = level
+        self.row_groups = []
+        self.stream.write(MAGIC)
+        self.offset = len(MAGIC)
+        self._reset()
+
+    def _reset(self):
+        """Starts a new row group."""
+        width = len(self.fieldnames)
+        self.size = 0
+        # Each column is dictionary encoded in order of first appearance:
+        self.positions = [{} for i in range(width)]
+        self.dictionaries = [[] for i in range(width)]
+        self.indexes = [[] for i in range(width)]
+
+    def _position(self, i, value):
+        """Returns the position of a value in the dictionary of column i."""
+        value = _encode(value)
+        positions = self.positions[i]
+        position = positions.get(value)
+        if position is None:
+            position = positions[value] = len(self.dictionaries[i])
+            self.dictionaries[i].append(value)
+        return position
+
+    def writerow(self, row):
+        width = len(self.fieldnames)
+        if len(row) != width:
+            row = (list(row) + [''] * width)[:width]
+        for i, value in enumerate(row):
+            self.indexes[i].append(self._position(i, value))
+        self.size += 1
+        if self.size >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self, batch):
+        """Writes the rows of a records.RecordBatch.
+
+        Values are encoded a column at a time, once per distinct value of the
+        column, and constant columns once.
+        """
+        width = len(self.fieldnames)
+        columns = (list(batch.columns) + [Constant('')] * width)[:width]
+        start = 0
+        while start < len(batch):
+            # The rows that fit in the current row group:
+            n = min(len(batch) - start, self.row_group_size - self.size)
+            for i, column in enumerate(columns):
+                if isinstance(column, Constant):
+                    self.indexes[i].extend(repeat(self._position(i, column.value), n))
+                    continue
+                values = column[start:start + n] if n < len(batch) else column
+                positions = {}
+                for value in values:
+                    if value not in positions:
+                        positions[value] = self._position(i, value)
+                self.indexes[i].extend(map(positions.__getitem__, values))
+            self.size += n
+            start += n
+            if self.size >= self.row_group_size:
+                self.flush()
+
+    def _write_block(self, data):
+        data = zlib.compress(data, self.level)
+        block = [self.offset, len(data)]
+        self.stream.write(data)
+        self.offset += len(data)
+        return block
+
+    def flush(self):
+        """Writes the rows written so far as a row group."""
+        if not self.size:
+            return
+        columns = []
+        for dictionary, indexes in izip(self.dictionaries, self.indexes):
+            typecode = [t for size, t in INDEX_TYPES if len(dictionary) <= size][0]
+            columns.append(self._write_block(marshal.dumps(dictionary)) +
+                           self._write_block(array.array(typecode, indexes).tostring()) +
+                           [typecode])
+        self.row_groups.append(dict(rows=self.size, columns=columns))
+        self._reset()
+
+    def close(self):
+        """Writes the last row group and the footer."""
+        self.flush()
+        footer = json.dumps(dict(fieldnames=self.fieldnames,
+                                 row_groups=self.row_groups,
+                                 byteorder=sys.byteorder))
+        self.stream.write(footer)
+        self.stream.write(struct.pack('<Q', len(footer)))
+        self.stream.write(MAGIC)
+
+class ColumnarReader:
+    """
+    A reader for a columnar file written by ColumnarWriter.
+
+    Attributes:
+        fieldnames: The list of column names.
+        rows: The integer number of rows.
+    """
+
+    def __init__(self, f):
+        self.stream = f
+        tail = len(MAGIC) + 8
+        f.seek(-tail, 2)
+        end = f.tell()
+        size = struct.unpack('<Q', f.read(8))[0]
+        if f.read() != MAGIC:
+            raise ValueError('Not a columnar file')
+        f.seek(end - size)
+        footer = json.loads(f.read(size))
+        self.fieldnames = [str(x) for x in footer['fieldnames']]
+        self.row_groups = footer['row_groups']
+        self.swap = footer['byteorder'] != sys.byteorder
+        self.rows = sum(x['rows'] for x in self.row_groups)
+
+    def _read_block(self, offset, length):
+        self.stream.seek(offset)
+        return zlib.decompress(self.stream.read(length))
+
+    def _position(self, name):
+        try:
+            return self.fieldnames.index(name)
+        except ValueError:
+            raise KeyError('No column named %s' % name)
+
+    def dictionaries(self, name, decode=True):
+        """Yields the list of distinct values of a column in each row group.
+
+        Only the dictionary blocks are read, so this is much faster than reading
+        the values of every row.
+        """
+        position = self._position(name)
+        for group in self.row_groups:
+            offset, length = group['columns'][position][:2]
+            dictionary = marshal.loads(self._read_block(offset, length))
+            if decode:
+                dictionary = [x.decode('utf-8') for x in dictionary]
+            yield dictionary
+
+    def columns(self, names=None, decode=True):
+        """Yields a list of value lists, one per requested column, per row group.
+
+        Args:
+            names: An optional list of column names, all columns by default.
+            decode: True if values should be returned as unicode.
+        """
+        positions = [self._position(x) for x in names or self.fieldnames]
+        for group in self.row_groups:
+            columns = []
+            for position in positions:
+                d_offset, d_length, i_offset, i_length, typecode = group['columns'][position]
+                dictionary = marshal.loads(self._read_block(d_offset, d_length))
+                if decode:
+                    dictionary = [x.decode('utf-8') for x in dictionary]
+                indexes = array.array(str(typecode))
+                indexes.fromstring(self._read_block(i_offset, i_length))
+                if self.swap:
+                    indexes.byteswap()
+                columns.append([dictionary[i] for i in indexes])
+            yield columns
+
+    def iter_rows(self, decode=True):
+        """Yields all rows as tuples of values.
+
+        Args:
+            decode: True if values should be returned as unicode.
+        """
+        for columns in self.columns(decode=decode):
+            for row in izip(*columns):
+                yield row
+
+    def __iter__(self):
+        """Iterates over all rows as tuples of unicode values."""
+        return self.iter_rows()
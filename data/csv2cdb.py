@@ -18,94 +18,467 @@ __author__ = "Aaron Steele"
 
 """This module supports uploading a CSV file to CartoDB over the SQL API.
 
-1) download taxon table into memory: {name:cartodb_id}
+1) sync the local taxon cache with the taxon table: {name:cartodb_id}
 2) for all names in CSV not in taxon table, bulk insert to taxon table
+3) for a delta CSV from dca2csv.py --delta, bulk delete the occurrences of its
+   updated and deleted records
+4) bulk insert CSV rows into the occurrence table with their taxon ids
+
+Completed batches and the taxon names scanned from the CSV are recorded in a
+checkpoint journal, so a rerun after a failure skips the scan and resumes the
+occurrence inserts from the end of the last run of completed batches.
 
 """
 
-from cartodb import CartoDB, CartoDBException
+from cartodb import CartoDB, RetryPolicy, SQLExecutor, sql_literal
+from cartodb.retry import sql_key
 
 import collections
+import columnar
 import csv_unicode as csvu
 import csv
-import json
 import logging
+import metrics
+import multiprocessing
 import os
+import schema
 import sys
-import time
-import threading
-import zipfile
-
-from Queue import Queue
+import urllib
+import validation
+
+from itertools import count, islice, izip
+from journal import Journal, batch_key
+from operator import itemgetter
+from records import BATCH_SIZE, Constant, RecordBatch
+from delta import SCOPE_COLUMNS
+from dwcterms import col_types
+from taxoncache import TaxonCache
 from optparse import OptionParser
-from ssl import SSLError
-from httplib import BadStatusLine
 
 
 TAXON_CONCEPTS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 
                   'species', 'scientificname']
 
-global TAXON_TABLE 
-TAXON_TABLE = {}
+# Inserts a batch of names in a single statement, skipping existing names, so a 
+# batch can safely be sent again:
+TAXON_INSERT = ("INSERT INTO taxon (name) "
+                "SELECT DISTINCT n FROM unnest(ARRAY[%(names)s]::text[]) AS n "
+                "WHERE NOT EXISTS (SELECT 1 FROM taxon WHERE taxon.name = n)")
+
+# Inserts a batch of occurrence rows:
+OCCURRENCE_INSERT = "INSERT INTO occurrence (%(columns)s) VALUES %(rows)s"
+
+# Deletes a batch of occurrences by id, scoped by their institution and collection:
+OCCURRENCE_DELETE = "DELETE FROM occurrence WHERE %(scope)s AND id IN (%(ids)s)"
+
+# The maximum size in bytes of an urlencoded SQL API request body:
+MAX_BODY_SIZE = 512 * 1024
+
+# The maximum number of rows, and of bytes of CSV rows, of an occurrence batch.
+# Its urlencoded SQL is usually about twice the size of its CSV rows:
+OCCURRENCE_BATCH_ROWS = 1000
+OCCURRENCE_BATCH_BYTES = MAX_BODY_SIZE / 3
+
+# The maximum number of batches submitted but not yet completed:
+MAX_PENDING = 200
+
+# Column types whose validated values are valid SQL literals:
+NUMERIC_TYPES = ('int4', 'numeric', 'float8')
+
+def encoded_size(value):
+    """Returns the size in bytes of a unicode value once urlencoded."""
+    return len(urllib.quote_plus(value.encode('utf-8')))
 
 class Query(object):
 
-    def __init__(self, queue, cdb, query):
-        self.queue = queue
-        self.cdb = cdb
+    # The name of the metrics of the query's batches:
+    stage = 'sql'
+
+    def __init__(self, query):
         self.query = query
 
-    def execute(self, params):
-        retry_count = 10
-        backoff = 1
-        errors = []
-        response = None
-        query = self.prepare_query(params)
+    def key(self, query, params):
+        """Returns the idempotency key of the query for params."""
+        return sql_key(query)
 
-        while retry_count > 0:
-            try:
-                response = self.cdb.sql(query)
-            except CartoDBException as e:
-                self.handle(query, params, None, e)
-            except Exception as e:
-                logging.info("Retry %s with backoff %s for %s - %s" % (retry_count, backoff, params, e))
-                errors.append(e)
-                time.sleep(backoff)
-                if backoff < 8:
-                    backoff *= 2
-                retry_count -= 1
-        
-        self.handle(query, params, response, errors)
-
-    def loop(self):
-        while True:
-            r = self.queue.get()
-            if r == None:
-                self.queue.task_done()
-                break
-            else:
-                (params) = r
-            self.execute(params)
-            self.queue.task_done()
+    def submit(self, executor, params):
+        """Submits the query for params to an SQLExecutor and returns its future."""
+        query = self.prepare_query(params)
+        return executor.submit(query, self.key(query, params))
+
+    def run(self, executor, batches, max_pending=MAX_PENDING):
+        """Submits params for each batch and handles their results in order.
+
+        At most max_pending batches are held in memory at once.
+        """
+        pending = collections.deque()
+        for params in batches:
+            pending.append((params, self.submit(executor, params)))
+            if len(pending) >= max_pending:
+                self.finish(*pending.popleft())
+        while pending:
+            self.finish(*pending.popleft())
+
+    def finish(self, params, future):
+        """Waits for a submitted query and handles its result."""
+        error = future.exception()
+        response = None if error else future.result()
+        if future.elapsed is not None:
+            metrics.observe('%s.batch_seconds' % self.stage, future.elapsed)
+        metrics.count('%s.%s' % (self.stage, 'failed_batches' if error else 'batches'))
+        self.handle(future.sql, params, response, error)
+
+    def batches(self, items, max_items=10000, max_size=MAX_BODY_SIZE):
+        """Yields lists of items whose prepared query fits in max_size bytes."""
+        overhead = self.base_size() + len('q=')
+        batch = []
+        size = overhead
+        for item in items:
+            item_size = self.item_size(item) + len('%2C')
+            if batch and (size + item_size > max_size or len(batch) >= max_items):
+                yield batch
+                batch = []
+                size = overhead
+            batch.append(item)
+            size += item_size
+        if batch:
+            yield batch
 
 class TaxonQuery(Query):
+
+    stage = 'taxon'
     
     def prepare_query(self, params):
-        query = ''
-        for name in params['names']:
-            query += self.query % dict(name=name) + ';'
-        return query
-        
-    def handle(self, query, params, response, errors):
-        logging.info('%s %s' % (response, errors))
+        names = u','.join(sql_literal(name) for name in params['names'])
+        return self.query % dict(names=names)
+
+    def base_size(self):
+        return encoded_size(self.query % dict(names=u''))
+
+    def item_size(self, name):
+        return encoded_size(sql_literal(name))
         
+    def handle(self, query, params, response, error):
+        if error:
+            logging.error('Failed to insert %s names: %s' % (len(params['names']), error))
+        else:
+            logging.info('Inserted %s names' % len(params['names']))
+
+class DeleteQuery(Query):
+    """Deletes batches of occurrences by id within one scope.
+
+    Ids are only unique within an archive, so only rows with the institution
+    and collection codes of the scope are deleted. Deleting an id twice is
+    harmless. The occurrences of a delta are only inserted once every delete
+    batch has completed, so a failed batch is retried by a rerun before the
+    new rows of its ids exist.
+    """
+
+    stage = 'delete'
+
+    def __init__(self, query, scope):
+        """Constructs a new DeleteQuery.
+
+        Args:
+            scope: The tuple of UTF-8 SCOPE_COLUMNS values of the rows to
+                delete, an empty value matching null.
+        """
+        Query.__init__(self, query)
+        self.scope = scope
+        self.scope_sql = u' AND '.join(
+            u'"%s" = %s' % (name, sql_literal(value)) if value else u'"%s" IS NULL' % name
+            for name, value in zip(SCOPE_COLUMNS, scope))
+
+    def prepare_query(self, params):
+        ids = u','.join(sql_literal(x) for x in params['ids'])
+        return self.query % dict(scope=self.scope_sql, ids=ids)
+
+    def base_size(self):
+        return encoded_size(self.query % dict(scope=self.scope_sql, ids=u''))
+
+    def item_size(self, id):
+        return encoded_size(sql_literal(id))
+
+    def handle(self, query, params, response, error):
+        scope = '/'.join(self.scope)
+        if error:
+            logging.error('Failed to delete %s occurrences of %s: %s' % (
+                len(params['ids']), scope, error))
+        else:
+            logging.info('Deleted %s occurrences of %s' % (len(params['ids']), scope))
+
+def map_distinct(batch, i, function):
+    """Returns the list of function(value) of column i of a RecordBatch.
+
+    The function is called once per distinct value of the column.
+    """
+    column = batch.columns[i]
+    if isinstance(column, Constant):
+        return [function(column.value)] * len(batch)
+    results = dict((x, function(x)) for x in set(column))
+    return map(results.__getitem__, column)
+
+class OccurrenceQuery(Query):
+    """Inserts batches of CSV rows annotated with the cartodb_id of their taxons.
+
+    Each CSV column with a known type in dwcterms.col_types is inserted, empty
+    values as null and others cast to the column type. Each taxon concept column
+    also fills a taxon_<concept>_cartodb_id column.
+
+    Attributes:
+        progress: An optional metrics.Progress updated with each batch.
+        row_offsets: True if batches are keyed by row numbers, as for columnar
+            files, rather than by byte offsets.
+    """
+
+    stage = 'occurrence'
+
+    def __init__(self, query, header, taxon_ids, validated=False):
+        """Constructs a new OccurrenceQuery.
+
+        Args:
+            header: The list of CSV header fieldnames.
+            taxon_ids: A dictionary of lowercase taxon name to cartodb_id.
+            validated: True if rows are coerced by validation.Validator before
+                their values are built, in which case numbers are sent
+                without casts.
+        """
+        Query.__init__(self, query)
+        self.progress = None
+        self.row_offsets = False
+        self.header = header
+        self.taxon_ids = taxon_ids
+        self.validated = validated
+        self.concepts = taxon_columns(header)
+        header_schema = schema.Schema(header)
+        self.columns = header_schema.typed_columns()
+        untyped = [x for i, x in enumerate(header) if header_schema.columns[i] not in col_types]
+        if untyped:
+            logging.warning('Skipping columns with no known type: %s' % ', '.join(untyped))
+        names = [name for i, name, col_type in self.columns] + \
+            ['taxon_%s_cartodb_id' % taxon for taxon, i in self.concepts]
+        self.column_list = ','.join('"%s"' % x for x in names)
+
+    def value_literal(self, value, col_type):
+        """Returns the SQL literal of a UTF-8 string value of a column type."""
+        if not value:
+            return u'null'
+        elif col_type == 'text':
+            return sql_literal(value)
+        elif self.validated and col_type in NUMERIC_TYPES:
+            return unicode(value)
+        return u'%s::%s' % (sql_literal(value), col_type)
+
+    def taxon_literal(self, name):
+        """Returns the SQL literal of the cartodb_id of a UTF-8 taxon name."""
+        cartodb_id = self.taxon_ids.get(name.decode('utf-8').strip().lower())
+        return u'null' if cartodb_id is None else unicode(cartodb_id)
+
+    def batch_values(self, batch):
+        """Returns the SQL VALUES tuple of each row of a records.RecordBatch.
+
+        Literals are built a column at a time, once per distinct value.
+        """
+        columns = [map_distinct(batch, i, lambda x: self.value_literal(x, col_type))
+                   for i, name, col_type in self.columns]
+        columns += [map_distinct(batch, i, self.taxon_literal) for taxon, i in self.concepts]
+        return [u'(%s)' % u','.join(x) for x in izip(*columns)]
+
+    def row_values(self, row):
+        """Returns a CSV row of UTF-8 strings as a SQL VALUES tuple."""
+        return self.batch_values(RecordBatch.from_rows(self.header, [row]))[0]
+
+    def prepare_query(self, params):
+        return self.query % dict(columns=self.column_list, rows=u','.join(params['rows']))
+
+    def submit(self, executor, params):
+        """Submits a batch that is not retried after ambiguous errors.
+
+        An insert that timed out may still have been applied, so sending it
+        again could insert its rows twice.
+        """
+        query = self.prepare_query(params)
+        return executor.submit(query, self.key(query, params), idempotent=False)
+
+    def key(self, query, params):
+        """Returns the journal key of the range of the batch's rows."""
+        return batch_key('occurrence', params['start'], params['end'])
+
+    def ranges(self, items, start, journal=None, max_rows=OCCURRENCE_BATCH_ROWS,
+               max_bytes=OCCURRENCE_BATCH_BYTES):
+        """Yields params of batches of (values, end offset) items.
+
+        Batches are cut by their number of rows and the size of their byte
+        range, rejected rows included, and not by the size of their SQL, which
+        depends on the taxon ids resolved. So a rerun makes batches with the
+        same keys whatever was resolved or rejected before. A batch whose rows
+        were all rejected is not sent, but is recorded in the journal, so a
+        resume doesn't stop at its range and reject its rows again.
+
+        Args:
+            items: An iterable of (VALUES tuple, or None if the row was
+                rejected, offset of the row's end).
+            start: The offset of the first row.
+            journal: An optional Journal of completed batches.
+            max_rows: The integer maximum number of rows per batch.
+            max_bytes: The integer size in bytes of a batch's range once it is
+                cut, unless offsets are row numbers.
+        """
+        rows = []
+        taken = 0
+        for values, end in items:
+            taken += 1
+            if values is not None:
+                rows.append(values)
+            if taken >= max_rows or (not self.row_offsets and end - start >= max_bytes):
+                if rows:
+                    yield dict(rows=rows, start=start, end=end)
+                else:
+                    self.skip(start, end, journal)
+                rows = []
+                taken = 0
+                start = end
+        if rows:
+            yield dict(rows=rows, start=start, end=end)
+        elif taken:
+            self.skip(start, end, journal)
+
+    def skip(self, start, end, journal=None):
+        """Completes a range of rows that were all rejected without sending it."""
+        if journal:
+            journal.record(batch_key('occurrence', start, end))
+        if self.progress:
+            self.progress.update(0, 0 if self.row_offsets else end - start)
+
+    def handle(self, query, params, response, error):
+        if error:
+            logging.error('Failed to insert %s occurrences: %s' % (len(params['rows']), error))
+        else:
+            logging.info('Inserted %s occurrences' % len(params['rows']))
+            if self.progress:
+                size = 0 if self.row_offsets else params['end'] - params['start']
+                self.progress.update(len(params['rows']), size)
+
+def load_occurrences(path, query, executor, journal=None, rejects=None):
+    """Streams the rows of a CSV file into the occurrence table in batches.
+
+    Batches are keyed by the byte range of their rows and cut by
+    OccurrenceQuery.ranges, so a rerun that resumes at the end of a completed
+    batch makes the same batches and skips those already in the journal.
+
+    Args:
+        path: A string path to the CSV file.
+        query: The OccurrenceQuery for the CSV header.
+        executor: The SQLExecutor that runs batches concurrently.
+        journal: An optional Journal of completed batches to resume from.
+        rejects: An optional writer for rows that fail validation, used when
+            query.validated is True.
+    """
+    start = schema.load_schema(path).data_offset
+    with open(path, 'rb') as f:
+        lines = csvu.OffsetFile(f)
+        lines.seek(start)
+        if journal:
+            start = journal.committed_offset('occurrence', start)
+            if start > lines.offset:
+                logging.info('Resuming occurrences at byte %s' % start)
+            lines.seek(start)
+        validator = validation.Validator(query.header) if query.validated else None
+        # The offset is read once the reader has returned each row:
+        rows = ((row, lines.offset) for row in csv.reader(lines))
+        query.progress = metrics.Progress('occurrence', os.path.getsize(path) - start)
+        query.run(executor, query.ranges(iter_values(rows, query, validator, rejects), start,
+                                         journal))
+        query.progress.done()
+
+def load_columnar_occurrences(path, query, executor, journal=None, rejects=None):
+    """Streams the rows of a columnar file into the occurrence table in batches.
+
+    As for load_occurrences, but batches are keyed by the range of the numbers
+    of their rows in the file.
+    """
+    query.row_offsets = True
+    start = journal.committed_offset('occurrence', 0) if journal else 0
+    if start:
+        logging.info('Resuming occurrences at row %s' % start)
+    with open(path, 'rb') as f:
+        reader = columnar.ColumnarReader(f)
+        validator = validation.Validator(query.header) if query.validated else None
+        rows = izip(islice(reader.iter_rows(decode=False), start, None), count(start + 1))
+        query.progress = metrics.Progress('occurrence')
+        query.run(executor, query.ranges(iter_values(rows, query, validator, rejects), start,
+                                         journal))
+        query.progress.done()
+
+def iter_values(rows, query, validator=None, rejects=None, batch_size=BATCH_SIZE):
+    """Yields the (VALUES tuple, offset of the row's end) of rows.
+
+    Rows are read in batches and their values built a column at a time. Rows
+    that fail validation are yielded with None values.
+
+    Args:
+        rows: An iterable of (row of UTF-8 strings, offset of the row's end).
+        query: The OccurrenceQuery for the header of the rows.
+        validator: An optional validation.Validator for the rows.
+        rejects: An optional writer for rows that fail validation.
+        batch_size: The integer number of rows per batch.
+    """
+    items = iter(rows)
+    while True:
+        chunk = list(islice(items, batch_size))
+        if not chunk:
+            break
+        rows, ends = zip(*chunk)
+        batch = RecordBatch.from_rows(query.header, rows)
+        positions = range(len(batch))
+        if validator:
+            positions = validation.valid_positions(batch, validator, rejects)
+            if len(positions) < len(batch):
+                batch = batch.take(positions)
+        values = [None] * len(ends)
+        for n, x in izip(positions, query.batch_values(batch)):
+            values[n] = x
+        for item in izip(values, ends):
+            yield item
+
+def delete_occurrences(path, query, executor):
+    """Deletes the occurrences listed in the .deletes.csv file of a delta.
+
+    Ids are grouped by their scope, and each scope is deleted by its own
+    DeleteQuery.
+
+    Args:
+        path: A string path to the .deletes.csv file written by dca2csv.py
+            with the id and SCOPE_COLUMNS of each updated or deleted record.
+        query: The delete SQL of each DeleteQuery.
+        executor: The SQLExecutor that runs batches concurrently.
+    """
+    scopes = collections.defaultdict(list)
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        if tuple(header[2:]) != SCOPE_COLUMNS:
+            raise ValueError('%s has no %s columns, convert the delta again with '
+                             'dca2csv.py' % (path, ' and '.join(SCOPE_COLUMNS)))
+        for row in reader:
+            if row:
+                scopes[tuple(row[2:])].append(row[0].decode('utf-8'))
+    for scope, ids in sorted(scopes.items()):
+        delete_query = DeleteQuery(query, scope)
+        delete_query.run(executor, (dict(ids=batch) for batch in delete_query.batches(ids)))
+
+def failed_batches(*stages):
+    """Returns the number of batches of query stages that failed so far."""
+    counters = metrics.METRICS.snapshot()['counters']
+    return sum(counters.get('%s.failed_batches' % x, 0) for x in stages)
+
 def get_options():
     """Parses and returns command line options."""
 
     parser = OptionParser()
 
     parser.add_option("-c", "--csv_file", dest="csv_file",
-                      help="The CSV file to upload",
+                      help="The CSV (or columnar .dwcc) file to upload",
                       default=None)
     parser.add_option("-k", "--consumer_key", dest="consumer_key",
                       help="The CartoDB consumer key",
@@ -119,97 +492,234 @@ def get_options():
                       help="The CartoDB user password")
     parser.add_option("-d", "--domain", dest="domain",
                       help="The CartoDB domain")
+    parser.add_option("--host", dest="host",
+                      help="The CartoDB host, or the whole server (e.g., "
+                      "localhost:8080) when no domain is given",
+                      default="cartodb.com")
+    parser.add_option("--protocol", dest="protocol",
+                      help="The protocol of the SQL API, https or http",
+                      default="https")
+    parser.add_option("-x", "--taxon_cache", dest="taxon_cache",
+                      help="The local taxon cache file",
+                      default="taxon_cache.sqlite")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="The number of processes used to read the CSV file",
+                      default=1)
+    parser.add_option("-b", "--checkpoint", dest="checkpoint",
+                      help="The checkpoint journal file of completed batches",
+                      default=None)
+    parser.add_option("-V", "--validate", dest="validate",
+                      action="store_true", default=False,
+                      help="Coerce values to their column types and write "
+                      "invalid rows to a .rejects.csv file")
+    parser.add_option("-D", "--delta", dest="delta",
+                      action="store_true", default=False,
+                      help="The CSV file is a delta from dca2csv.py --delta: "
+                      "delete the occurrences in its .deletes.csv file first")
+    parser.add_option("-n", "--num_requests", dest="num_requests", type="int",
+                      help="The maximum number of concurrent SQL API requests",
+                      default=100)
+    parser.add_option("-M", "--metrics", dest="metrics",
+                      help="The JSON file the metrics summary is written to, "
+                      "by default <csv_file>.metrics.json",
+                      default=None)
+    parser.add_option("--profile", dest="profile",
+                      help="Profile the upload with cProfile and write the "
+                      "stats to this file",
+                      default=None)
+    parser.add_option("--sample", dest="sample", action="store_true", default=False,
+                      help="Profile with the sampling profiler instead, which "
+                      "writes a text report")
 
     (options, args) = parser.parse_args()
 
     return options
 
-def taxons_from_csv(path):
-    """Returns a multimap of taxon concept to set of names."""
+def taxon_columns(header):
+    """Returns a list of (taxon concept, column index) for a CSV header row."""
+    header_schema = schema.Schema(header)
+    return [(x, header_schema.index(x)) for x in TAXON_CONCEPTS 
+            if header_schema.index(x) is not None]
+
+def taxons_from_range(part):
+    """Returns a multimap of taxon concept to set of names for part of a CSV file.
+
+    Only the taxon concept columns are read. Values are deduplicated as raw UTF-8
+    strings, so each distinct name is only decoded and lowercased once.
+
+    Args:
+        part: A (path, start, end) tuple of byte offsets from split_ranges. The
+            header is read from the schema sidecar and skipped if start is 0.
+    """
+    path, start, end = part
+    csv_schema = schema.load_schema(path)
+    columns = taxon_columns(csv_schema.fieldnames)
     taxons = collections.defaultdict(set)
-    for row in csvu.UnicodeDictReader(open(path, 'r')):
-        row = dict((k.lower(), v) for k, v in row.iteritems()) # lowercase keys
-        for taxon in TAXON_CONCEPTS:
-            name = row.get(taxon)
-            if name:
-                taxons[taxon].add(name.strip().lower())
+    if not columns:
+        return taxons
+    f = csvu.RangeFile(path, max(start, csv_schema.data_offset), end)
+    reader = csv.reader(f)
+    concepts = [x for x, i in columns]
+    indexes = [i for x, i in columns]
+    width = max(indexes) + 1
+    project = itemgetter(*indexes)
+    seen = [set() for x in concepts]
+    for row in reader:
+        if len(row) < width:
+            row = row + [''] * width
+        values = project(row)
+        if len(concepts) == 1:
+            values = (values,)
+        for names, value in izip(seen, values):
+            names.add(value)
+    f.close()
+    for taxon, names in izip(concepts, seen):
+        names.discard('')
+        if names:
+            taxons[taxon] = set(x.decode('utf-8').strip().lower() for x in names)
     return taxons
 
-def get_taxon_table(cdb):
-    taxon_table = {}
-    response = cdb.sql("SELECT name, cartodb_id FROM taxon")
-    for row in response['rows']:
-        taxon_table[row['name'].lower()] = row['cartodb_id']
-    return taxon_table
+def taxons_from_csv(path, jobs=1):
+    """Returns a multimap of taxon concept to set of names.
+
+    Args:
+        path: A string path to the CSV file.
+        jobs: The integer number of processes that each read a byte range of the
+            file. Ranges are split on line boundaries, so quoted values must not
+            contain line breaks when jobs is more than one.
+    """
+    schema.load_schema(path) # writes the sidecar read by each part
+    parts = [(path, start, end) for start, end in csvu.split_ranges(path, jobs)]
+    if len(parts) == 1:
+        return taxons_from_range(parts[0])
+    pool = multiprocessing.Pool(len(parts))
+    try:
+        taxons = collections.defaultdict(set)
+        for part in pool.imap_unordered(taxons_from_range, parts):
+            for taxon, names in part.iteritems():
+                taxons[taxon].update(names)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return taxons
+
+def taxons_from_columnar(path):
+    """Returns a multimap of taxon concept to set of names from a columnar file.
+
+    Only the distinct values of the taxon concept columns are read.
+    """
+    taxons = collections.defaultdict(set)
+    reader = columnar.ColumnarReader(open(path, 'rb'))
+    columns = dict((x.lower(), x) for x in reader.fieldnames) # lowercase names
+    for taxon in TAXON_CONCEPTS:
+        if taxon not in columns:
+            continue
+        for names in reader.dictionaries(columns[taxon]):
+            taxons[taxon].update(x.strip().lower() for x in names if x)
+    return taxons
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)    
 
     options = get_options()
+    profiler = metrics.Profiler(options.profile, options.sample)
+    profiler.start()
     
     cdb = CartoDB(
         options.consumer_key, 
         options.consumer_secret, 
         options.user, 
         options.password, 
-        options.domain)
+        options.domain,
+        host=options.host,
+        protocol=options.protocol,
+        pool_size=options.num_requests,
+        observer=metrics.observe_request)
     
-    queue = Queue()
-    renderers = {}
-    num_threads = 40
-
-    query = "INSERT INTO taxon (name) VALUES ('%(name)s')"
-
-    for i in range(num_threads): # number of threads
-        renderer = TaxonQuery(queue, cdb, query)
-        render_thread = threading.Thread(target=renderer.loop)
-        render_thread.start()
-        renderers[i] = render_thread
-
-    taxons = taxons_from_csv(options.csv_file)
-    taxon_table = get_taxon_table(cdb)
+    # Completed batches are recorded, so they are skipped if the upload is rerun:
+    checkpoint = options.checkpoint or '%s.journal' % options.csv_file
+    journal = Journal(checkpoint, options.csv_file)
+    retry = RetryPolicy(ledger=journal, observer=metrics.observe_retry)
+    executor = SQLExecutor(cdb, max_in_flight=options.num_requests, retry=retry)
+
+    taxon_query = TaxonQuery(TAXON_INSERT)
+
+    taxons = journal.load_taxons()
+    if taxons is not None:
+        logging.info('Loaded taxon names from %s' % checkpoint)
+    else:
+        with metrics.timer('scan'):
+            if options.csv_file.endswith('.dwcc'):
+                taxons = taxons_from_columnar(options.csv_file)
+            else:
+                taxons = taxons_from_csv(options.csv_file, options.jobs)
+        journal.save_taxons(taxons)
+    # Brings the local taxon table up to date with the new rows on the server:
+    cache = TaxonCache(options.taxon_cache)
+    with metrics.timer('taxon_sync'):
+        cache.sync(cdb, retry=retry)
 
     uniques = set()
     for names in taxons.values():
         uniques.update(names)
 
-    batch_size = 500
-    names = []
-    for name in uniques:
-        if not taxon_table.has_key(name):
-            if len(names) < batch_size:
-                names.append(name)
-            else:
-                queue.put(dict(names=names))
-                names = []
-    if len(names) > 0:
-        queue.put(dict(names=names))
-    
-    for i in range(num_threads):
-        queue.put(None)
-
-    # wait for pending rendering jobs to complete
-    queue.join()
-    for i in range(num_threads):
-        renderers[i].join()
-
-    # Reload taxon table into memory:
-    taxon_table = get_taxon_table(cdb)
-
-    taxon_locations = {} # name:{column: cartodb_id}
-    for taxon, names in taxons.iteritems():
-        for name in names:
-            taxon_locations[name] = {'taxon_%s_cartodb_id' % taxon: taxon_table[name]}
-    logging.info(taxon_locations)
-
-    logging.info(TAXON_TABLE)
+    # Inserts batches of new names concurrently:
+    known = cache.lookup(uniques)
+    new_names = (name for name in uniques if not known.has_key(name))
+    with metrics.timer('taxon_insert'):
+        taxon_query.run(executor, (dict(names=names) for names in taxon_query.batches(new_names)))
+
+    # Syncs the inserted names and looks up all names, querying any misses:
+    with metrics.timer('taxon_sync'):
+        cache.sync(cdb, retry=retry)
+        taxon_table = cache.resolve(cdb, uniques, retry)
+    logging.info('Resolved %s of %s taxon names' % (len(taxon_table), len(uniques)))
+
+    # Inserts the occurrences with their taxon ids, unless some names are
+    # missing or, for a delta, the old rows of some records were not deleted:
+    columnar_file = options.csv_file.endswith('.dwcc')
+    if columnar_file:
+        with open(options.csv_file, 'rb') as f:
+            header = columnar.ColumnarReader(f).fieldnames
+    else:
+        header = schema.load_schema(options.csv_file).fieldnames
+    if options.delta and not failed_batches(TaxonQuery.stage):
+        deletes_path = '%s.deletes.csv' % os.path.splitext(options.csv_file)[0]
+        with metrics.timer('delete'):
+            delete_occurrences(deletes_path, OCCURRENCE_DELETE, executor)
+    if failed_batches(TaxonQuery.stage):
+        logging.error('Skipping occurrences, since taxon names failed to insert')
+    elif failed_batches(DeleteQuery.stage):
+        logging.error('Skipping occurrences, since old occurrences failed to delete')
+    else:
+        occurrence_query = OccurrenceQuery(OCCURRENCE_INSERT, header, taxon_table,
+                                           options.validate)
+        rejects = None
+        if options.validate:
+            # Appends, since a resumed upload only rereads the rest of the file:
+            rejects_path = '%s.rejects.csv' % os.path.splitext(options.csv_file)[0]
+            exists = os.path.exists(rejects_path)
+            rejects_out = open(rejects_path, 'ab')
+            rejects = csvu.UnicodeWriter(rejects_out, quoting=csv.QUOTE_ALL)
+            if not exists:
+                rejects.writerow(header + ['error'])
+        load = load_columnar_occurrences if columnar_file else load_occurrences
+        with metrics.timer('occurrence'):
+            load(options.csv_file, occurrence_query, executor, journal, rejects)
+        if rejects:
+            rejects_out.close()
+    executor.shutdown()
+    journal.close()
+    profiler.stop()
+
+    failed = failed_batches(TaxonQuery.stage, DeleteQuery.stage, OccurrenceQuery.stage)
+    metrics.METRICS.log_timers()
+    metrics.METRICS.write_summary(options.metrics or '%s.metrics.json' % options.csv_file,
+                                  script='csv2cdb', csv_file=options.csv_file,
+                                  failed_batches=failed)
+    if failed:
+        logging.error('%s batches failed, rerun with the same --checkpoint to retry them '
+                      '(completed batches are skipped)' % failed)
+        sys.exit(1)
     logging.info('CSV successfully uploaded to CartoDB .')
-
-
-
-"""
-1) load CSV and insert names into taxon table
-2) load taxon table into memory
-3) insert into taxon
-
-"""
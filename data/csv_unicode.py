@@ -22,7 +22,139 @@ __author__ = "Aaron Steele"
 Code inspired by: http://docs.python.org/library/csv.html#csv-examples 
 """
 
-import csv, codecs, cStringIO, sys
+import codecs, csv, cStringIO, os, sys
+
+from itertools import izip, repeat
+from records import Constant
+
+# The default number of bytes buffered by writers before they are flushed:
+BUFFER_SIZE = 1024 * 1024
+
+def is_utf8(encoding):
+    """Returns True if the encoding name refers to UTF-8."""
+    return codecs.lookup(encoding or 'utf-8').name == 'utf-8'
+
+def encode_value(value):
+    """Returns a value as a UTF-8 string, or '' if the value is None.
+
+    Byte strings are assumed to already be UTF-8 encoded and are passed through.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, str):
+        return value
+    elif value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+# The value types that encode_value returns unchanged:
+_STR_TYPES = frozenset([str])
+
+def encode_column(values):
+    """Returns a list of values as UTF-8 strings, as is if they all are."""
+    if set(map(type, values)) <= _STR_TYPES:
+        return values
+    return map(encode_value, values)
+
+def split_ranges(path, parts):
+    """Splits a file into byte ranges that start and end on line boundaries.
+
+    Ranges assume one record per line, so quoted values must not contain
+    line breaks.
+
+    Args:
+        path: A string path to the file.
+        parts: The integer maximum number of ranges.
+
+    Returns:
+        A list of (start, end) byte offset tuples covering the whole file.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, parts):
+            offset = size * i / parts
+            if offset <= bounds[-1]:
+                continue
+            f.seek(offset - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+class RangeFile:
+    """
+    A read-only file object limited to the bytes from start up to end of the 
+    file at path, for use with split_ranges.
+    """
+    def __init__(self, path, start=0, end=None):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        if end is None:
+            end = os.path.getsize(path)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        line = self.f.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        # Reads lines in blocks, which is much faster than calling readline:
+        while self.remaining > 0:
+            lines = self.f.readlines(min(self.remaining, BUFFER_SIZE))
+            if not lines:
+                break
+            for line in lines:
+                if len(line) >= self.remaining:
+                    # The range ends within (or at the end of) this line:
+                    line = line[:self.remaining]
+                    self.remaining = 0
+                    self.f.seek(0, 2)
+                    yield line
+                    return
+                self.remaining -= len(line)
+                yield line
+
+    def close(self):
+        self.f.close()
+
+class OffsetFile:
+    """
+    Iterator over the lines of file "f" that tracks the byte offset just past
+    the last line it returned. A csv.reader pulls only the lines of one record
+    at a time, so after each row the offset is where the next record starts.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def seek(self, offset):
+        self.f.seek(offset)
+        self.offset = offset
+
+    def __iter__(self):
+        # Reads lines in blocks, which is much faster than calling readline:
+        while True:
+            lines = self.f.readlines(BUFFER_SIZE)
+            if not lines:
+                break
+            for line in lines:
+                self.offset += len(line)
+                yield line
 
 class UTF8Recoder:
     """
@@ -37,6 +169,102 @@ class UTF8Recoder:
     def next(self):
         return self.reader.next().encode("utf-8")
 
+    def read(self, size=-1):
+        return self.reader.read(size).encode("utf-8")
+
+def iter_records(f, lineterminator='\n'):
+    """Yields the records of file "f" split on lineterminator, without it.
+
+    Newline terminated files are iterated by line, and a '\r' before the '\n' is
+    removed as well, as the csv module does. Files with other terminators are
+    read in blocks and split on the terminator.
+    """
+    if lineterminator in ('\n', '\r\n'):
+        for line in f:
+            if line[-1:] == '\n':
+                line = line[:-1]
+                if line[-1:] == '\r':
+                    line = line[:-1]
+            yield line
+        return
+    tail = ''
+    while True:
+        block = f.read(BUFFER_SIZE)
+        if not block:
+            break
+        records = (tail + block).split(lineterminator)
+        tail = records.pop()
+        for record in records:
+            yield record
+    if tail:
+        yield tail
+
+class DelimitedReader:
+    """
+    A reader for delimited files whose fields are never enclosed in quotes,
+    which will iterate over rows in file "f", which is encoded in the given
+    encoding, as lists of UTF-8 strings.
+
+    Records and fields are found with plain string splits, so there is no per
+    character quote handling, and both terminators may be any string.
+    """
+
+    def __init__(self, f, delimiter='\t', lineterminator='\n', encoding="utf-8"):
+        if not is_utf8(encoding):
+            f = UTF8Recoder(f, encoding)
+        self.delimiter = delimiter
+        self.records = iter_records(f, lineterminator)
+
+    def next(self):
+        return self.records.next().split(self.delimiter)
+
+    def __iter__(self):
+        delimiter = self.delimiter
+        return (record.split(delimiter) for record in self.records)
+
+def dialect_reader(f, delimiter=',', lineterminator='\n', quotechar='"', encoding="utf-8"):
+    """Returns a reader of rows of UTF-8 strings for a file with the given format.
+
+    Files without a quotechar are read with a DelimitedReader, others with the
+    csv module. The csv module reads a file by line, and lines only end at
+    '\n', so records with other terminators, '\r' included, are split before
+    they are parsed.
+    """
+    if not quotechar:
+        return DelimitedReader(f, delimiter, lineterminator, encoding)
+    if lineterminator not in ('\n', '\r\n'):
+        if not is_utf8(encoding):
+            f = UTF8Recoder(f, encoding)
+            encoding = 'utf-8'
+        f = iter_records(f, lineterminator)
+    return UnicodeReader(f, delimiter=delimiter, quotechar=quotechar, 
+                         skipinitialspace=True, encoding=encoding, decode=False)
+
+class UnicodeReader:
+    """
+    A CSV reader which will iterate over rows in the CSV file "f",
+    which is encoded in the given encoding, as lists of values.
+
+    UTF-8 input is handed to the csv module as is. Other encodings are recoded
+    to UTF-8 first. If decode is False, rows are returned as UTF-8 strings 
+    instead of unicode, which avoids decoding altogether.
+    """
+
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", decode=True, **kwds):
+        if not is_utf8(encoding):
+            f = UTF8Recoder(f, encoding)
+        self.reader = csv.reader(f, dialect=dialect, **kwds)
+        self.decode = decode
+
+    def next(self):
+        row = self.reader.next()
+        if self.decode:
+            return [s.decode("utf-8") for s in row]
+        return row
+
+    def __iter__(self):
+        return self
+
 class UnicodeDictReader:
     """
     A CSV reader which will iterate over lines in the CSV file "f",
@@ -44,67 +272,99 @@ class UnicodeDictReader:
     """
 
     def __init__(self, f, fieldnames=None, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
+        self.reader = UnicodeReader(f, dialect=dialect, encoding=encoding, **kwds)
         if fieldnames:
             self.header = fieldnames
         else:
             self.header = self.reader.next()
 
     def next(self):
-        row = self.reader.next()
-        vals = [unicode(s, "utf-8") for s in row]
-        return dict((self.header[x], vals[x]) for x in range(len(self.header)))
+        return dict(izip(self.header, self.reader.next()))
 
     def __iter__(self):
         return self
 
-class UnicodeDictWriter:
+class UnicodeWriter:
     """
-    A CSV writer which will write rows to CSV file "f",
+    A CSV writer which will write rows (sequences of values) to CSV file "f",
     which is encoded in the given encoding.
+
+    Rows are buffered as UTF-8 and written to "f" once buffer_size bytes have
+    accumulated, so callers using a buffer must call flush() when done. The 
+    default buffer_size of 0 writes every row immediately. When the target 
+    encoding is UTF-8 the buffer is written as is, without being recoded.
     """
 
-    def __init__(self, f, fieldnames, dialect=csv.excel, encoding="utf-8", **kwds):
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", buffer_size=0, **kwds):
         # Redirect output to a queue
-        self.fieldnames = fieldnames
         self.queue = cStringIO.StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
-        
-    def writeheader(self):
-        self.writer.writerow(self.fieldnames)
+        self.buffer_size = buffer_size
+        if is_utf8(encoding):
+            self.encoder = None
+        else:
+            self.encoder = codecs.getincrementalencoder(encoding)()
 
     def writerow(self, row):
-        values = []
-        
-        # Some (most?) rows don't have all the keys possible
-        # in the file. In such cases, we need to make sure we
-        # insert a blank string in their place.
-        for fieldname in self.fieldnames:
-            if row.has_key(fieldname) and row[fieldname] is not None:
-                if isinstance(row[fieldname], unicode):
-                    values.append(row[fieldname])
-                else:
-                    values.append(unicode(row[fieldname]))
+        self.writer.writerow(map(encode_value, row))
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writer.writerow(map(encode_value, row))
+            if self.queue.tell() >= self.buffer_size:
+                self.flush()
+
+    def write_batch(self, batch):
+        """Writes the rows of a records.RecordBatch.
+
+        Values are encoded a column at a time, and constant columns once.
+        """
+        columns = []
+        for column in batch.columns:
+            if isinstance(column, Constant):
+                columns.append(repeat(encode_value(column.value), len(batch)))
             else:
-                values.append("")
+                columns.append(encode_column(column))
+        self.writer.writerows(izip(*columns))
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
 
-        self.writer.writerow([str.encode('utf-8') for str in values])
+    def flush(self):
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
+        if self.encoder:
+            # ... and reencode it into the target encoding
+            data = self.encoder.encode(data.decode("utf-8"))
         # write to the target stream
         self.stream.write(data)
         # empty queue
         self.queue.truncate(0)
 
+class UnicodeDictWriter(UnicodeWriter):
+    """
+    A CSV writer which will write rows to CSV file "f",
+    which is encoded in the given encoding.
+    """
+
+    def __init__(self, f, fieldnames, dialect=csv.excel, encoding="utf-8", buffer_size=0, **kwds):
+        UnicodeWriter.__init__(self, f, dialect=dialect, encoding=encoding, 
+                               buffer_size=buffer_size, **kwds)
+        self.fieldnames = fieldnames
+        
+    def writeheader(self):
+        UnicodeWriter.writerow(self, self.fieldnames)
+
+    def writerow(self, row):
+        # Some (most?) rows don't have all the keys possible
+        # in the file. In such cases, we need to make sure we
+        # insert a blank string in their place.
+        UnicodeWriter.writerow(self, map(row.get, self.fieldnames))
+
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        UnicodeWriter.writerows(self, (map(row.get, self.fieldnames) for row in rows))
 
 
 if __name__ == '__main__':
@@ -21,22 +21,53 @@ __author__ = "Aaron Steele"
 The Darwin Core Archive format is specified here:
 http://rs.tdwg.org/dwc/terms/guides/text/index.htm
 
-Only the data contained within the <core> element are converted to a CSV file. 
+Only the data contained within the <core> element are converted to a CSV file,
+unless extensions are requested. In that case the rows of each <extension> are
+joined to their core rows on the <coreid> and added to the CSV file as a JSON
+list in one column per extension.
 
-Note: All <extension> elements are currently ignored.
+Archives can be converted from an extracted directory or read directly from the
+zip file, in which case core data files are streamed from their compressed
+members without being extracted to disk.
 
 """
+import columnar
 import csv_unicode as csvu
 import csv
+import delta
+import dwcajoin
+import geometry
+import hashlib
+import json
 import logging
+import metrics
+import multiprocessing
 import os
+import posixpath
+import records
+import schema
+import shutil
 import sys
+import tempfile
 import urllib2
+import validation
 import zipfile
 
+from cStringIO import StringIO
+from itertools import islice
 from optparse import OptionParser
 from urlparse import urlparse
-from xml.dom.minidom import parse, parseString
+from xml.etree.cElementTree import iterparse
+
+# Term names by term URI, since the same few terms appear in every metafile:
+_TERM_NAMES = {}
+
+def term_name(term):
+    """Returns the name of a term URI, i.e., the last segment of its path."""
+    name = _TERM_NAMES.get(term)
+    if name is None:
+        name = _TERM_NAMES[term] = urlparse(term).path.split('/')[-1]
+    return name
 
 class FieldType(object):
     """Represents a <field> element in a Darwin Core Archive metafile.
@@ -53,6 +84,8 @@ class FieldType(object):
         default: An optional string that defines the field default value.
     """
 
+    __slots__ = ('_term', '_index', '_default')
+
     def __init__(self, term, index=None, default=None):
         """Constructs a new FieldType instance.
 
@@ -61,8 +94,7 @@ class FieldType(object):
             index: An optional integer that defines the field index.
             default: An optional string that defines the field default value.
         """
-        term = urlparse(term).path
-        self._term = term.split('/')[-1]
+        self._term = term_name(term)
         if index == '' or index is None:
             self._index = None
         else:
@@ -80,7 +112,7 @@ class FieldType(object):
 
     def __str__(self):
         """Returns the attributes of this FieldType as a dictionary string."""
-        return str(self.__dict__)
+        return str(dict(term=self._term, index=self._index, default=self._default))
 
     # Defines read-only properties for term, index, and default attributes:
     def get_term(self):
@@ -98,6 +130,8 @@ class IdType(object):
 
     """
 
+    __slots__ = ('_index',)
+
     def __init__(self, index):
         self._index = int(index)
 
@@ -112,7 +146,7 @@ class IdType(object):
 
     def __str__(self):
         """Returns the attributes of this FieldType as a dictionary string."""
-        return str(self.__dict__)
+        return str(dict(index=self._index))
 
     # Defines read-only properties for term, index, and default attributes:
     def get_index(self):
@@ -122,6 +156,19 @@ class IdType(object):
         return 'id'
     term = property(get_term)
 
+class CoreIdType(IdType):
+    """Represents a <coreid> element in a Darwin Core Archive metafile.
+
+    The index refers to the column of an extension file that holds the id of the
+    core record each extension row belongs to.
+    """
+
+    __slots__ = ()
+
+    def get_term(self):
+        return 'coreid'
+    term = property(get_term)
+
 class CoreFileType(object):
     """Represents a <core> element in a Darwin Core Archive metafile.
 
@@ -134,46 +181,60 @@ class CoreFileType(object):
         rowType: A string that defines the row type.
         fieldsTerminatedBy: A string that defines the field separator.
         linesTerminatedBy: A string that defines the new line character.
-        fieldsEnclosedBy: A string that defines the character enclosing fields.
+        fieldsEnclosedBy: A string that defines the character enclosing fields,
+            or '' if fields are not enclosed.
         encoding: A string that defines the character encoding.
         ignoreHeaderLines: An integer specifying how many lines to skip.
         dateFormat: A string the defines the date format.
         locations: A list of strings that define file locations.
         fields: A list of FieldType objects with index values.
         defaults: A list of FieldType objects without index values.
+        plan: An (indexes, width, defaults) tuple used to project data rows:
+            the column indexes of the id and fields, the minimum row width, and
+            the default values appended to each row, as UTF-8 strings like the
+            values of the data files.
     """
     
     def __init__(self, metafile):
         """Constructs a new CoreFileType instance.
 
         Args:
-            metafile: A string that contains the contents of a metafile.
+            metafile: A string that contains the contents of a metafile, or the
+                <core> element of a parsed metafile.
         """
-        dom = parseString(metafile)
-        core = dom.getElementsByTagName('core')[0]
-        
+        if isinstance(metafile, basestring):
+            metafile = parse_elements(metafile)[0]
+        self._parse(metafile)
+
+    def _parse(self, core):
+        """Extracts attributes, locations, and fields from a file type element."""
         # Extracts core attributes:
-        self._rowType = core.getAttribute('rowType')
-        self._fieldsTerminatedBy = core.getAttribute('fieldsTerminatedBy') or ','
-        self._linesTerminatedBy = core.getAttribute('linesTerminatedBy') or '\n'
-        self._fieldsEnclosedBy = core.getAttribute('fieldsEnclosedBy') or '"'
-        self._encoding = core.getAttribute('encoding')
-        self._ignoreHeaderLines = int(core.getAttribute('ignoreHeaderLines'))
-        self._dateFormat = core.getAttribute('dateFormat')
+        self._rowType = core.get('rowType', '')
+        self._fieldsTerminatedBy = unescape(core.get('fieldsTerminatedBy')) or ','
+        self._linesTerminatedBy = unescape(core.get('linesTerminatedBy')) or '\n'
+        # An empty fieldsEnclosedBy means that fields are not enclosed:
+        self._fieldsEnclosedBy = unescape(core.get('fieldsEnclosedBy', '"'))
+        self._encoding = core.get('encoding', '')
+        self._ignoreHeaderLines = int(core.get('ignoreHeaderLines') or 0)
+        self._dateFormat = core.get('dateFormat', '')
+
+        children = {}
+        for x in core.iter():
+            children.setdefault(local_name(x.tag), []).append(x)
 
         # Extracts core file locations:
-        locations = core.getElementsByTagName('location')
-        self._locations = [x.childNodes[0].data for x in locations]
+        self._locations = [x.text for x in children.get('location', [])]
         
-        idElem = core.getElementsByTagName('id')
-        if len(idElem) > 0:        
-            self._recid = IdType(idElem[0].getAttribute('index'))
+        self._recid = None
+        if 'id' in children:
+            self._recid = IdType(children['id'][0].get('index'))
 
         # Extracts and sorts core fields with index values:
-        fields = [FieldType(x.getAttribute('term') or None, 
-                            index=x.getAttribute('index') or None, 
-                            default=x.getAttribute('default') or None)
-                  for x in core.getElementsByTagName('field')]
+        fields = [FieldType(x.get('term') or None, 
+                            index=x.get('index') or None, 
+                            default=x.get('default') or None)
+                  for x in children.get('field', [])]
+        self._plan = None
         self._fields = [x for x in fields if x.index is not None]
         self._fields.sort()
 
@@ -189,6 +250,17 @@ class CoreFileType(object):
         return self._recid
     recid = property(get_id)
 
+    def get_plan(self):
+        if self._plan is None:
+            indexes = [x.index for x in self._fields]
+            if self._recid:
+                indexes.insert(0, self._recid.index)
+            width = max(indexes) + 1 if indexes else 0
+            defaults = [csvu.encode_value(x.default) for x in self._defaults]
+            self._plan = (indexes, width, defaults)
+        return self._plan
+    plan = property(get_plan)
+
     def get_defaults(self):
         return self._defaults
     defaults = property(get_defaults)
@@ -220,58 +292,601 @@ class CoreFileType(object):
         return self._rowType
     rowType = property(get_rowType)
 
-def writecsv(metafile, destination):
-    """Writes a single CSV file from data defined by a Darwin Core Archive metafile.
-    
+class ExtensionFileType(CoreFileType):
+    """Represents an <extension> element in a Darwin Core Archive metafile.
+
+    The <extension> element is a complexType named extensionFileType and it is 
+    defined here: http://rs.tdwg.org/dwc/text/tdwg_dwc_text.xsd
+
+    It has the same attributes as a CoreFileType, except that recid is the 
+    CoreIdType that links each row to its core record.
+
+    Attributes:
+        name: A string naming the extension, i.e., the lowercased rowType term.
+    """
+
+    def __init__(self, element):
+        """Constructs a new ExtensionFileType instance.
+
+        Args:
+            element: The <extension> element from a parsed metafile.
+        """
+        self._parse(element)
+        self._recid = None
+        for x in element.iter():
+            if local_name(x.tag) == 'coreid':
+                self._recid = CoreIdType(x.get('index'))
+                break
+
+    def get_name(self):
+        return self._rowType.split('/')[-1].lower()
+    name = property(get_name)
+
+def unescape(value):
+    """Returns a metafile attribute with escapes such as \\t replaced, as a string."""
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    try:
+        return value.decode('string_escape')
+    except ValueError:
+        return value
+
+def local_name(tag):
+    """Returns an element tag without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+def parse_elements(metafile):
+    """Returns the (<core> element, list of <extension> elements) of a metafile.
+
     Args:
-        metafile: A string path to a Darwin Core Archive metafile.
-        destination: A string path to where CSV results will be written.
+        metafile: A string that contains the contents of a metafile.
+    """
+    core = None
+    extensions = []
+    for event, element in iterparse(StringIO(metafile)):
+        name = local_name(element.tag)
+        if name == 'core':
+            core = element
+        elif name == 'extension':
+            extensions.append(element)
+    if core is None:
+        raise ValueError('No <core> element in metafile')
+    return core, extensions
+
+# Parsed metafiles by the SHA-1 of their contents:
+_METAFILES = {}
+
+# The maximum number of parsed metafiles kept:
+METAFILE_CACHE_SIZE = 1024
+
+def parse_metafile(metafile):
+    """Returns the (CoreFileType, list of ExtensionFileType) of a metafile.
+
+    Results are cached by a hash of the metafile contents, so an unchanged
+    metafile is only parsed once per process. The returned objects are shared
+    and must not be modified.
+
+    Args:
+        metafile: A string that contains the contents of a metafile.
+    """
+    key = hashlib.sha1(metafile).hexdigest()
+    parsed = _METAFILES.get(key)
+    if parsed is None:
+        core, extensions = parse_elements(metafile)
+        parsed = (CoreFileType(core), [ExtensionFileType(x) for x in extensions])
+        if len(_METAFILES) >= METAFILE_CACHE_SIZE:
+            _METAFILES.clear()
+        _METAFILES[key] = parsed
+    return parsed
+
+def get_extensions(metafile):
+    """Returns a list of ExtensionFileType for each <extension> in a metafile.
+
+    Args:
+        metafile: A string that contains the contents of a metafile.
+    """
+    return parse_metafile(metafile)[1]
+
+def workspace_name(source):
+    """Returns the name of the workspace for an archive URL or path.
+
+    The name of an IPT archive URL is its resource, e.g., nysm_mammals for
+    http://vertnet.nhm.ku.edu:8080/ipt/archive.do?r=nysm_mammals, and that of
+    other URLs and paths the file name without its extension.
+    """
+    url = urlparse(source)
+    resource = dict(x.split('=', 1) for x in url.query.split('&') if '=' in x).get('r')
+    if resource:
+        return resource
+    return os.path.splitext(posixpath.basename(url.path.rstrip('/')))[0]
+
+# The size of the chunks used to stream an archive download to disk:
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+def download(url, path, state=None):
+    """Streams the Darwin Core Archive at a URL into a local file.
+
+    The response body is copied in DOWNLOAD_CHUNK_SIZE chunks so that memory
+    use stays bounded regardless of the size of the archive.
+
+    Args:
+        url: A string URL to a Darwin Core Archive.
+        path: A string path to where the archive will be written.
+        state: An optional delta.HarvestState. The ETag and Last-Modified of
+            its last download of url are sent as If-None-Match and
+            If-Modified-Since, so an archive that has not changed is not sent
+            again, and those of this download are kept in it.
+
+    Returns:
+        The integer HTTP response code, 304 if the archive has not changed.
+    """
+    request = urllib2.Request(url)
+    if state:
+        etag, last_modified = state.get_validators(url)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+    with metrics.timer('download'):
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304: # NOT MODIFIED
+                return e.code
+            raise
+        if response.code == 200:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+            metrics.count('download.bytes', os.path.getsize(path))
+            if state:
+                state.set_validators(url, response.info().getheader('ETag'),
+                                     response.info().getheader('Last-Modified'))
+    return response.code
+
+def find_metafile(archive):
+    """Returns the name of the metafile member in a Darwin Core Archive zip.
+
+    Args:
+        archive: A zipfile.ZipFile for a Darwin Core Archive.
+    """
+    names = [x for x in archive.namelist() 
+             if posixpath.basename(x).lower() == 'meta.xml']
+    if not names:
+        raise ValueError('No meta.xml found in archive %s' % archive.filename)
+    # Prefers the metafile closest to the root of the archive:
+    names.sort(key=lambda x: (x.count('/'), x))
+    return names[0]
+
+def open_location(location, metafile, archive=None):
+    """Opens a core data file for reading.
+
+    Locations are resolved relative to the directory containing the metafile. 
+    If an archive is given, the location is opened as a member of the zip and 
+    is decompressed as it is read.
+
+    Args:
+        location: A string location from a <core> element.
+        metafile: A string path (or archive member name) of the metafile.
+        archive: An optional zipfile.ZipFile containing the location.
     """
-    logging.info('Converting %s to %s' % (metafile, destination))
+    if archive:
+        return archive.open(posixpath.join(posixpath.dirname(metafile), location))
+    return open(os.path.join(os.path.dirname(metafile), location), 'rb')
 
-    core = CoreFileType(open(metafile, 'r').read())
+def location_size(location, metafile, archive=None):
+    """Returns the uncompressed size in bytes of a core data file."""
+    if archive:
+        return archive.getinfo(posixpath.join(posixpath.dirname(metafile), location)).file_size
+    return os.path.getsize(os.path.join(os.path.dirname(metafile), location))
 
-    # Builds the CSV header fieldnames:
+# File name extensions for each output format:
+FORMAT_EXTENSIONS = {'csv': 'csv', 'columnar': 'dwcc'}
+
+# The smallest byte range of a core data file that is converted as one part:
+MIN_PART_SIZE = 16 * 1024 * 1024
+
+# The number of rows read before they are written, as one records.RecordBatch:
+CONVERT_BATCH_SIZE = 5000
+
+def load_core(metafile, archive=None):
+    """Returns a (CoreFileType, metafile) tuple for a Darwin Core Archive.
+
+    Args:
+        metafile: A string path to a metafile, or the name of the metafile 
+            member in archive (None to locate it automatically).
+        archive: An optional zipfile.ZipFile for the Darwin Core Archive.
+    """
+    if archive:
+        metafile = metafile or find_metafile(archive)
+        with metrics.timer('unzip'):
+            data = archive.read(metafile)
+    else:
+        data = open(metafile, 'r').read()
+    with metrics.timer('parse'):
+        return parse_metafile(data)[0], metafile
+
+def get_fieldnames(core):
+    """Returns the list of CSV header fieldnames for a CoreFileType."""
     id_term = []
     if core.recid:
         id_term = [core.recid.term]
     field_terms = [x.term for x in core.fields]
     default_field_terms = [x.term for x in core.defaults]
-    fieldnames = id_term + field_terms + default_field_terms
+    return id_term + field_terms + default_field_terms
 
-    # Creates the CSV writer and writes the header row:
-    dw = csvu.UnicodeDictWriter(open(destination, 'w'), fieldnames, quoting=csv.QUOTE_ALL)
-    dw.writeheader()
+def core_reader(core, f, skip_header=True):
+    """Returns a reader of the rows of a data file as lists of UTF-8 strings.
 
-    # Formatting params for input CSV files:
-    delimiter = core.fieldsTerminatedBy
-    lineterminator = core.linesTerminatedBy
-    quotechar = core.fieldsEnclosedBy
-    
-    # Writes CSV data for each input CSV file:
+    Rows are read as they are in the file, with all of their columns.
+
+    Args:
+        core: The CoreFileType (or ExtensionFileType) describing the data file.
+        f: A file object for the data file (or a range of it).
+        skip_header: True if core.ignoreHeaderLines should be skipped.
+    """
+    # Reads unquoted files with plain splits and others with the csv module:
+    dr = csvu.dialect_reader(
+        f, 
+        delimiter=core.fieldsTerminatedBy,
+        lineterminator=core.linesTerminatedBy, 
+        quotechar=core.fieldsEnclosedBy,
+        encoding=core.encoding or 'utf-8')
+
+    # Skips over nodata lines:
+    if skip_header:
+        for x in islice(dr, core.ignoreHeaderLines):
+            pass
+    return dr
+
+def iter_rows(core, f, skip_header=True):
+    """Yields the rows of a core data file as lists of UTF-8 strings.
+
+    Each row holds the id (if any), the fields, and the defaults of core in the 
+    same order as get_fieldnames().
+
+    Args:
+        core: The CoreFileType (or ExtensionFileType) describing the data file.
+        f: A file object for the data file (or a range of it).
+        skip_header: True if core.ignoreHeaderLines should be skipped.
+    """
+    # Column indexes of the id and fields in the input rows, and the constant
+    # values appended to every output row for the default terms:
+    indexes, width, defaults = core.plan
+    padding = [''] * width
+
+    # Rows are passed through as UTF-8 strings, so they are never decoded:
+    for row in core_reader(core, f, skip_header):
+        if len(row) < width:
+            row = row + padding
+        yield [row[i] for i in indexes] + defaults
+
+def iter_batches(core, f, skip_header=True, batch_size=CONVERT_BATCH_SIZE):
+    """Yields the rows of a core data file as records.RecordBatch.
+
+    Each batch has the columns of get_fieldnames(), with the defaults of core
+    stored once as constant columns.
+
+    Args:
+        core: The CoreFileType describing the data file.
+        f: A file object for the data file (or a range of it).
+        skip_header: True if core.ignoreHeaderLines should be skipped.
+        batch_size: The integer number of rows per batch.
+    """
+    indexes, width, defaults = core.plan
+    return records.iter_batches(get_fieldnames(core), core_reader(core, f, skip_header),
+                                batch_size, indexes, defaults)
+
+def iter_locations(core, metafile, archive=None):
+    """Yields the rows of all data files of a core (or extension) file type."""
+    for location in core.locations:
+        f = open_location(location, metafile, archive)
+        try:
+            for row in iter_rows(core, f):
+                yield row
+        finally:
+            f.close()
+
+def convert_rows(core, f, writer, skip_header=True, progress=None):
+    """Writes the rows of a core data file to a CSV writer.
+
+    Rows are read and written in batches of CONVERT_BATCH_SIZE, so the time
+    spent reading and decoding them (the transcode timer) is measured apart
+    from the time spent writing them (the write timer).
+
+    Args:
+        core: The CoreFileType describing the data file.
+        f: A file object for the core data file (or a range of it).
+        writer: The writer to write each records.RecordBatch to, e.g., a
+            csv_unicode.UnicodeWriter.
+        skip_header: True if core.ignoreHeaderLines should be skipped.
+        progress: An optional metrics.Progress to update with each batch.
+    """
+    f = metrics.MeteredFile(f)
+    batches = iter_batches(core, f, skip_header)
+    read = 0
+    while True:
+        with metrics.timer('transcode'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        with metrics.timer('write'):
+            writer.write_batch(batch)
+        if progress:
+            progress.update(len(batch), f.bytes - read)
+            read = f.bytes
+
+def convert_joined(core, extensions, metafile, writer, archive=None, tmpdir=None):
+    """Writes core rows joined with their extension rows to a CSV writer.
+
+    Extension rows are matched to core rows by id with dwcajoin.merge_join and 
+    appended to each core row as one JSON list of objects per extension. Data
+    files not already sorted by id are sorted with a bounded memory external
+    sort, in which case rows are written in order of their id.
+
+    Args:
+        core: The CoreFileType, which must have an <id>.
+        extensions: A list of ExtensionFileType, each with a <coreid>.
+        metafile: The string metafile path or archive member name.
+        writer: The csv_unicode.UnicodeWriter to write rows to.
+        archive: An optional zipfile.ZipFile containing the data files.
+        tmpdir: An optional string path to a directory for sorted runs.
+    """
+    if not core.recid:
+        raise ValueError('Extensions cannot be joined to a core without an <id>')
+    sources = []
+    for x in [core] + extensions:
+        if not x.recid:
+            raise ValueError('Extension %s has no <coreid>' % x.rowType)
+        presorted = dwcajoin.is_sorted(iter_locations(x, metafile, archive))
+        logging.info('Rows of %s are %ssorted by id' % 
+                     (x.rowType, '' if presorted else 'not '))
+        sources.append(dwcajoin.sorted_rows(iter_locations(x, metafile, archive),
+                                            presorted=presorted, tmpdir=tmpdir))
+    names = [get_fieldnames(x)[1:] for x in extensions]
+    joined = dwcajoin.merge_join(sources[0], [(x, 0) for x in sources[1:]])
+    for row, groups in joined:
+        for fieldnames, group in zip(names, groups):
+            row.append(json.dumps([dict(zip(fieldnames, x[1:])) for x in group],
+                                  separators=(',', ':')))
+        writer.writerow(row)
+
+def get_stages(writer, fieldnames, rejects=None, geometry_format=None, state=None):
+    """Returns the writers that process rows before they reach a writer.
+
+    Rows are validated first if a rejects writer is given, so that only rows
+    that are written are compared with the harvest state. Unchanged rows are
+    then dropped if a state is given, and the rest have the geometry columns
+    appended if a geometry format is given. The stages buffer rows, so each
+    must be flushed in order when done.
+
+    Args:
+        writer: The writer for the output rows.
+        fieldnames: The list of header fieldnames of the converted rows.
+        rejects: An optional writer for rows that fail validation.
+        geometry_format: An optional string geometry encoding, 'ewkb' or 'ewkt'.
+        state: An optional delta.HarvestState of the last harvest.
+
+    Returns:
+        The list of stages, the one to write converted rows to first.
+    """
+    stages = []
+    if geometry_format:
+        writer = geometry.GeometryWriter(writer, fieldnames, geometry_format)
+        stages.insert(0, writer)
+    if state:
+        writer = delta.DeltaWriter(writer, fieldnames, state)
+        stages.insert(0, writer)
+    if rejects:
+        writer = validation.ValidatingWriter(writer, fieldnames, rejects)
+        stages.insert(0, writer)
+    return stages
+
+def convert_part(part):
+    """Converts one part of a core data file into a headerless CSV file.
+
+    Args:
+        part: A (metafile, archive, location, start, end, path, validate,
+            geometry_format) tuple where archive is a string path or None, start
+            and end are byte offsets into location (None to read all of it),
+            path is where the CSV rows will be written, validate is True if rows
+            should be validated, with invalid rows written to path + '.rejects',
+            and geometry_format is the optional geometry encoding.
+
+    Returns:
+        A (path, metrics snapshot) tuple with the string path the rows were
+        written to and the metrics of converting them.
+    """
+    metafile, archive, location, start, end, path, validate, geometry_format = part
+    # Workers are forked (and reused), so only this part is counted:
+    metrics.METRICS.reset()
+    if archive:
+        archive = zipfile.ZipFile(archive)
+    core, metafile = load_core(metafile, archive)
+    if start is None:
+        f = open_location(location, metafile, archive)
+        size = location_size(location, metafile, archive)
+    else:
+        f = csvu.RangeFile(os.path.join(os.path.dirname(metafile), location), start, end)
+        size = end - start
+    rejects_out = open(path + '.rejects', 'wb') if validate else None
+    with open(path, 'wb') as out:
+        dw = csvu.UnicodeWriter(out, quoting=csv.QUOTE_ALL, buffer_size=csvu.BUFFER_SIZE)
+        rejects = csvu.UnicodeWriter(rejects_out, quoting=csv.QUOTE_ALL) if validate else None
+        stages = get_stages(dw, get_fieldnames(core), rejects, geometry_format)
+        progress = metrics.Progress('convert', size)
+        convert_rows(core, f, stages[0] if stages else dw, not start, progress)
+        progress.done()
+        with metrics.timer('write'):
+            for stage in stages:
+                stage.flush()
+            dw.flush()
+    if rejects_out:
+        rejects_out.close()
+    f.close()
+    if archive:
+        archive.close()
+    return path, metrics.METRICS.snapshot()
+
+def get_parts(core, metafile, archive, jobs, workspace, validate=False, 
+              geometry_format=None):
+    """Returns the list of parts used to convert core data files in parallel.
+
+    Data files inside an archive are converted whole. Extracted data files are
+    split on line boundaries into at most jobs byte ranges of at least
+    MIN_PART_SIZE bytes, unless their lines are not terminated by newlines or
+    their fields are enclosed in quotes, which may hold line breaks.
+
+    Args:
+        core: The CoreFileType.
+        metafile: The string metafile path or archive member name.
+        archive: An optional string path to a Darwin Core Archive zip file.
+        jobs: The integer number of worker processes.
+        workspace: A string path to the directory for part files.
+        validate: True if the rows of each part should be validated.
+        geometry_format: The optional geometry encoding of each part.
+    """
+    ranges = []
     for location in core.locations:
-        f = open(location, 'r')
-        dr = csvu.UnicodeDictReader(
-            f, 
-            fieldnames=fieldnames,
-            delimiter='\t',
-            lineterminator=lineterminator, 
-            quotechar=quotechar,
-            skipinitialspace=True)
-
-        # Skips over nodata lines:
-        for x in range(0, core.ignoreHeaderLines):
-            dr.next()
-
-        for row in dr:
-
-            #print row
-            # Adds the default values for any default terms:
-            for d in core.defaults:
-                row[d.term] = d.default
-
-            # Writes the row:
-            dw.writerow(row)
+        if archive or core.linesTerminatedBy not in ('\n', '\r\n') or \
+                core.fieldsEnclosedBy:
+            ranges.append((location, None, None))
+            continue
+        path = os.path.join(os.path.dirname(metafile), location)
+        parts = max(1, min(jobs, os.path.getsize(path) / MIN_PART_SIZE))
+        ranges.extend((location, start, end) 
+                      for start, end in csvu.split_ranges(path, parts))
+    return [(metafile, archive, location, start, end, 
+             os.path.join(workspace, 'part-%05d.csv' % i), validate, geometry_format)
+            for i, (location, start, end) in enumerate(ranges)]
+
+def writecsv(metafile, destination, archive=None, jobs=1, extensions=False, 
+             format='csv', validate=False, geometry_format=None, state=None):
+    """Writes a single CSV file from data defined by a Darwin Core Archive metafile.
+    
+    Args:
+        metafile: A string path to a Darwin Core Archive metafile. If archive is 
+            given, the name of the metafile member within the archive, or None
+            to locate it automatically.
+        destination: A string path to where CSV results will be written.
+        archive: An optional string path to (or file object for) a Darwin Core
+            Archive zip file. Data are streamed from the zip without extraction.
+        jobs: The integer number of processes used to convert core data files. 
+            Parallel conversion requires archive to be a path, if given.
+        extensions: True if extension rows should be joined to core rows. Joins 
+            are always done in a single process.
+        format: The string output format, either 'csv' or 'columnar' for a 
+            columnar.ColumnarWriter file. Columnar files are always written in
+            a single process.
+        validate: True if rows should be coerced to their column types (see
+            validation.py). Invalid rows are written with their error message
+            to a .rejects.csv file next to destination instead.
+        geometry_format: An optional string geometry encoding, 'ewkb' or 'ewkt'.
+            If given, the_geom and the_geom_webmercator columns are computed
+            from the coordinates (see geometry.py) and appended to each row.
+        state: An optional delta.HarvestState. If given, only the rows of
+            records inserted or updated since the harvest it holds are written,
+            and the ids of updated and deleted records are written to a
+            .deletes.csv file next to destination. Deltas are always written
+            in a single process.
+    """
+    zf = zipfile.ZipFile(archive) if archive else None
+    core, metafile = load_core(metafile, zf)
+    logging.info('Converting %s%s to %s' % 
+                 (metafile, ' from %s' % zf.filename if zf else '', destination))
+
+    fieldnames = get_fieldnames(core)
+    if extensions:
+        extensions = get_extensions(zf.read(metafile) if zf else open(metafile).read())
+        fieldnames += [x.name for x in extensions]
+
+    header = fieldnames + (geometry.GEOMETRY_COLUMNS if geometry_format else [])
+
+    # Creates the writer and writes the header row:
+    out = open(destination, 'wb')
+    if format == 'columnar':
+        dw = columnar.ColumnarWriter(out, header)
+    else:
+        dw = csvu.UnicodeWriter(out, quoting=csv.QUOTE_ALL, buffer_size=csvu.BUFFER_SIZE)
+        dw.writerow(header)
+        dw.flush()
+
+    # Wraps the writer with the validation and geometry stages:
+    rejects = None
+    if validate:
+        rejects_path = '%s.rejects.csv' % os.path.splitext(destination)[0]
+        rejects_out = open(rejects_path, 'wb')
+        rejects = csvu.UnicodeWriter(rejects_out, quoting=csv.QUOTE_ALL)
+        rejects.writerow(fieldnames + ['error'])
+    stages = get_stages(dw, fieldnames, rejects, geometry_format, state)
+    writer = stages[0] if stages else dw
+
+    if extensions:
+        tmpdir = os.path.dirname(os.path.abspath(destination))
+        convert_joined(core, extensions, metafile, writer, zf, tmpdir)
+    elif jobs > 1 and format == 'csv' and not state and \
+            (archive is None or isinstance(archive, basestring)):
+        # Converts parts in a process pool and appends them in order:
+        workspace = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(destination)))
+        parts = get_parts(core, metafile, archive, jobs, workspace, validate, 
+                          geometry_format)
+        logging.info('Converting %s parts with %s jobs' % (len(parts), jobs))
+        # A core without locations has no parts, but the pool needs a process:
+        pool = multiprocessing.Pool(max(1, min(jobs, len(parts))))
+        try:
+            for i, (path, snapshot) in enumerate(pool.imap(convert_part, parts), 1):
+                metrics.METRICS.merge(snapshot)
+                with metrics.timer('append'):
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, out, csvu.BUFFER_SIZE)
+                    os.remove(path)
+                    if validate:
+                        with open(path + '.rejects', 'rb') as f:
+                            shutil.copyfileobj(f, rejects_out, csvu.BUFFER_SIZE)
+                        os.remove(path + '.rejects')
+                logging.info('Converted part %s of %s' % (i, len(parts)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(workspace, ignore_errors=True)
+    else:
+        # Writes CSV data for each input CSV file:
+        progress = metrics.Progress('convert', sum(location_size(x, metafile, zf) 
+                                                   for x in core.locations))
+        for location in core.locations:
+            f = open_location(location, metafile, zf)
+            convert_rows(core, f, writer, progress=progress)
+            f.close()
+        progress.done()
+
+    with metrics.timer('write'):
+        for stage in stages:
+            stage.flush()
+    if validate:
+        rejects_out.close()
+        logging.info('Wrote rejected rows to %s' % rejects_path)
+    if state:
+        deletes_path = '%s.deletes.csv' % os.path.splitext(destination)[0]
+        with open(deletes_path, 'wb') as deletes_out:
+            deletes = csvu.UnicodeWriter(deletes_out, quoting=csv.QUOTE_ALL)
+            deletes.writerow(['id', 'change'] + list(delta.SCOPE_COLUMNS))
+            delta_writer = [x for x in stages if isinstance(x, delta.DeltaWriter)][0]
+            delta_writer.write_removed(deletes)
+        logging.info('Wrote updated and deleted ids to %s' % deletes_path)
+
+    with metrics.timer('write'):
+        if format == 'columnar':
+            dw.close()
+        else:
+            dw.flush()
+    out.close()
+    if zf:
+        zf.close()
+    if format == 'csv':
+        # Writes the schema sidecar used by the loaders:
+        schema.load_schema(destination)
         
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)    
@@ -286,34 +901,103 @@ if __name__ == '__main__':
                       default=None)
     parser.add_option("-u", "--dwca_url", dest="url",
                       help="URL to a Darwin Core Archive")
+    parser.add_option("-a", "--archive", dest="archive",
+                      help="Path to a local Darwin Core Archive zip file",
+                      default=None)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="Number of processes used for conversion",
+                      default=1)
+    parser.add_option("-e", "--extensions", dest="extensions",
+                      action="store_true", default=False,
+                      help="Join extension rows to core rows")
+    parser.add_option("-f", "--format", dest="format", type="choice",
+                      choices=['csv', 'columnar'], default='csv',
+                      help="The output format: csv (default) or columnar")
+    parser.add_option("-V", "--validate", dest="validate",
+                      action="store_true", default=False,
+                      help="Coerce values to their column types and write "
+                      "invalid rows to a .rejects.csv file")
+    parser.add_option("-g", "--geometry", dest="geometry", type="choice",
+                      choices=['ewkb', 'ewkt'], default=None,
+                      help="Add the_geom and the_geom_webmercator columns "
+                      "encoded as ewkb (hex) or ewkt")
+    parser.add_option("-S", "--state", dest="state",
+                      help="The SQLite file holding the state of the last "
+                      "harvest, by default <workspace>/<workspace>.state.sqlite "
+                      "with -u",
+                      default=None)
+    parser.add_option("-D", "--delta", dest="delta",
+                      action="store_true", default=False,
+                      help="Only write the records inserted or updated since "
+                      "the last harvest, and the ids of those updated or "
+                      "deleted to a .deletes.csv file")
+    parser.add_option("-M", "--metrics", dest="metrics",
+                      help="The JSON file the metrics summary is written to, "
+                      "by default <destination>.metrics.json",
+                      default=None)
+    parser.add_option("--profile", dest="profile",
+                      help="Profile the conversion with cProfile and write the "
+                      "stats to this file",
+                      default=None)
+    parser.add_option("--sample", dest="sample", action="store_true", default=False,
+                      help="Profile with the sampling profiler instead, which "
+                      "writes a text report")
     (options, args) = parser.parse_args()
     metafile = options.metafile
     destination = options.destination
+    archive = options.archive
     
     url = options.url
 
+    if options.delta and not (options.state or url):
+        parser.error('--delta requires a --state file')
+
     if url:
-        workspace = url.split('=')[1]
-        os.mkdir(workspace)
-        os.chdir(workspace)
-        destination = '%s.%s' % (workspace, 'csv')
+        workspace = workspace_name(url)
+        # The workspace is kept between harvests for its state file:
+        if not os.path.isdir(workspace):
+            os.mkdir(workspace)
+        destination = os.path.join(workspace, '%s.%s' % 
+                                   (workspace, FORMAT_EXTENSIONS[options.format]))
+        archive = os.path.join(workspace, '%s.zip' % workspace)
+        state = delta.HarvestState(options.state or 
+                                   os.path.join(workspace, '%s.state.sqlite' % workspace))
         logging.info('Downloading DwCA: %s' % url)
         try:
-            response = urllib2.urlopen(options.url)
-            if response.code != 200 and response.code != 304: # OK or NOT MODIFIED
-                print 'Download failed with response code %s' % (name, response.code)
+            code = download(url, archive, state)
+            if code == 304:
+                logging.info('Archive not modified since the last harvest: %s' % url)
+                sys.exit(0)
+            if code != 200: # OK
+                print 'Download failed with response code %s, url: %s' % (code, url)
                 sys.exit(1)
-            open('%s.zip' % workspace, 'w').write(response.read())
-            with zipfile.ZipFile('%s.zip' % workspace) as myzip:
-                myzip.extractall()
-            metafile = 'meta.xml'
             
         except urllib2.HTTPError, e:
             print 'Dowload failed because of HTTPError code: %s, url: %s' % (e.code, url)
         except urllib2.URLError, e:
             print 'Download failed because of URLError reason: %s, url: %s ' % (e.reason, url)
 
-    # Writes the CSV file:
-    writecsv(metafile, destination)
+    elif options.state:
+        state = delta.HarvestState(options.state)
+    else:
+        state = None
+
+    if archive and not destination:
+        destination = '%s.%s' % (os.path.splitext(archive)[0], 
+                                 FORMAT_EXTENSIONS[options.format])
 
+    # Writes the CSV file:
+    with metrics.Profiler(options.profile, options.sample):
+        writecsv(metafile, destination, archive, options.jobs, options.extensions, 
+                 options.format, options.validate, options.geometry,
+                 state if options.delta else None)
+
+    # Only a complete harvest is compared with by the next one:
+    if state:
+        state.commit(replace=options.delta)
+        state.close()
+
+    metrics.METRICS.log_timers()
+    metrics.METRICS.write_summary(options.metrics or '%s.metrics.json' % destination,
+                                  script='dca2csv', destination=destination)
     logging.info('Darwin Core Archive successfully converted.')
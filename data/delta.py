@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports incremental harvests of a Darwin Core Archive.
+
+A HarvestState is a SQLite file kept from one harvest of an archive to the
+next. It holds the ETag and Last-Modified headers of the last download, so an
+archive that has not changed is not downloaded again, and a hash of the
+converted row of every record by id, with its institution and collection codes.
+
+A DeltaWriter compares the rows of a new harvest with those hashes: rows of
+new records (inserted) and of records whose row changed (updated) are written,
+and unchanged rows are dropped. Records of the last harvest that are no longer
+in the archive are deleted. The ids of updated and deleted records are listed
+so that a loader can remove their old rows before it inserts the new ones.
+Ids are only unique within an archive, so each is listed with the codes of
+its old row, which scope it among the rows of other archives.
+
+The new hashes only replace the old ones when commit() is called, once the
+harvest is complete, so a failed harvest is compared with the same state
+when it is run again.
+"""
+
+import hashlib
+import logging
+import metrics
+import sqlite3
+
+from records import RecordBatch
+
+# The number of ids per lookup query (SQLite allows 999 parameters):
+LOOKUP_SIZE = 500
+
+# The default number of rows compared per batch:
+BATCH_SIZE = 10000
+
+# The lowercase names of the columns kept with each id to scope it:
+SCOPE_COLUMNS = ('institutioncode', 'collectioncode')
+
+def record_hash(row):
+    """Returns the hex MD5 digest of a row of UTF-8 strings."""
+    return hashlib.md5('\x00'.join(row)).hexdigest()
+
+class HarvestState(object):
+    """The state of the last complete harvest of one archive."""
+
+    def __init__(self, path):
+        """Opens (or creates) the state.
+
+        Args:
+            path: A string path to the SQLite state file.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Ids are stored as the UTF-8 strings of the converted rows:
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS record (id TEXT PRIMARY KEY, hash TEXT, '
+                        'institutioncode TEXT, collectioncode TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+        # The records of this harvest, with their change if written:
+        self.db.execute('CREATE TEMP TABLE current (id TEXT PRIMARY KEY, hash TEXT, '
+                        'institutioncode TEXT, collectioncode TEXT, change TEXT)')
+        self.db.commit()
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(record)')]
+        if not set(SCOPE_COLUMNS).issubset(columns):
+            self.db.close()
+            raise ValueError('%s has no codes for its records, remove it to harvest '
+                             'the archive from scratch' % path)
+
+    def get_validators(self, url):
+        """Returns the (ETag, Last-Modified) of the last download of a URL.
+
+        Either may be None. Validators are only kept for the URL of the last
+        harvest, so both are None for any other URL.
+        """
+        row = self.db.execute("SELECT value FROM state WHERE key = 'url'").fetchone()
+        if not row or row[0] != url:
+            return None, None
+        return self._get_state('etag'), self._get_state('last_modified')
+
+    def set_validators(self, url, etag, last_modified):
+        """Keeps the validators of a download, saved on commit()."""
+        for key, value in [('url', url), ('etag', etag), ('last_modified', last_modified)]:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def _get_state(self, key):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_records(self):
+        return self.db.execute('SELECT count(*) FROM record').fetchone()[0]
+    records = property(get_records)
+
+    def compare(self, ids, hashes, scopes):
+        """Returns the change of each record of a batch of this harvest.
+
+        Args:
+            ids: A list of record ids.
+            hashes: A list of the record_hash of each record's row.
+            scopes: A list of the tuple of SCOPE_COLUMNS values of each
+                record's row.
+
+        Returns:
+            A list with 'inserted', 'updated' or None (unchanged) per record.
+        """
+        previous = {}
+        for i in range(0, len(ids), LOOKUP_SIZE):
+            batch = ids[i:i + LOOKUP_SIZE]
+            sql = 'SELECT id, hash FROM record WHERE id IN (%s)' % ','.join('?' * len(batch))
+            previous.update(self.db.execute(sql, batch))
+        changes = []
+        for id, hash in zip(ids, hashes):
+            old = previous.get(id)
+            if old is None:
+                changes.append('inserted')
+            elif old != hash:
+                changes.append('updated')
+            else:
+                changes.append(None)
+        self.db.executemany('INSERT OR REPLACE INTO current VALUES (?, ?, ?, ?, ?)',
+                            [(id, hash) + scope + (change,) for id, hash, scope, change
+                             in zip(ids, hashes, scopes, changes)])
+        return changes
+
+    def removed(self):
+        """Yields the (id, change, institutioncode, collectioncode) of updated
+        records and of deleted records.
+
+        Deleted records are those of the last harvest that were not compared
+        in this one. The codes are those of the last harvest's row, which is
+        the one to remove.
+        """
+        for row in self.db.execute("SELECT c.id, c.change, r.institutioncode, r.collectioncode "
+                                   "FROM current c JOIN record r ON r.id = c.id "
+                                   "WHERE c.change = 'updated'"):
+            yield row
+        for row in self.db.execute("SELECT id, 'deleted', institutioncode, collectioncode "
+                                   "FROM record WHERE id NOT IN (SELECT id FROM current)"):
+            yield row
+
+    def commit(self, replace=True):
+        """Saves the state of this harvest.
+
+        Args:
+            replace: True if the records compared in this harvest replace
+                those of the last one, False to only save the validators.
+        """
+        if replace:
+            self.db.execute('DELETE FROM record')
+            self.db.execute('INSERT INTO record SELECT id, hash, institutioncode, '
+                            'collectioncode FROM current')
+        self.db.commit()
+        logging.info('Saved harvest state to %s' % self.path)
+
+    def close(self):
+        self.db.close()
+
+class DeltaWriter(object):
+    """A writer that only writes rows inserted or updated since the last harvest.
+
+    Rows are buffered and compared with the HarvestState in batches, so callers
+    must call flush() when done. Rows without an id can't be compared and are
+    dropped.
+
+    Attributes:
+        counts: A dictionary of the number of rows per change ('inserted',
+            'updated', 'unchanged' and 'no_id').
+    """
+
+    def __init__(self, writer, fieldnames, state, batch_size=BATCH_SIZE):
+        """Constructs a new DeltaWriter.
+
+        Args:
+            writer: The writer for inserted and updated rows.
+            fieldnames: The list of header fieldnames of the rows, the first
+                of which must be the id.
+            state: The HarvestState of the last harvest.
+            batch_size: The integer number of rows per batch.
+        """
+        if not fieldnames or fieldnames[0] != 'id':
+            raise ValueError('Deltas require a core with an <id>')
+        self.writer = writer
+        self.fieldnames = fieldnames
+        self.state = state
+        # The position of each scope column, or None if the rows have none:
+        names = [x.lower() for x in fieldnames]
+        self.scope = [names.index(x) if x in names else None for x in SCOPE_COLUMNS]
+        self.batch_size = batch_size
+        self.rows = []
+        self.counts = dict(inserted=0, updated=0, unchanged=0, no_id=0)
+        if not state.records:
+            logging.warning('No previous harvest in %s, every record is inserted' %
+                            state.path)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self, batch):
+        """Compares a records.RecordBatch and writes its changed rows."""
+        self.flush()
+        ids = batch.column(0)
+        if not all(ids):
+            batch = batch.take([n for n, id in enumerate(ids) if id])
+            self.count('no_id', len(ids) - len(batch))
+            ids = batch.column(0)
+        scopes = zip(*[[''] * len(batch) if i is None else batch.column(i)
+                       for i in self.scope])
+        changes = self.state.compare(ids, map(record_hash, batch.rows()), scopes)
+        changed = [n for n, change in enumerate(changes) if change]
+        for change in ('inserted', 'updated'):
+            self.count(change, changes.count(change))
+        self.count('unchanged', len(batch) - len(changed))
+        if len(changed) < len(batch):
+            batch = batch.take(changed)
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        """Compares and writes the buffered rows."""
+        rows, self.rows = self.rows, []
+        if rows:
+            self.write_batch(RecordBatch.from_rows(self.fieldnames, rows))
+
+    def count(self, change, n):
+        self.counts[change] += n
+        metrics.count('delta.%s' % change, n)
+
+    def write_removed(self, writer):
+        """Writes the (id, change, institutioncode, collectioncode) of updated
+        and deleted records to a writer.
+
+        Returns:
+            The integer number of deleted records.
+        """
+        deleted = 0
+        for id, change, institutioncode, collectioncode in self.state.removed():
+            writer.writerow([id, change, institutioncode, collectioncode])
+            if change == 'deleted':
+                deleted += 1
+        metrics.count('delta.deleted', deleted)
+        if self.counts['no_id']:
+            logging.warning('Dropped %s rows without an id' % self.counts['no_id'])
+        logging.info('Delta: %s inserted, %s updated, %s deleted, %s unchanged' % (
+            self.counts['inserted'], self.counts['updated'], deleted,
+            self.counts['unchanged']))
+        return deleted
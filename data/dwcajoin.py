@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports joining Darwin Core Archive extension rows to core rows.
+
+Rows are lists of strings and are joined on a key column with a streaming
+sort-merge. Inputs that are not already sorted by key are sorted first, in
+memory if they fit in a single run and otherwise with an external merge sort
+that spills sorted runs to temporary files.
+"""
+
+import heapq
+import logging
+import marshal
+import tempfile
+
+from itertools import groupby
+from operator import itemgetter
+
+# The default number of rows sorted in memory before a run is spilled to disk:
+RUN_SIZE = 500000
+
+def is_sorted(rows, key=0):
+    """Returns True if rows are in ascending order of the key column."""
+    previous = None
+    for row in rows:
+        value = row[key]
+        if previous is not None and value < previous:
+            return False
+        previous = value
+    return True
+
+def _spill(rows, tmpdir):
+    """Writes rows to a temporary file and returns the open file."""
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    for row in rows:
+        marshal.dump(row, f)
+    f.seek(0)
+    return f
+
+def _load(f):
+    """Yields the rows written to a file by _spill, then closes it."""
+    try:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                break
+    finally:
+        f.close()
+
+def external_sort(rows, key=0, run_size=RUN_SIZE, tmpdir=None):
+    """Yields rows in ascending order of the key column with bounded memory.
+
+    Args:
+        rows: An iterable of rows (lists of strings).
+        key: The integer index of the key column.
+        run_size: The integer maximum number of rows held in memory.
+        tmpdir: An optional string path to a directory for spilled runs.
+    """
+    getkey = itemgetter(key)
+    runs = []
+    run = []
+    for row in rows:
+        run.append(row)
+        if len(run) >= run_size:
+            run.sort(key=getkey)
+            runs.append(_spill(run, tmpdir))
+            run = []
+    run.sort(key=getkey)
+    if not runs:
+        for row in run:
+            yield row
+        return
+    if run:
+        runs.append(_spill(run, tmpdir))
+    logging.info('Merging %s sorted runs of %s rows' % (len(runs), run_size))
+    decorated = [((getkey(row), i, row) for i, row in enumerate(_load(f)))
+                 for f in runs]
+    for value, i, row in heapq.merge(*decorated):
+        yield row
+
+def sorted_rows(rows, key=0, presorted=False, run_size=RUN_SIZE, tmpdir=None):
+    """Returns rows in ascending order of the key column.
+
+    If presorted is True the rows are streamed through unchanged, otherwise they
+    are sorted with external_sort.
+    """
+    if presorted:
+        return iter(rows)
+    return external_sort(rows, key, run_size, tmpdir)
+
+def merge_join(core, extensions, key=0):
+    """Left joins extension rows to core rows with a streaming sort-merge.
+
+    Both core and extension rows must be in ascending order of their key.
+
+    Args:
+        core: An iterable of core rows sorted by the key column.
+        extensions: A list of (rows, key) tuples, one per extension, where rows
+            is an iterable sorted by the integer key column.
+        key: The integer index of the key column in core rows.
+
+    Yields:
+        (core_row, groups) tuples where groups holds one list of matching
+        extension rows per extension, in the order given.
+    """
+    groups = [groupby(rows, itemgetter(k)) for rows, k in extensions]
+    heads = [next(g, None) for g in groups]
+    # The most recent (key, rows) match per extension, for repeated core keys:
+    current = [(None, [])] * len(groups)
+    for row in core:
+        value = row[key]
+        matches = []
+        for i, g in enumerate(groups):
+            if current[i][0] != value:
+                # Skips over extension rows with no core row:
+                while heads[i] is not None and heads[i][0] < value:
+                    heads[i] = next(g, None)
+                if heads[i] is not None and heads[i][0] == value:
+                    current[i] = (value, list(heads[i][1]))
+                    heads[i] = next(g, None)
+                else:
+                    current[i] = (value, [])
+            matches.append(current[i][1])
+        yield row, matches
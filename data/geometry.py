@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports precomputing the geometry columns of occurrences.
+
+The the_geom column holds a WGS84 point (SRID 4326) and the_geom_webmercator
+the same point projected to Web Mercator (SRID 3857). Both are computed from
+decimallatitude and decimallongitude and written as hex EWKB, which PostGIS
+reads directly as a geometry value, or as EWKT. Coordinates that are missing,
+can't be parsed, or are out of range leave both columns empty.
+
+Points are computed in batches one column at a time, so the coordinate
+columns are parsed in one pass and each point is packed with a precompiled
+struct.
+"""
+
+import binascii
+import logging
+import math
+import struct
+
+from records import Constant, RecordBatch
+
+# The geometry columns added to rows:
+GEOMETRY_COLUMNS = ['the_geom', 'the_geom_webmercator']
+
+# The default number of rows per batch:
+BATCH_SIZE = 10000
+
+WGS84_SRID = 4326
+WEB_MERCATOR_SRID = 3857
+
+# The Web Mercator half-width in meters, and the latitude where it is square:
+MERCATOR_EXTENT = 20037508.342789244
+MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+# A little-endian EWKB point with an SRID: byte order, type, SRID, x, y:
+EWKB_POINT = struct.Struct('<BIIdd')
+EWKB_POINT_SRID = 0x20000001
+
+def parse_coordinates(latitudes, longitudes):
+    """Returns a list of (lon, lat) floats, or None where a pair is invalid.
+
+    Args:
+        latitudes: A list of decimal latitude strings.
+        longitudes: A list of decimal longitude strings of the same length.
+    """
+    points = []
+    for lat, lon in zip(latitudes, longitudes):
+        try:
+            lat = float(lat)
+            lon = float(lon)
+        except ValueError:
+            points.append(None)
+            continue
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            points.append((lon, lat))
+        else:
+            points.append(None)
+    return points
+
+def to_web_mercator(points):
+    """Returns a list of Web Mercator (x, y) meters for (lon, lat) points.
+
+    Latitudes are clamped to the extent of the projection, which can't
+    represent the poles.
+    """
+    scale = MERCATOR_EXTENT / 180.0
+    projected = []
+    for point in points:
+        if point is None:
+            projected.append(None)
+            continue
+        lon, lat = point
+        lat = max(-MERCATOR_MAX_LATITUDE, min(MERCATOR_MAX_LATITUDE, lat))
+        y = math.log(math.tan((90 + lat) * math.pi / 360)) / (math.pi / 180)
+        projected.append((lon * scale, y * scale))
+    return projected
+
+def ewkb(points, srid):
+    """Returns a list of hex EWKB strings ('' where a point is None)."""
+    pack = EWKB_POINT.pack
+    return [binascii.hexlify(pack(1, EWKB_POINT_SRID, srid, p[0], p[1])).upper()
+            if p is not None else '' for p in points]
+
+def ewkt(points, srid):
+    """Returns a list of EWKT strings ('' where a point is None)."""
+    return ['SRID=%d;POINT(%r %r)' % (srid, p[0], p[1]) if p is not None else ''
+            for p in points]
+
+# Geometry encodings by name:
+FORMATS = {'ewkb': ewkb, 'ewkt': ewkt}
+
+def geometry_columns(latitudes, longitudes, format='ewkb'):
+    """Returns the (the_geom, the_geom_webmercator) value lists for a batch.
+
+    Args:
+        latitudes: A list of decimal latitude strings.
+        longitudes: A list of decimal longitude strings of the same length.
+        format: The string geometry encoding, 'ewkb' or 'ewkt'.
+    """
+    encode = FORMATS[format]
+    points = parse_coordinates(latitudes, longitudes)
+    return (encode(points, WGS84_SRID),
+            encode(to_web_mercator(points), WEB_MERCATOR_SRID))
+
+class GeometryWriter(object):
+    """A writer that appends the geometry columns to rows written to another.
+
+    Rows are buffered and their geometry computed in batches, so callers must
+    call flush() when done.
+
+    Attributes:
+        missing: The integer number of rows written without a geometry.
+    """
+
+    def __init__(self, writer, fieldnames, format='ewkb', batch_size=BATCH_SIZE):
+        """Constructs a new GeometryWriter.
+
+        Args:
+            writer: The writer for rows with geometry columns.
+            fieldnames: The list of header fieldnames of the rows, without the
+                geometry columns.
+            format: The string geometry encoding, 'ewkb' or 'ewkt'.
+            batch_size: The integer number of rows per batch.
+        """
+        columns = dict((x.strip().lower(), i) for i, x in enumerate(fieldnames))
+        self.lat = columns.get('decimallatitude')
+        self.lon = columns.get('decimallongitude')
+        if self.lat is None or self.lon is None:
+            logging.warning('No decimalLatitude and decimalLongitude columns, '
+                            'geometry columns will be empty')
+        self.writer = writer
+        self.fieldnames = fieldnames
+        self.format = format
+        self.batch_size = batch_size
+        self.rows = []
+        self.missing = 0
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self, batch):
+        """Appends the geometry columns to a records.RecordBatch and writes it."""
+        self.flush()
+        if self.lat is None or self.lon is None:
+            the_geom, webmercator = Constant(''), Constant('')
+            self.missing += len(batch)
+        else:
+            the_geom, webmercator = geometry_columns(batch.column(self.lat),
+                                                     batch.column(self.lon), self.format)
+            self.missing += the_geom.count('')
+        batch.append(GEOMETRY_COLUMNS[0], the_geom)
+        batch.append(GEOMETRY_COLUMNS[1], webmercator)
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        """Computes the geometry of the buffered rows and writes them."""
+        rows, self.rows = self.rows, []
+        if rows:
+            self.write_batch(RecordBatch.from_rows(self.fieldnames, rows))
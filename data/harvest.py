@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports harvesting many Darwin Core Archives at once.
+
+Each source is an archive URL, e.g., an IPT archive.do URL, or the path to a
+local zip file. Every archive is converted by dca2csv.writecsv in its own
+workspace directory under the harvest directory, named as dca2csv.py names it,
+so archives never share files and the working directory never changes.
+
+Downloads wait on the network, so they run in a small pool of threads. Each
+archive is converted in a pool of processes as soon as its download is done,
+while other downloads continue. As with dca2csv.py -u, each workspace keeps a
+state file, so an archive that has not changed since the last harvest is not
+downloaded or converted again, and --delta writes only the changed records.
+
+When all archives are done the status of each one is logged and written to a
+JSON report.
+
+Usage:
+    python harvest.py -l urls.txt -w harvest -n 8 -j 4
+"""
+
+import delta
+import dca2csv
+import json
+import logging
+import metrics
+import multiprocessing
+import os
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+from urlparse import urlparse
+
+# The default number of concurrent downloads:
+DOWNLOADS = 4
+
+def is_url(source):
+    return urlparse(source).scheme in ('http', 'https', 'ftp')
+
+def read_sources(path):
+    """Returns the sources listed one per line in a file, skipping # comments."""
+    with open(path) as f:
+        lines = [x.split('#', 1)[0].strip() for x in f]
+    return [x for x in lines if x]
+
+class Harvest(object):
+    """The harvest of one archive.
+
+    Attributes:
+        source: The string archive URL or path.
+        name: The string workspace name.
+        workspace: The string path to the workspace directory.
+        archive: The string path to the archive zip file.
+        destination: The string path to the output file.
+        state: The string path to the delta.HarvestState file.
+        status: The string status: pending, not_modified, converted or failed.
+        error: The string error message if failed.
+        seconds: A dictionary of the seconds taken by download and convert.
+        counters: A dictionary of the metrics counters of the conversion.
+        result: The multiprocessing AsyncResult of the conversion, if started.
+    """
+
+    def __init__(self, source, root, format='csv'):
+        """Constructs a new Harvest.
+
+        Args:
+            source: The string archive URL or path.
+            root: The string path to the harvest directory.
+            format: The string output format (see dca2csv.FORMAT_EXTENSIONS).
+        """
+        self.source = source
+        self.name = dca2csv.workspace_name(source)
+        self.workspace = os.path.join(root, self.name)
+        if is_url(source):
+            self.archive = os.path.join(self.workspace, '%s.zip' % self.name)
+        else:
+            self.archive = source
+        self.destination = os.path.join(
+            self.workspace, '%s.%s' % (self.name, dca2csv.FORMAT_EXTENSIONS[format]))
+        self.state = os.path.join(self.workspace, '%s.state.sqlite' % self.name)
+        self.status = 'pending'
+        self.error = None
+        self.seconds = {}
+        self.counters = {}
+        self.result = None
+        self.began = None
+
+    def fail(self, stage, error):
+        self.status = 'failed'
+        self.error = '%s failed: %s' % (stage, error)
+        logging.error('%s: %s' % (self.name, self.error))
+
+    def to_json(self):
+        return dict(source=self.source, name=self.name, status=self.status,
+                    error=self.error, destination=self.destination,
+                    seconds=self.seconds, counters=self.counters)
+
+def convert_archive(task):
+    """Converts one archive in a worker process, returning errors instead of raising them.
+
+    Args:
+        task: A (source, archive, destination, state, validators, options)
+            tuple where state is the string path to the harvest state file,
+            validators the (ETag, Last-Modified) of the download or None, and
+            options a dictionary of extensions, format, validate, geometry and
+            delta (see dca2csv.writecsv).
+
+    Returns:
+        An (error message or None, metrics snapshot) tuple.
+    """
+    source, archive, destination, state_path, validators, options = task
+    # Workers are reused, so only this archive is counted:
+    metrics.METRICS.reset()
+    state = None
+    try:
+        state = delta.HarvestState(state_path)
+        if validators:
+            state.set_validators(source, *validators)
+        # Archives are converted in parallel, so each one in a single process:
+        dca2csv.writecsv(None, destination, archive, 1, options['extensions'],
+                         options['format'], options['validate'], options['geometry'],
+                         state if options['delta'] else None)
+        state.commit(replace=options['delta'])
+    except Exception, e:
+        logging.exception('Failed to convert %s' % source)
+        return '%s: %s' % (e.__class__.__name__, e), metrics.METRICS.snapshot()
+    finally:
+        if state:
+            state.close()
+    return None, metrics.METRICS.snapshot()
+
+def fetch(harvest):
+    """Downloads the archive of a harvest if it changed since the last harvest.
+
+    Returns:
+        The (ETag, Last-Modified) of the download, or None if the archive is
+        not a URL or failed or was not modified, in which case harvest.status is
+        updated.
+    """
+    if not os.path.isdir(harvest.workspace):
+        os.makedirs(harvest.workspace)
+    if not is_url(harvest.source):
+        return None
+    logging.info('Downloading %s' % harvest.source)
+    began = time.time()
+    state = None
+    try:
+        state = delta.HarvestState(harvest.state)
+        code = dca2csv.download(harvest.source, harvest.archive, state)
+        # The new validators are only saved once the archive is converted:
+        validators = state.get_validators(harvest.source)
+    except Exception, e:
+        # One unreachable provider must not stop the others:
+        harvest.fail('download', e)
+        return None
+    finally:
+        if state:
+            state.close()
+        harvest.seconds['download'] = time.time() - began
+    if code == 304:
+        harvest.status = 'not_modified'
+        logging.info('%s not modified since the last harvest' % harvest.name)
+    elif code != 200:
+        harvest.fail('download', 'HTTP response code %s' % code)
+    return validators
+
+def harvest_all(sources, root, downloads=DOWNLOADS, jobs=None, extensions=False,
+                format='csv', validate=False, geometry_format=None, write_delta=False):
+    """Harvests many archives with concurrent downloads and conversions.
+
+    Args:
+        sources: A list of string archive URLs or paths.
+        root: A string path to the directory of the workspaces.
+        downloads: The integer number of concurrent downloads.
+        jobs: The integer number of concurrent conversions (by default the
+            number of CPUs).
+        extensions, format, validate, geometry_format: As for dca2csv.writecsv.
+        write_delta: True to write only the records changed since the last
+            harvest.
+
+    Returns:
+        The list of Harvest, in the order of sources.
+    """
+    harvests = [Harvest(x, root, format) for x in sources]
+    names = [x.name for x in harvests]
+    duplicates = sorted(set(x for x in names if names.count(x) > 1))
+    if duplicates:
+        raise ValueError('Sources share workspace names: %s' % ', '.join(duplicates))
+    options = dict(extensions=extensions, format=format, validate=validate,
+                   geometry=geometry_format, delta=write_delta)
+
+    # The process pool is created before any thread starts, since it forks:
+    converters = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    downloaders = ThreadPool(downloads)
+
+    def download_and_submit(harvest):
+        validators = fetch(harvest)
+        if harvest.status == 'pending':
+            harvest.began = time.time()
+            harvest.result = converters.apply_async(convert_archive, [(
+                harvest.source, harvest.archive, harvest.destination, harvest.state,
+                validators, options)])
+
+    try:
+        downloaders.map(download_and_submit, harvests, chunksize=1)
+        downloaders.close()
+        for i, harvest in enumerate(harvests, 1):
+            if not harvest.result:
+                continue
+            error, snapshot = harvest.result.get()
+            harvest.seconds['convert'] = time.time() - harvest.began
+            harvest.counters = snapshot['counters']
+            metrics.METRICS.merge(snapshot)
+            if error:
+                harvest.fail('convert', error)
+            else:
+                harvest.status = 'converted'
+                logging.info('Converted %s (%s of %s)' % (harvest.name, i, len(harvests)))
+        converters.close()
+    finally:
+        downloaders.terminate()
+        converters.terminate()
+        converters.join()
+    return harvests
+
+def report(harvests):
+    """Logs the status of each harvest and returns a dictionary of counts."""
+    counts = dict((x, 0) for x in ['converted', 'not_modified', 'failed'])
+    for harvest in harvests:
+        counts[harvest.status] += 1
+        detail = harvest.error or ''
+        if harvest.status == 'converted':
+            detail = '%s rows' % harvest.counters.get('convert.rows', 0)
+            if 'delta.inserted' in harvest.counters:
+                detail += ', delta %s inserted, %s updated, %s deleted' % tuple(
+                    harvest.counters.get('delta.%s' % x, 0)
+                    for x in ('inserted', 'updated', 'deleted'))
+        logging.info('%-30s %-13s %6.1fs  %s' % (
+            harvest.name, harvest.status, sum(harvest.seconds.values()), detail))
+    logging.info('Harvested %s archives: %s converted, %s not modified, %s failed' % (
+        len(harvests), counts['converted'], counts['not_modified'], counts['failed']))
+    return counts
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+
+    parser = OptionParser(usage='%prog [options] [URL or path ...]')
+    parser.add_option("-l", "--list", dest="list",
+                      help="A file listing archive URLs or paths, one per line",
+                      default=None)
+    parser.add_option("-w", "--workspace", dest="workspace",
+                      help="The directory of the archive workspaces",
+                      default=".")
+    parser.add_option("-n", "--downloads", dest="downloads", type="int",
+                      help="The number of concurrent downloads",
+                      default=DOWNLOADS)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="The number of concurrent conversions, by default "
+                      "the number of CPUs",
+                      default=None)
+    parser.add_option("-e", "--extensions", dest="extensions",
+                      action="store_true", default=False,
+                      help="Join extension rows to core rows")
+    parser.add_option("-f", "--format", dest="format", type="choice",
+                      choices=['csv', 'columnar'], default='csv',
+                      help="The output format: csv (default) or columnar")
+    parser.add_option("-V", "--validate", dest="validate",
+                      action="store_true", default=False,
+                      help="Coerce values to their column types and write "
+                      "invalid rows to a .rejects.csv file")
+    parser.add_option("-g", "--geometry", dest="geometry", type="choice",
+                      choices=['ewkb', 'ewkt'], default=None,
+                      help="Add the_geom and the_geom_webmercator columns "
+                      "encoded as ewkb (hex) or ewkt")
+    parser.add_option("-D", "--delta", dest="delta",
+                      action="store_true", default=False,
+                      help="Only write the records inserted or updated since "
+                      "the last harvest of each archive")
+    parser.add_option("-r", "--report", dest="report",
+                      help="The JSON status report, by default "
+                      "<workspace>/harvest.json",
+                      default=None)
+    (options, args) = parser.parse_args()
+
+    sources = args + (read_sources(options.list) if options.list else [])
+    if not sources:
+        parser.error('No archive URLs or paths given')
+
+    began = time.time()
+    try:
+        harvests = harvest_all(sources, options.workspace, options.downloads,
+                               options.jobs, options.extensions, options.format,
+                               options.validate, options.geometry, options.delta)
+    except ValueError, e:
+        parser.error(str(e))
+    counts = report(harvests)
+
+    path = options.report or os.path.join(options.workspace, 'harvest.json')
+    with open(path, 'w') as f:
+        json.dump(dict(elapsed=time.time() - began, counts=counts,
+                       metrics=metrics.METRICS.snapshot(),
+                       archives=[x.to_json() for x in harvests]),
+                  f, indent=2, sort_keys=True)
+    logging.info('Wrote harvest report to %s' % path)
+    if counts['failed']:
+        sys.exit(1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports resuming interrupted uploads from a checkpoint journal.
+
+The journal is a SQLite file that records each completed batch by key. Batches
+read from a range of the source CSV file have keys of the form
+"stage:start:end" with the byte offsets of their rows, so an upload can resume
+from the end of the longest run of completed batches. The journal also keeps
+the taxon names scanned from the CSV file so that a restart skips the scan.
+
+A journal belongs to one version of a source file: if the file size or
+modification time changes, the journal is cleared.
+
+The journal implements the done() and record() methods of an
+IdempotencyLedger so that it can be used as the ledger of a RetryPolicy.
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+
+def batch_key(stage, start, end):
+    """Returns the journal key of a batch of rows from a range of offsets."""
+    return '%s:%d:%d' % (stage, start, end)
+
+class Journal(object):
+    """A checkpoint journal of completed batches for one source file."""
+
+    def __init__(self, path, source):
+        """Opens (or creates) the journal.
+
+        Args:
+            path: A string path to the SQLite journal file.
+            source: A string path to the source CSV file.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS batch (key TEXT PRIMARY KEY, '
+                        'stage TEXT, start INTEGER, end INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS taxon (concept TEXT, name TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+        stat = os.stat(source)
+        version = '%s:%d:%d' % (os.path.abspath(source), stat.st_size, int(stat.st_mtime))
+        row = self.db.execute("SELECT value FROM state WHERE key = 'source'").fetchone()
+        if row and row[0] != version:
+            logging.info('Source changed, clearing journal %s' % path)
+            for table in ['batch', 'taxon', 'state']:
+                self.db.execute('DELETE FROM %s' % table)
+        self.db.execute("INSERT OR REPLACE INTO state VALUES ('source', ?)", (version,))
+        self.db.commit()
+
+    def done(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM batch WHERE key = ?',
+                                   (key,)).fetchone() is not None
+
+    def record(self, key):
+        """Records a completed batch and commits it to disk."""
+        parts = key.split(':')
+        if len(parts) == 3:
+            stage, start, end = parts[0], int(parts[1]), int(parts[2])
+        else:
+            stage, start, end = None, None, None
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO batch VALUES (?, ?, ?, ?)',
+                            (key, stage, start, end))
+            self.db.commit()
+
+    def committed_offset(self, stage, start):
+        """Returns the end of the completed batches of a stage that follow start.
+
+        Batches may complete out of order, so this is the offset up to which
+        every batch is complete, and where the stage should resume.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT start, end FROM batch WHERE stage = ? '
+                                   'AND start >= ? ORDER BY start', (stage, start))
+            for batch_start, batch_end in rows:
+                if batch_start != start:
+                    break
+                start = batch_end
+        return start
+
+    def save_taxons(self, taxons):
+        """Saves a multimap of taxon concept to set of names."""
+        with self.lock:
+            self.db.execute('DELETE FROM taxon')
+            for concept, names in taxons.iteritems():
+                self.db.executemany('INSERT INTO taxon VALUES (?, ?)',
+                                    ((concept, x) for x in names))
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('taxons', 1)")
+            self.db.commit()
+
+    def load_taxons(self):
+        """Returns the saved multimap of taxon concept to set of names, or None."""
+        with self.lock:
+            if not self.db.execute("SELECT 1 FROM state WHERE key = 'taxons'").fetchone():
+                return None
+            taxons = collections.defaultdict(set)
+            for concept, name in self.db.execute('SELECT concept, name FROM taxon'):
+                taxons[concept].add(name)
+        return taxons
+
+    def close(self):
+        self.db.close()
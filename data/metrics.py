@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports lightweight metrics for the ingest scripts.
+
+A Metrics registry holds named counters, timers and latency histograms, and is
+safe to share between threads. Most code uses the module-level METRICS, e.g.:
+
+    with metrics.timer('parse'):
+        core = parse_metafile(metafile)
+    metrics.count('retries')
+
+Worker processes have their own registry: they send a snapshot() back with
+their results, and the parent merges it.
+
+Progress logs rows/s and bytes/s at most every PROGRESS_INTERVAL seconds, and
+a JSON summary of the whole registry can be written when a run ends. A
+Profiler runs code under cProfile, or under a sampling profiler that counts
+the functions on the stack at regular intervals.
+"""
+
+import cProfile
+import collections
+import json
+import logging
+import signal
+import threading
+import time
+
+from contextlib import contextmanager
+from itertools import chain, imap, islice
+
+# The upper bounds in seconds of the latency histogram buckets:
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# The minimum number of seconds between progress log lines:
+PROGRESS_INTERVAL = 10.0
+
+# The number of lines a MeteredFile counts at once:
+METERED_BLOCK_LINES = 1000
+
+# The number of seconds between stack samples of the sampling profiler:
+SAMPLE_INTERVAL = 0.005
+
+class Histogram(object):
+    """Counts observed values in buckets with fixed upper bounds.
+
+    Attributes:
+        counts: The list of counts per bucket, plus one for larger values.
+        count: The integer number of values observed.
+        total: The sum of the values observed.
+        max: The largest value observed.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_json(self):
+        return dict(buckets=self.buckets, counts=self.counts, count=self.count,
+                    total=self.total, max=self.max,
+                    mean=self.total / self.count if self.count else None,
+                    p50=self.quantile(0.5), p95=self.quantile(0.95),
+                    p99=self.quantile(0.99))
+
+    def merge(self, value):
+        """Adds the counts of a histogram given as to_json()."""
+        self.counts = [x + y for x, y in zip(self.counts, value['counts'])]
+        self.count += value['count']
+        self.total += value['total']
+        self.max = max(self.max, value['max'])
+
+class Metrics(object):
+    """A registry of counters, timers and histograms by name.
+
+    Timers hold the number of timed blocks and their total seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.reset()
+
+    def reset(self):
+        """Clears all metrics."""
+        with self.lock:
+            self.counters = collections.defaultdict(int)
+            self.timers = collections.defaultdict(lambda: [0, 0.0])
+            self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds, n=1):
+        with self.lock:
+            timer = self.timers[name]
+            timer[0] += n
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Adds the time spent in a with block to a timer."""
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - began)
+
+    def observe(self, name, value):
+        """Adds a value, e.g., a latency in seconds, to a histogram."""
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """Returns the metrics as a dictionary of plain values."""
+        with self.lock:
+            return dict(
+                counters=dict(self.counters),
+                timers=dict((k, dict(count=v[0], seconds=v[1]))
+                            for k, v in self.timers.iteritems()),
+                histograms=dict((k, v.to_json()) for k, v in self.histograms.iteritems()))
+
+    def merge(self, snapshot):
+        """Adds the metrics of a snapshot, e.g., from a worker process."""
+        with self.lock:
+            for name, n in snapshot['counters'].iteritems():
+                self.counters[name] += n
+            for name, value in snapshot['timers'].iteritems():
+                timer = self.timers[name]
+                timer[0] += value['count']
+                timer[1] += value['seconds']
+            for name, value in snapshot['histograms'].iteritems():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(value['buckets'])
+                self.histograms[name].merge(value)
+
+    def summary(self, **extra):
+        """Returns a snapshot with the elapsed seconds and any extra values."""
+        summary = self.snapshot()
+        summary['elapsed'] = time.time() - self.started
+        summary.update(extra)
+        return summary
+
+    def log_timers(self):
+        """Logs the total seconds of each timer, slowest first."""
+        with self.lock:
+            timers = sorted(self.timers.items(), key=lambda x: -x[1][1])
+        if timers:
+            logging.info('Stage times: %s' % ', '.join('%s %.2fs' % (name, seconds)
+                                                      for name, (n, seconds) in timers))
+
+    def write_summary(self, path, **extra):
+        """Writes the summary() to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.summary(**extra), f, indent=2, sort_keys=True)
+        logging.info('Wrote metrics summary to %s' % path)
+
+# The registry used by the ingest scripts:
+METRICS = Metrics()
+
+count = METRICS.count
+add_time = METRICS.add_time
+timer = METRICS.timer
+observe = METRICS.observe
+
+def observe_request(seconds, status):
+    """Records one CartoDB SQL API request, for use as a CartoDB observer."""
+    METRICS.observe('sql.latency', seconds)
+    METRICS.count('sql.requests')
+    if status != '200':
+        METRICS.count('sql.errors')
+
+def observe_retry(attempt, error):
+    """Records one retry, for use as a RetryPolicy observer."""
+    METRICS.count('sql.retries')
+
+class Progress(object):
+    """Counts the rows and bytes of a stage and logs their rate.
+
+    Attributes:
+        rows: The integer number of rows so far.
+        bytes: The integer number of bytes so far.
+    """
+
+    def __init__(self, name, total_bytes=None, interval=PROGRESS_INTERVAL,
+                 metrics=METRICS):
+        """Constructs a new Progress.
+
+        Args:
+            name: The string name of the stage, used as the prefix of its
+                <name>.rows and <name>.bytes counters.
+            total_bytes: The optional expected number of bytes.
+            interval: The float minimum number of seconds between log lines.
+            metrics: The Metrics registry to count rows and bytes in.
+        """
+        self.name = name
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.metrics = metrics
+        self.rows = 0
+        self.bytes = 0
+        self.began = time.time()
+        self.logged = self.began
+
+    def update(self, rows=0, bytes=0):
+        """Adds rows and bytes, logging the rates if interval has passed."""
+        self.rows += rows
+        self.bytes += bytes
+        self.metrics.count('%s.rows' % self.name, rows)
+        self.metrics.count('%s.bytes' % self.name, bytes)
+        now = time.time()
+        if now - self.logged >= self.interval:
+            self.logged = now
+            self.log(now)
+
+    def log(self, now=None):
+        elapsed = (now or time.time()) - self.began
+        percent = ''
+        if self.total_bytes:
+            percent = ', %.0f%%' % (100.0 * self.bytes / self.total_bytes)
+        logging.info('%s: %s rows (%.0f rows/s), %.1f MB (%.2f MB/s)%s' % (
+            self.name, self.rows, self.rows / elapsed if elapsed else 0,
+            self.bytes / 1e6, self.bytes / 1e6 / elapsed if elapsed else 0, percent))
+
+    def done(self):
+        """Logs the final rates."""
+        self.log()
+
+class MeteredFile(object):
+    """A read-only file wrapper that counts the bytes read from file "f".
+
+    Attributes:
+        bytes: The integer number of bytes read so far.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self.f.readline(size)
+        self.bytes += len(line)
+        return line
+
+    def __iter__(self):
+        # Counts lines in blocks, so each line is passed through without a call:
+        return chain.from_iterable(self._blocks())
+
+    def _blocks(self):
+        lines = iter(self.f)
+        while True:
+            block = list(islice(lines, METERED_BLOCK_LINES))
+            if not block:
+                break
+            self.bytes += sum(imap(len, block))
+            yield block
+
+    def close(self):
+        self.f.close()
+
+class Sampler(object):
+    """A sampling profiler that counts the functions on the main thread's stack.
+
+    Samples are taken on SIGPROF, so they are spread over CPU time, and only
+    work in the main thread on Unix.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.own = collections.Counter() # the function running
+        self.total = collections.Counter() # every function on the stack
+
+    def sample(self, signum, frame):
+        self.samples += 1
+        seen = set()
+        own = True
+        while frame is not None:
+            code = frame.f_code
+            key = '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+            if own:
+                self.own[key] += 1
+                own = False
+            if key not in seen:
+                self.total[key] += 1
+                seen.add(key)
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path, limit=50):
+        """Writes the functions with the most samples to a text file."""
+        with open(path, 'w') as f:
+            f.write('%s samples every %ss of CPU time\n\n' % (self.samples, self.interval))
+            f.write('%8s %8s  %s\n' % ('own', 'total', 'function'))
+            for key, n in self.total.most_common(limit):
+                f.write('%8d %8d  %s\n' % (self.own[key], n, key))
+
+class Profiler(object):
+    """Profiles the code run between start() and stop(), or in a with block.
+
+    The results are written to path when stopped: pstats data for cProfile,
+    or a text report for the Sampler. Without a path nothing is profiled.
+    """
+
+    def __init__(self, path=None, sampling=False):
+        """Constructs a new Profiler.
+
+        Args:
+            path: An optional string path for the results.
+            sampling: True to use the Sampler, which has less overhead than
+                cProfile but only samples the main thread.
+        """
+        self.path = path
+        self.sampling = sampling
+        self.profiler = None
+
+    def start(self):
+        if not self.path:
+            return
+        if self.sampling:
+            self.profiler = Sampler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if not self.profiler:
+            return
+        if self.sampling:
+            self.profiler.stop()
+            self.profiler.write(self.path)
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+        self.profiler = None
+        logging.info('Wrote profile to %s' % self.path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
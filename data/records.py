@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports passing rows between stages in columnar batches.
+
+A RecordBatch holds a batch of rows with a fixed list of fieldnames as one
+list of values per column. Readers transpose rows into columns once, and then
+each stage works on whole columns: validation coerces the distinct values of
+a column, geometry reads the coordinate columns and appends two more, and
+writers encode a column at a time. Columns that have the same value in every
+row, such as the defaults of a core, are stored once as a Constant.
+
+Rows are only rebuilt, as tuples, where a whole row is needed, e.g., by the
+csv module.
+"""
+
+from itertools import islice, izip, repeat
+
+# The default number of rows per batch:
+BATCH_SIZE = 5000
+
+class Constant(object):
+    """A column with the same value in every row of a batch."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class RecordBatch(object):
+    """A batch of rows held as columns.
+
+    Attributes:
+        fieldnames: The list of column names.
+        columns: The list of columns, each a sequence of one value per row
+            or a Constant.
+    """
+
+    def __init__(self, fieldnames, columns, size):
+        """Constructs a new RecordBatch.
+
+        Args:
+            fieldnames: The list of column names.
+            columns: The list of columns, one per fieldname.
+            size: The integer number of rows.
+        """
+        self.fieldnames = fieldnames
+        self.columns = columns
+        self.size = size
+
+    @classmethod
+    def from_rows(cls, fieldnames, rows, indexes=None, constants=()):
+        """Returns a RecordBatch of a list of rows.
+
+        Args:
+            fieldnames: The list of column names.
+            rows: A list of rows, each a sequence of values. Rows shorter than
+                the others are padded with ''.
+            indexes: An optional list of the position in each row of each
+                column, by default the first len(fieldnames) - len(constants).
+            constants: The values of the last columns, which are the same for
+                every row.
+        """
+        if indexes is None:
+            indexes = range(len(fieldnames) - len(constants))
+        width = max(indexes) + 1 if indexes else 0
+        if rows and min(map(len, rows)) < width:
+            padding = ('',) * width
+            rows = [row if len(row) >= width else tuple(row) + padding for row in rows]
+        # The tuples of zip are the columns, so values are not copied again:
+        values = zip(*rows) if rows else [()] * width
+        columns = [values[i] for i in indexes] + [Constant(x) for x in constants]
+        return cls(fieldnames, columns, len(rows))
+
+    def __len__(self):
+        return self.size
+
+    def index(self, name):
+        """Returns the position of the column of a fieldname, case-insensitive."""
+        name = name.strip().lower()
+        for i, x in enumerate(self.fieldnames):
+            if x.strip().lower() == name:
+                return i
+        return None
+
+    def column(self, i):
+        """Returns the sequence of values of the column at position i."""
+        column = self.columns[i]
+        if isinstance(column, Constant):
+            return [column.value] * self.size
+        return column
+
+    def append(self, name, column):
+        """Adds a column, a sequence of values or a Constant, after the others."""
+        self.fieldnames = self.fieldnames + [name]
+        self.columns.append(column)
+
+    def take(self, positions):
+        """Returns a RecordBatch of the rows at a list of positions."""
+        columns = []
+        for column in self.columns:
+            if isinstance(column, Constant):
+                columns.append(column)
+            else:
+                columns.append([column[i] for i in positions])
+        return RecordBatch(self.fieldnames, columns, len(positions))
+
+    def iter_columns(self):
+        """Returns a list of an iterable per column, with Constants repeated."""
+        return [repeat(x.value, self.size) if isinstance(x, Constant) else x
+                for x in self.columns]
+
+    def rows(self):
+        """Returns an iterator over the rows of the batch as tuples."""
+        if not self.columns:
+            return iter([()] * self.size)
+        return izip(*self.iter_columns())
+
+def iter_batches(fieldnames, rows, batch_size=BATCH_SIZE, indexes=None, constants=()):
+    """Yields RecordBatch of batch_size rows from an iterable of rows.
+
+    See RecordBatch.from_rows for fieldnames, indexes and constants.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        batch = RecordBatch.from_rows(fieldnames, batch, indexes, constants)
+        # The rows are released before the batch is used:
+        yield batch
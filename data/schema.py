@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports inspecting the header of a CSV file.
+
+The header is parsed with the CSV dialect of the file (by default the one
+written by dca2csv.py) and each fieldname is mapped case-insensitively onto a
+known column: a Darwin Core term or a column in col_types.
+
+The result is cached in a sidecar file next to the CSV file, named
+<file>.schema.json, so later stages can look up column indexes and skip the
+header without parsing it again. The sidecar is ignored once the size or
+modification time of the CSV file changes.
+"""
+
+import csv
+import csv_unicode as csvu
+import json
+import logging
+import os
+
+from dwcterms import terms, col_types, nysm_terms
+
+# The names of known columns:
+KNOWN_COLUMNS = frozenset(terms) | frozenset(nysm_terms) | frozenset(col_types)
+
+class SchemaError(ValueError):
+    """Raised when a header has columns that are not known."""
+    pass
+
+class Schema(object):
+    """The header of a CSV file mapped onto known columns.
+
+    Attributes:
+        fieldnames: The list of header fieldnames as they appear in the file.
+        columns: The list of lowercase column names, one per fieldname.
+        unknown: The list of fieldnames that are not known columns.
+        dialect: A dictionary of csv format parameters for the file.
+        data_offset: The byte offset of the first row after the header.
+    """
+
+    def __init__(self, fieldnames, dialect=None, data_offset=None):
+        """Constructs a new Schema.
+
+        Args:
+            fieldnames: The list of header fieldnames.
+            dialect: An optional dictionary of csv format parameters.
+            data_offset: The optional byte offset of the first data row.
+        """
+        self.fieldnames = list(fieldnames)
+        self.dialect = dialect or {}
+        self.data_offset = data_offset
+        self.columns = [x.strip().lower() for x in self.fieldnames]
+        self.unknown = [x for x, name in zip(self.fieldnames, self.columns)
+                        if name not in KNOWN_COLUMNS]
+        self._index = {}
+        for i, name in enumerate(self.columns):
+            self._index.setdefault(name, i)
+
+    def index(self, name):
+        """Returns the index of a column by case-insensitive name, or None."""
+        return self._index.get(name.strip().lower())
+
+    def typed_columns(self):
+        """Returns a list of (index, column name, type) for columns in col_types."""
+        return [(i, name, col_types[name]) for i, name in enumerate(self.columns)
+                if name in col_types]
+
+    def check(self):
+        """Raises a SchemaError that names every unknown column, if any."""
+        if self.unknown:
+            raise SchemaError('Unknown columns (not Darwin Core terms or in col_types): %s' %
+                              ', '.join(self.unknown))
+
+    def to_json(self):
+        return dict(fieldnames=self.fieldnames, dialect=self.dialect,
+                    data_offset=self.data_offset)
+
+    @classmethod
+    def from_json(cls, value):
+        dialect = dict((str(k), str(v) if isinstance(v, basestring) else v)
+                       for k, v in value['dialect'].iteritems())
+        return cls(value['fieldnames'], dialect, value['data_offset'])
+
+def read_schema(path, dialect=None, encoding='utf-8'):
+    """Returns the Schema of a CSV file by parsing its header.
+
+    Args:
+        path: A string path to the CSV file.
+        dialect: An optional dictionary of csv format parameters, by default
+            those of the files written by dca2csv.py.
+        encoding: The string encoding of the file.
+    """
+    with open(path, 'rb') as f:
+        lines = csvu.OffsetFile(f)
+        try:
+            fieldnames = csv.reader(lines, **(dialect or {})).next()
+        except StopIteration:
+            fieldnames = []
+        fieldnames = [x.decode(encoding) for x in fieldnames]
+        if fieldnames:
+            fieldnames[0] = fieldnames[0].lstrip(u'\ufeff')
+        return Schema(fieldnames, dialect, lines.offset)
+
+def sidecar_path(path):
+    """Returns the path to the schema sidecar file of a CSV file."""
+    return '%s.schema.json' % path
+
+def _version(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def load_schema(path, dialect=None, encoding='utf-8'):
+    """Returns the Schema of a CSV file, from its sidecar file if up to date.
+
+    If there is no up to date sidecar file the header is parsed and a sidecar
+    is written, when the directory is writable.
+
+    Args:
+        path: A string path to the CSV file.
+        dialect: An optional dictionary of csv format parameters.
+        encoding: The string encoding of the file.
+    """
+    sidecar = sidecar_path(path)
+    version = _version(path)
+    try:
+        with open(sidecar, 'r') as f:
+            cached = json.load(f)
+        if cached['version'] == version and cached['dialect'] == (dialect or {}):
+            return Schema.from_json(cached)
+    except (IOError, ValueError, KeyError):
+        pass
+    schema = read_schema(path, dialect, encoding)
+    value = schema.to_json()
+    value['version'] = version
+    try:
+        with open(sidecar, 'w') as f:
+            json.dump(value, f)
+    except IOError, e:
+        logging.warning('Could not write schema sidecar %s: %s' % (sidecar, e))
+    return schema
@@ -16,53 +16,120 @@
 
 __author__ = "Aaron Steele"
 
-"""This module supports uploading a CSV file to CartoDB over the SQL API.
+"""This module supports moving rows from a CSV staging table into occurrence.
 
-1) download taxon table into memory: {name:cartodb_id}
-2) for all names in CSV not in taxon table, bulk insert to taxon table
+A CSV file uploaded to the CartoDB dashboard becomes a staging table of text
+columns. Its rows are inserted into the occurrence table with each column cast
+to its type in col_types and empty values inserted as null.
+
+The move runs as many INSERT ... SELECT statements, one per cartodb_id range of
+the staging table, sent concurrently through the CartoDB client. Each chunk is
+retried on transient errors and can be recorded in a checkpoint file, so a
+rerun skips the chunks that already completed. With --print the statements
+are printed instead of run.
 
 """
 
-from cartodb import CartoDB, CartoDBException
+from cartodb import CartoDB, CartoDBException, RetryPolicy, SQLExecutor
+from cartodb.retry import FileLedger
 
-import collections
-import csv_unicode as csvu
-import csv
-import json
 import logging
-import os
+import metrics
 import sys
 import time
-import threading
-import zipfile
 
-from Queue import Queue
+from dwcterms import col_types
 from optparse import OptionParser
-from ssl import SSLError
-from httplib import BadStatusLine
-
-terms = ['acceptednameusage', 'acceptednameusageid', 'accessrights', 'associatedmedia', 'associatedoccurrences', 'associatedreferences', 'associatedsequences', 'associatedtaxa', 'basisofrecord', 'bed', 'behavior', 'bibliographiccitation', 'catalognumber', 'class', 'collectioncode', 'collectionid', 'continent', 'coordinateprecision', 'coordinateuncertaintyinmeters', 'country', 'countrycode', 'county', 'datageneralizations', 'datasetid', 'datasetname', 'dateidentified', 'day', 'decimallatitude', 'decimallongitude', 'disposition', 'dynamicproperties', 'earliestageorloweststage', 'earliesteonorlowesteonothem', 'earliestepochorlowestseries', 'earliesteraorlowesterathem', 'earliestperiodorlowestsystem', 'enddayofyear', 'establishmentmeans', 'eventdate', 'eventid', 'eventremarks', 'eventtime', 'family', 'fieldnotes', 'fieldnumber', 'footprintspatialfit', 'footprintsrs', 'footprintwkt', 'formation', 'genus', 'geodeticdatum', 'geologicalcontextid', 'georeferencedby', 'georeferenceddate', 'georeferenceprotocol', 'georeferenceremarks', 'georeferencesources', 'georeferenceverificationstatus', 'group', 'habitat', 'higherclassification', 'highergeography', 'highergeographyid', 'highestbiostratigraphiczone', 'identificationid', 'identificationqualifier', 'identificationreferences', 'identificationremarks', 'identificationverificationstatus', 'identifiedby', 'individualcount', 'individualid', 'informationwithheld', 'infraspecificepithet', 'institutioncode', 'institutionid', 'island', 'islandgroup', 'kingdom', 'language', 'latestageorhigheststage', 'latesteonorhighesteonothem', 'latestepochorhighestseries', 'latesteraorhighesterathem', 'latestperiodorhighestsystem', 'lifestage', 'lithostratigraphicterms', 'locality', 'locationaccordingto', 'locationid', 'locationremarks', 'lowestbiostratigraphiczone', 'maximumdepthinmeters', 'maximumdistanceabovesurfaceinmeters', 'maximumelevationinmeters', 'measurementaccuracy', 'measurementdeterminedby', 'measurementdetermineddate', 'measurementid', 'measurementmethod', 'measurementremarks', 'measurementtype', 'measurementunit', 'measurementvalue', 'member', 'minimumdepthinmeters', 'minimumdistanceabovesurfaceinmeters', 'minimumelevationinmeters', 'modified', 'month', 'municipality', 'nameaccordingto', 'nameaccordingtoid', 'namepublishedin', 'namepublishedinid', 'namepublishedinyear', 'nomenclaturalcode', 'nomenclaturalstatus', 'occurrenceid', 'occurrenceremarks', 'occurrencestatus', 'order', 'originalnameusage', 'originalnameusageid', 'othercatalognumbers', 'ownerinstitutioncode', 'parentnameusage', 'parentnameusageid', 'phylum', 'pointradiusspatialfit', 'preparations', 'previousidentifications', 'recordedby', 'recordnumber', 'references', 'relatedresourceid', 'relationshipaccordingto', 'relationshipestablisheddate', 'relationshipofresource', 'relationshipremarks', 'reproductivecondition', 'resourceid', 'resourcerelationshipid', 'rights', 'rightsholder', 'samplingeffort', 'samplingprotocol', 'scientificname', 'scientificnameauthorship', 'scientificnameid', 'sex', 'specificepithet', 'startdayofyear', 'stateprovince', 'subgenus', 'taxonconceptid', 'taxonid', 'taxonomicstatus', 'taxonrank', 'taxonremarks', 'type', 'typestatus', 'verbatimcoordinates', 'verbatimcoordinatesystem', 'verbatimdepth', 'verbatimelevation', 'verbatimeventdate', 'verbatimlatitude', 'verbatimlocality', 'verbatimlongitude', 'verbatimsrs', 'verbatimtaxonrank', 'vernacularname', 'waterbody', 'year'] 
-
-col_types = {'datasetname': 'text', 'occurrenceremarks': 'text', 'namepublishedin': 'text', 'geologicalcontextid': 'text', 'associatedreferences': 'text', 'month': 'int4', 'decimallongitude': 'text', 'fieldnotes': 'text', 'verbatimlongitude': 'text', 'highergeography': 'text', 'modified': 'text', 'startdayofyear': 'int4', 'minimumelevationinmeters': 'numeric', 'resourcerelationshipid': 'text', 'continent': 'text', 'measurementmethod': 'text', 'relationshipremarks': 'text', 'measurementtype': 'text', 'group': 'text', 'accessrights': 'text', 'locationid': 'text', 'measurementdeterminedby': 'text', 'maximumdistanceabovesurfaceinmeters': 'numeric', 'kingdom': 'text', 'identificationverificationstatus': 'text', 'cartodb_id': 'int4', 'coordinateprecision': 'numeric', 'verbatimcoordinatesystem': 'text', 'verbatimsrs': 'text', 'parentnameusageid': 'text', 'latesteraorhighesterathem': 'text', 'day': 'int4', 'identificationid': 'text', 'occurrenceid': 'text', 'earliestageorloweststage': 'text', 'earliesteonorlowesteonothem': 'text', 'measurementunit': 'text', 'footprintsrs': 'text', 'samplingeffort': 'text', 'identificationqualifier': 'text', 'names_cartodb_id': 'float8', 'phylum': 'text', 'originalnameusageid': 'text', 'datageneralizations': 'text', 'coordinateuncertaintyinmeters': 'numeric', 'higherclassification': 'text', 'habitat': 'text', 'lifestage': 'text', 'namepublishedinid': 'text', 'collectioncode': 'text', 'latestageorhigheststage': 'text', 'earliestperiodorlowestsystem': 'text', 'verbatimlatitude': 'text', 'year': 'int4', 'specificepithet': 'text', 'verbatimtaxonrank': 'text', 'relationshipestablisheddate': 'text', 'basisofrecord': 'text', 'geodeticdatum': 'text', 'latesteonorhighesteonothem': 'text', 'acceptednameusage': 'text', 'measurementvalue': 'text', 'parentnameusage': 'text', 'verbatimeventdate': 'text', 'order': 'text', 'recordedby': 'text', 'earliesteraorlowesterathem': 'text', 'samplingprotocol': 'text', 'taxonid': 'text', 'formation': 'text', 'disposition': 'text', 'measurementremarks': 'text', 'the_geom_webmercator': 'geometry', 'language': 'text', 'institutionid': 'text', 'island': 'text', 'occurrencestatus': 'text', 'ownerinstitutioncode': 'text', 'nomenclaturalstatus': 'text', 'genus': 'text', 'datasetid': 'text', 'georeferenceprotocol': 'text', 'eventremarks': 'text', 'family': 'text', 'scientificnameid': 'text', 'measurementaccuracy': 'text', 'stateprovince': 'text', 'municipality': 'text', 'nameaccordingtoid': 'text', 'county': 'text', 'georeferenceddate': 'text', 'references': 'text', 'associatedoccurrences': 'text', 'georeferencedby': 'text', 'earliestepochorlowestseries': 'text', 'taxonrank': 'text', 'verbatimlocality': 'text', 'measurementid': 'text', 'identificationreferences': 'text', 'countrycode': 'text', 'institutioncode': 'text', 'highergeographyid': 'text', 'relationshipaccordingto': 'text', 'latestperiodorhighestsystem': 'text', 'maximumelevationinmeters': 'numeric', 'nameaccordingto': 'text', 'typestatus': 'text', 'type': 'text', 'taxonconceptid': 'text', 'eventid': 'text', 'eventtime': 'text', 'islandgroup': 'text', 'verbatimdepth': 'text', 'preparations': 'text', 'measurementdetermineddate': 'text', 'pointradiusspatialfit': 'text', 'georeferenceremarks': 'text', 'footprintspatialfit': 'text', 'rights': 'text', 'dynamicproperties': 'text', 'georeferenceverificationstatus': 'text', 'sex': 'text', 'infraspecificepithet': 'text', 'bed': 'text', 'fieldnumber': 'text', 'behavior': 'text', 'country': 'text', 'taxonomicstatus': 'text', 'taxonremarks': 'text', 'eventdate': 'text', 'relatedresourceid': 'text', 'namepublishedinyear': 'text', 'individualcount': 'text', 'verbatimelevation': 'text', 'rightsholder': 'text', 'subgenus': 'text', 'bibliographiccitation': 'text', 'verbatimcoordinates': 'text', 'updated_at': 'timestamp', 'locations_cartodb_id': 'float8', 'georeferencesources': 'text', 'nomenclaturalcode': 'text', 'waterbody': 'text', 'dateidentified': 'text', 'catalognumber': 'text', 'id': 'text', 'originalnameusage': 'text', 'locality': 'text', 'relationshipofresource': 'text', 'resourceid': 'text', 'member': 'text', 'locationremarks': 'text', 'minimumdistanceabovesurfaceinmeters': 'numeric', 'informationwithheld': 'text', 'scientificnameauthorship': 'text', 'recordnumber': 'text', 'lowestbiostratigraphiczone': 'text', 'collectionid': 'text', 'acceptednameusageid': 'text', 'individualid': 'text', 'footprintwkt': 'text', 'maximumdepthinmeters': 'numeric', 'scientificname': 'text', 'highestbiostratigraphiczone': 'text', 'the_geom': 'geometry', 'class': 'text', 'vernacularname': 'text', 'previousidentifications': 'text', 'identificationremarks': 'text', 'decimallatitude': 'numeric', 'minimumdepthinmeters': 'numeric', 'latestepochorhighestseries': 'text', 'created_at': 'timestamp', 'locationaccordingto': 'text', 'othercatalognumbers': 'text', 'establishmentmeans': 'text', 'identifiedby': 'text', 'associatedmedia': 'text', 'associatedsequences': 'text', 'associatedtaxa': 'text', 'lithostratigraphicterms': 'text', 'reproductivecondition': 'text', 'original': 'text', 'enddayofyear': 'int4'}
+from schema import SchemaError, load_schema
 
+# (term, term, term_type)
+case = 'CASE WHEN "%s"=\'\' THEN null ELSE "%s"::%s END'
 
-nysm_terms = [term.lower() for term in ["id","fieldNumber","county","minimumElevationInMeters","coordinateUncertaintyInMeters","georeferenceProtocol","lifeStage","geodeticDatum","country","occurrenceRemarks","family","higherClassification","sex","catalogNumber","institutionCode","continent","stateProvince","decimalLatitude","modified","day","islandGroup","order","individualCount","infraspecificEpithet","georeferenceRemarks","locality","specificEpithet","class","scientificName","recordNumber","verbatimEventDate","year","phylum","preparations","decimalLongitude","collectionCode","island","verbatimElevation","higherGeography","recordedBy","kingdom","eventTime","genus","verbatimCoordinateSystem","basisOfRecord","maximumElevationInMeters","month"]]
+# Moves one cartodb_id range of the staging table:
+MOVE = ('INSERT INTO occurrence (%(columns)s) SELECT %(cases)s FROM %(table)s '
+        'WHERE cartodb_id >= %(start)d AND cartodb_id < %(end)d')
 
-# (term, term, term_type)
-case = "CASE WHEN %s='' THEN null ELSE %s::%s END"
+# The default number of staging rows moved per statement:
+CHUNK_SIZE = 10000
 
-"""
-1) get terms from csv
-2) build select statement
-3) post
+def get_columns(csv_file, ignore_unknown=False):
+    """Returns the lowercase columns of the header of a CSV file.
 
-"""
+    Raises a schema.SchemaError naming the unknown columns, if any, unless 
+    ignore_unknown is True.
+    """
+    csv_schema = load_schema(csv_file)
+    if not ignore_unknown:
+        csv_schema.check()
+    return csv_schema.columns
 
-def get_columns(csv_file):
-    cols = [column.strip().lower().replace('"', '') 
-            for column in open(csv_file, 'r').readline().split(',')]
-    cols.sort()
-    return cols
+def typed_columns(cols):
+    """Returns the columns that have a type in col_types, warning about others."""
+    typed = []
+    for col in cols:
+        if col in col_types:
+            typed.append(col)
+        else:
+            logging.warning('Skipping column %s with no known type' % col)
+    return typed
+
+def get_select(cols):
+    """Returns the (column list, typed select list) of an insert from staging."""
+    columns = ','.join('"%s"' % col for col in cols)
+    cases = ','.join(case % (col, col, col_types[col]) for col in cols)
+    return columns, cases
+
+def get_id_range(cdb, table):
+    """Returns the (min, max) cartodb_id of a table, or (None, None) if empty."""
+    row = cdb.sql('SELECT min(cartodb_id) AS first, max(cartodb_id) AS last FROM %s' % 
+                  table)['rows'][0]
+    return row['first'], row['last']
+
+def get_chunks(first, last, chunk_size=CHUNK_SIZE):
+    """Returns a list of [start, end) cartodb_id ranges covering first to last."""
+    if first is None:
+        return []
+    return [(start, min(start + chunk_size, last + 1)) 
+            for start in range(first, last + 1, chunk_size)]
+
+def move(executor, cols, table, chunks):
+    """Runs the move statement for each chunk concurrently and reports progress.
+
+    Chunks are not idempotent, so they are only retried after errors that mean
+    the statement was not applied. Each chunk is keyed by its table and range,
+    so chunks recorded in the executor's ledger are skipped.
+
+    Args:
+        executor: The SQLExecutor that runs chunks.
+        cols: The list of typed staging table columns.
+        table: The name of the staging table.
+        chunks: A list of (start, end) cartodb_id ranges.
+
+    Returns:
+        A list of the (start, end) ranges that failed.
+    """
+    columns, cases = get_select(cols)
+    futures = []
+    for start, end in chunks:
+        sql = MOVE % dict(columns=columns, cases=cases, table=table, start=start, end=end)
+        key = '%s:%d:%d' % (table, start, end)
+        futures.append(((start, end), executor.submit(sql, key, idempotent=False)))
+    began = time.time()
+    failed = []
+    rows = 0
+    for done, (chunk, future) in enumerate(futures, 1):
+        error = future.exception()
+        if future.elapsed is not None:
+            metrics.observe('move.chunk_seconds', future.elapsed)
+        if error:
+            logging.error('Failed to move cartodb_id %s to %s: %s' % (chunk + (error,)))
+            failed.append(chunk)
+        else:
+            rows += (future.result() or {}).get('total_rows', 0)
+        elapsed = time.time() - began
+        logging.info('Moved %s of %s chunks, %s rows (%.0f rows/s)' %
+                     (done, len(chunks), rows, rows / elapsed if elapsed else 0))
+    return failed
 
 def get_options():
     """Parses and returns command line options."""
@@ -87,6 +154,32 @@ def get_options():
                       help="The CartoDB user password")
     parser.add_option("-d", "--domain", dest="domain",
                       help="The CartoDB domain")
+    parser.add_option("--host", dest="host",
+                      help="The CartoDB host, or the whole server (e.g., "
+                      "localhost:8080) when no domain is given",
+                      default="cartodb.com")
+    parser.add_option("--protocol", dest="protocol",
+                      help="The protocol of the SQL API, https or http",
+                      default="https")
+    parser.add_option("-z", "--chunk_size", dest="chunk_size", type="int",
+                      help="The number of staging rows moved per statement",
+                      default=CHUNK_SIZE)
+    parser.add_option("-n", "--num_requests", dest="num_requests", type="int",
+                      help="The maximum number of concurrent statements",
+                      default=4)
+    parser.add_option("-b", "--checkpoint", dest="checkpoint",
+                      help="The file recording completed chunks",
+                      default=None)
+    parser.add_option("-i", "--ignore_unknown", dest="ignore_unknown", action="store_true",
+                      help="Skip columns that are not known instead of failing",
+                      default=False)
+    parser.add_option("--print", dest="print_sql", action="store_true",
+                      help="Print the statement instead of running it",
+                      default=False)
+    parser.add_option("-M", "--metrics", dest="metrics",
+                      help="The JSON file the metrics summary is written to, "
+                      "by default <table_name>.metrics.json",
+                      default=None)
 
     (options, args) = parser.parse_args()
 
@@ -97,27 +190,45 @@ if __name__ == '__main__':
 
     options = get_options()
     
+    try:
+        cols = typed_columns(get_columns(options.csv_file, options.ignore_unknown))
+    except SchemaError, e:
+        logging.error('%s - rerun with --ignore_unknown to skip them' % e)
+        sys.exit(1)
+
+    if options.print_sql:
+        # Prints out an SQL statement that inserts into occurrence table from another.
+        columns, cases = get_select(cols)
+        print 'INSERT INTO occurrence (%s) (SELECT %s FROM %s);' % (columns, cases, options.table_name)
+        sys.exit(0)
+
     cdb = CartoDB(
         options.consumer_key, 
         options.consumer_secret, 
         options.user, 
         options.password, 
-        options.domain)
-    
-    cols = get_columns(options.csv_file)
-
-    sql = 'INSERT INTO occurrence (%s) (%s);'
-
-    cases = []
-    for col in cols:
-        col_type = col_types[col]
-        col_case = case % (col, col, col_type)
-        cases.append(col_case)
-
-
-    select = 'SELECT %s FROM %s' % (reduce(lambda x,y: '%s,%s' % (x, y), cases), options.table_name)
-
-    # Prints out an SQL statement that inserts into occurrence table from another.
-    print sql % (reduce(lambda x,y: '%s,%s' % (x, y), cols), select)
-
-    
+        options.domain,
+        host=options.host,
+        protocol=options.protocol,
+        pool_size=options.num_requests,
+        observer=metrics.observe_request)
+
+    ledger = FileLedger(options.checkpoint) if options.checkpoint else None
+    executor = SQLExecutor(cdb, max_in_flight=options.num_requests, 
+                           retry=RetryPolicy(ledger=ledger, observer=metrics.observe_retry))
+
+    first, last = get_id_range(cdb, options.table_name)
+    chunks = get_chunks(first, last, options.chunk_size)
+    logging.info('Moving cartodb_id %s to %s of %s in %s chunks' % 
+                 (first, last, options.table_name, len(chunks)))
+    with metrics.timer('move'):
+        failed = move(executor, cols, options.table_name, chunks)
+    executor.shutdown()
+    metrics.METRICS.write_summary(options.metrics or '%s.metrics.json' % options.table_name,
+                                  script='sqlbutcher', table_name=options.table_name,
+                                  failed_chunks=len(failed))
+
+    if failed:
+        logging.error('%s chunks failed, rerun with --checkpoint to retry them' % len(failed))
+        sys.exit(1)
+    logging.info('Moved %s to occurrence.' % options.table_name)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports a persistent local cache of the CartoDB taxon table.
+
+The cache is a SQLite file mapping lowercase taxon names to their cartodb_id.
+It is synced incrementally: only rows with a cartodb_id greater than the last
+one seen, or an updated_at later than the last one seen, are downloaded. Names
+are looked up locally and the server is only queried for names that miss.
+Reads from the server are retried on transient errors with a RetryPolicy.
+"""
+
+import logging
+import sqlite3
+
+from itertools import chain
+
+from cartodb import RetryPolicy, sql_literal
+
+# The number of rows requested per page when syncing:
+PAGE_SIZE = 10000
+
+# The number of names per lookup query (SQLite allows 999 parameters):
+LOOKUP_SIZE = 500
+
+class TaxonCache(object):
+    """A local on-disk cache of taxon name to cartodb_id.
+
+    Attributes:
+        last_id: The largest cartodb_id synced from the server.
+        last_updated: The latest updated_at synced from the server.
+    """
+
+    def __init__(self, path):
+        """Opens (or creates) the cache.
+
+        Args:
+            path: A string path to the SQLite cache file.
+        """
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS taxon '
+                        '(name TEXT PRIMARY KEY, cartodb_id INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sync (key TEXT PRIMARY KEY, value)')
+        self.db.commit()
+
+    def _get_state(self, key, default):
+        row = self.db.execute('SELECT value FROM sync WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?)', (key, value))
+
+    def get_last_id(self):
+        return self._get_state('last_id', 0)
+    last_id = property(get_last_id)
+    def get_last_updated(self):
+        return self._get_state('last_updated', None)
+    last_updated = property(get_last_updated)
+
+    def _store(self, rows):
+        """Stores rows of name and cartodb_id and returns the number stored."""
+        rows = [(row['name'].lower(), row['cartodb_id']) for row in rows if row['name']]
+        self.db.executemany('INSERT OR REPLACE INTO taxon VALUES (?, ?)', rows)
+        return len(rows)
+
+    def _sync_pages(self, rows, page_size, last_id, last_updated):
+        """Stores synced rows and the sync state one page at a time.
+
+        Returns:
+            A (count, last_id, last_updated) tuple.
+        """
+        count = 0
+        page = []
+        for row in chain(rows, [None]):
+            if row is not None:
+                page.append(row)
+            if page and (row is None or len(page) >= page_size):
+                count += self._store(page)
+                last_id = max([last_id] + [x['cartodb_id'] for x in page])
+                last_updated = max([last_updated] + [x['updated_at'] for x in page])
+                self._set_state('last_id', last_id)
+                self._set_state('last_updated', last_updated)
+                self.db.commit()
+                page = []
+        return count, last_id, last_updated
+
+    def sync(self, cdb, page_size=PAGE_SIZE, retry=None):
+        """Downloads taxon rows added or updated since the last sync.
+
+        Args:
+            cdb: The CartoDB client.
+            page_size: The integer number of rows per request.
+            retry: An optional RetryPolicy for each request.
+
+        Returns:
+            The integer number of rows downloaded.
+        """
+        retry = retry or RetryPolicy()
+        last_id = self.last_id
+        last_updated = self.last_updated
+        columns = 'SELECT name, cartodb_id, updated_at FROM taxon'
+        count = 0
+        if last_updated:
+            # Picks up renames of rows that were already synced:
+            changed = cdb.iter_sql('%s WHERE updated_at > %s AND cartodb_id <= %d' % 
+                                   (columns, sql_literal(last_updated), last_id), page_size,
+                                   retry=retry)
+            count, last_id, last_updated = self._sync_pages(
+                changed, page_size, last_id, last_updated)
+        added = cdb.iter_sql(columns, page_size, after=last_id, retry=retry)
+        added_count, last_id, last_updated = self._sync_pages(
+            added, page_size, last_id, last_updated)
+        count += added_count
+        logging.info('Synced %s taxon rows up to cartodb_id %s' % (count, last_id))
+        return count
+
+    def lookup(self, names):
+        """Returns a dictionary of name to cartodb_id for names in the cache."""
+        names = list(names)
+        found = {}
+        for i in range(0, len(names), LOOKUP_SIZE):
+            batch = names[i:i + LOOKUP_SIZE]
+            sql = 'SELECT name, cartodb_id FROM taxon WHERE name IN (%s)' % \
+                ','.join('?' * len(batch))
+            found.update(self.db.execute(sql, batch))
+        return found
+
+    def resolve(self, cdb, names, retry=None):
+        """Returns a dictionary of name to cartodb_id, querying CartoDB for misses.
+
+        Args:
+            cdb: The CartoDB client.
+            names: An iterable of lowercase names.
+            retry: An optional RetryPolicy for each request.
+        """
+        retry = retry or RetryPolicy()
+        names = list(names)
+        found = self.lookup(names)
+        misses = [x for x in names if x not in found]
+        for i in range(0, len(misses), LOOKUP_SIZE):
+            batch = misses[i:i + LOOKUP_SIZE]
+            sql = "SELECT name, cartodb_id FROM taxon WHERE name IN (%s)" % \
+                ','.join(sql_literal(x) for x in batch)
+            rows = retry.call(cdb.sql, (sql,))['rows']
+            self._store(rows)
+            found.update((row['name'].lower(), row['cartodb_id']) for row in rows)
+        self.db.commit()
+        return found
+
+    def __contains__(self, name):
+        return self.db.execute('SELECT 1 FROM taxon WHERE name = ?', (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM taxon').fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Aaron Steele and University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele"
+
+"""This module supports coercing and validating rows by column type.
+
+Rows of UTF-8 strings are checked against the Postgres types in col_types
+before they reach CartoDB, so that one bad value can't abort a whole insert.
+Integer, numeric and timestamp values are parsed and normalized, values that
+are empty or only whitespace become empty (null), and rows with a value that
+can't be parsed are rejected with a message naming the column.
+
+Rows are validated in batches one column at a time. Columns such as year,
+month or country repeat a small number of distinct values, so each distinct
+value is only parsed once per batch.
+"""
+
+import logging
+import math
+
+from datetime import datetime
+from dwcterms import col_types
+from records import Constant, RecordBatch
+
+# The default number of rows validated per batch:
+BATCH_SIZE = 10000
+
+# The range of an int4 column:
+INT4_MIN = -2 ** 31
+INT4_MAX = 2 ** 31 - 1
+
+# Formats accepted for timestamp columns:
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+
+def coerce_int(value):
+    """Returns an integer value as a string, e.g., '12.0' as '12'."""
+    number = float(value)
+    if number != int(number):
+        raise ValueError('not an integer: %s' % value)
+    if not INT4_MIN <= number <= INT4_MAX:
+        raise ValueError('out of range: %s' % value)
+    return str(int(number))
+
+def coerce_numeric(value):
+    """Returns a finite numeric value with surrounding whitespace removed."""
+    value = value.strip()
+    number = float(value)
+    if math.isnan(number) or math.isinf(number):
+        raise ValueError('not a finite number: %s' % value)
+    return value
+
+def coerce_timestamp(value):
+    """Returns a timestamp value in the form YYYY-MM-DD HH:MM:SS."""
+    value = value.strip()
+    for format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, format).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+    raise ValueError('not a timestamp: %s' % value)
+
+# Coercion functions by column type. Text and geometry values are not coerced:
+COERCERS = {
+    'int4': coerce_int,
+    'numeric': coerce_numeric,
+    'float8': coerce_numeric,
+    'timestamp': coerce_timestamp
+}
+
+def coerce_column(values, name, col_type):
+    """Coerces a column of values.
+
+    Each distinct value is only coerced once.
+
+    Args:
+        values: A list of UTF-8 strings.
+        name: The string column name, used in error messages.
+        col_type: The string Postgres type of the column, a key of COERCERS.
+
+    Returns:
+        A (list of coerced values, dictionary of position to error message)
+        tuple. Values that can't be coerced are returned unchanged.
+    """
+    coerce = COERCERS[col_type]
+    # Maps each distinct value to its (coerced value, error message):
+    results = {'': ('', None)}
+    for value in set(values):
+        if value in results:
+            continue
+        if not value.strip():
+            results[value] = ('', None)
+        else:
+            try:
+                results[value] = (coerce(value), None)
+            except (ValueError, OverflowError):
+                results[value] = (value, 'invalid %s %s: %r' % (col_type, name, value))
+    coerced = [results[x][0] for x in values]
+    errors = dict((n, results[x][1]) for n, x in enumerate(values) if results[x][1])
+    return coerced, errors
+
+class Validator(object):
+    """Coerces and validates rows for the columns of a header.
+
+    Attributes:
+        columns: A list of (index, name, column type) for the coerced columns.
+    """
+
+    def __init__(self, fieldnames, types=col_types):
+        """Constructs a new Validator.
+
+        Args:
+            fieldnames: The list of header fieldnames.
+            types: A dictionary of lowercase column name to Postgres type.
+        """
+        self.columns = []
+        for i, name in enumerate(fieldnames):
+            col_type = types.get(name.strip().lower())
+            if col_type in COERCERS:
+                self.columns.append((i, name, col_type))
+
+    def validate(self, items, get_row=None):
+        """Coerces a batch of rows in place and separates the invalid ones.
+
+        Args:
+            items: A list of rows, each a list of UTF-8 strings.
+            get_row: An optional function that returns the row of an item, for
+                items that carry other data with their row.
+
+        Returns:
+            A (valid items, rejects) tuple where rejects is a list of (row, 
+            error message) tuples.
+        """
+        rows = map(get_row, items) if get_row else items
+        errors = {}
+        for i, name, col_type in self.columns:
+            values = [row[i] if i < len(row) else '' for row in rows]
+            coerced, column_errors = coerce_column(values, name, col_type)
+            for row, value in zip(rows, coerced):
+                if i < len(row):
+                    row[i] = value
+            for n, error in column_errors.iteritems():
+                errors.setdefault(n, []).append(error)
+        if not errors:
+            return items, []
+        valid = [x for n, x in enumerate(items) if n not in errors]
+        rejects = [(rows[n], '; '.join(errors[n])) for n in sorted(errors)]
+        return valid, rejects
+
+    def validate_batch(self, batch):
+        """Coerces the columns of a records.RecordBatch in place.
+
+        Returns:
+            A (list of the positions of valid rows, rejects) tuple where
+            rejects is a list of (row, error message) tuples.
+        """
+        errors = {}
+        for i, name, col_type in self.columns:
+            column = batch.columns[i]
+            if isinstance(column, Constant):
+                coerced, column_errors = coerce_column([column.value], name, col_type)
+                batch.columns[i] = Constant(coerced[0])
+                if column_errors:
+                    column_errors = dict((n, column_errors[0]) for n in range(len(batch)))
+            else:
+                batch.columns[i], column_errors = coerce_column(column, name, col_type)
+            for n, error in column_errors.iteritems():
+                errors.setdefault(n, []).append(error)
+        if not errors:
+            return range(len(batch)), []
+        invalid = sorted(errors)
+        rows = batch.take(invalid).rows()
+        rejects = [(list(row), '; '.join(errors[n])) for n, row in zip(invalid, rows)]
+        return [n for n in range(len(batch)) if n not in errors], rejects
+
+def iter_valid(items, validator, rejects=None, batch_size=BATCH_SIZE, get_row=None):
+    """Yields the valid items of an iterable of rows, validated in batches.
+
+    Args:
+        items: An iterable of rows, each a list of UTF-8 strings.
+        validator: The Validator for the rows.
+        rejects: An optional writer for invalid rows, each followed by its
+            error message.
+        batch_size: The integer number of rows validated at once.
+        get_row: An optional function that returns the row of an item.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            for x in _validate_batch(batch, validator, rejects, get_row)[0]:
+                yield x
+            batch = []
+    for x in _validate_batch(batch, validator, rejects, get_row)[0]:
+        yield x
+
+def valid_positions(batch, validator, rejects=None):
+    """Coerces a records.RecordBatch and returns the positions of valid rows.
+
+    Invalid rows are written to rejects, if given, with their error message.
+    """
+    valid, invalid = validator.validate_batch(batch)
+    if invalid:
+        logging.warning('Rejected %s of %s rows' % (len(invalid), len(batch)))
+        if rejects:
+            rejects.writerows(x + [error] for x, error in invalid)
+    return valid
+
+def _validate_batch(batch, validator, rejects, get_row=None):
+    """Returns the (valid items, rejects) of a batch, writing rejects if given."""
+    if not batch:
+        return [], []
+    valid, invalid = validator.validate(batch, get_row)
+    if invalid:
+        logging.warning('Rejected %s of %s rows' % (len(invalid), len(batch)))
+        if rejects:
+            rejects.writerows(x + [error] for x, error in invalid)
+    return valid, invalid
+
+class ValidatingWriter(object):
+    """A writer that validates rows in batches before writing them to another.
+
+    Invalid rows are written to a separate rejects writer with their error
+    message appended, so callers must call flush() when done.
+
+    Attributes:
+        rejected: The integer number of rows rejected so far.
+    """
+
+    def __init__(self, writer, fieldnames, rejects=None, batch_size=BATCH_SIZE):
+        """Constructs a new ValidatingWriter.
+
+        Args:
+            writer: The writer for valid rows, e.g., a csv_unicode.UnicodeWriter.
+            fieldnames: The list of header fieldnames of the rows.
+            rejects: An optional writer for invalid rows.
+            batch_size: The integer number of rows validated at once.
+        """
+        self.writer = writer
+        self.fieldnames = fieldnames
+        self.validator = Validator(fieldnames)
+        self.rejects = rejects
+        self.batch_size = batch_size
+        self.rows = []
+        self.rejected = 0
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self, batch):
+        """Validates a records.RecordBatch and writes its valid rows."""
+        self.flush()
+        valid = valid_positions(batch, self.validator, self.rejects)
+        self.rejected += len(batch) - len(valid)
+        if len(valid) < len(batch):
+            batch = batch.take(valid)
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        """Validates and writes the buffered rows."""
+        rows, self.rows = self.rows, []
+        if rows:
+            self.write_batch(RecordBatch.from_rows(self.fieldnames, rows))